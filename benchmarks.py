@@ -0,0 +1,243 @@
+#!/usr/bin/python3
+"""Ad-hoc performance measurements. Run `python benchmarks.py [NAME ...]`, all of them by default."""
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from os import remove
+from os.path import getsize
+from random import Random
+from resource import getrusage, RUSAGE_SELF
+from sys import argv
+from pathlib import Path
+from shutil import copyfile, rmtree
+from tempfile import mkdtemp, mkstemp
+from time import perf_counter
+import json
+import tracemalloc
+
+from src.Matrix import DocsGenerator, ExcelPrinter, Matrix, ServiceAssignmentsMatrix, bundle_jobs, get_bundle_zip, get_printer, iter_docx, printers
+from src.Task import DiskSnapshotStorage, SnapshotManager, SnapshotStorage, Task, TaskProvider, tasklist_to_json, json_to_tasklist
+
+
+class MemorySnapshotStorage(SnapshotStorage):
+    def __init__(self) -> None:
+        self.s: dict[str, dict[str, tuple[str, float]]] = {}
+
+    def write(self, storage_id: str, data_id: str, data: str) -> None:
+        self.s.setdefault(storage_id, {})[data_id] = (data, perf_counter())
+
+    def list(self, storage_id: str) -> dict[str, float]:
+        return {k: v[1] for k, v in self.s.get(storage_id, {}).items()}
+
+    def read(self, storage_id: str, data_id: str) -> str:
+        return self.s[storage_id][data_id][0]
+
+    def delete(self, storage_id: str, data_id: str) -> None:
+        del self.s[storage_id][data_id]
+
+
+def synthetic_tasks(n: int, seed: int = 0, body_size: int = 400) -> list[Task]:
+    """Tasks resembling the real ones: a few dozen people, products and releases"""
+    r = Random(seed)
+    people = [f'Имя{i} Фамилия{i}' for i in range(60)]
+    releases = [f'{p}_{v}.{m}.0' for p in ('CC', 'CR', 'CRE', 'CRS', 'IS', 'LX6')
+                for v in range(12, 15) for m in range(3)] + ['']
+    out = []
+    for i in range(n):
+        t = Task(f'Задача номер {seed}-{i} про что-то важное', r.sample(people, r.choice((1, 1, 2))),
+                 r.choice(releases), f'https://tfs.content.ai/HQ/_workitems/edit/{seed}{i}',
+                 tid=f'{seed}{i}', project=r.choice(('HQ', 'AIS', 'Lingvo')),
+                 parent_title=f'Родительская задача {i // 10}', body='Тело задачи. ' * (body_size // 13))
+        out.append(t)
+    return out
+
+
+def measure(f):
+    """Returns (result, seconds, traced bytes still held by the result, peak traced bytes)"""
+    tracemalloc.start()
+    t = perf_counter()
+    x = f()
+    t = perf_counter() - t
+    held, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return x, t, held, peak
+
+
+def bench_task_memory():
+    """Loading a year of monthly snapshots: slotted Task vs the former __dict__ based one"""
+    class DictTask:
+        def __init__(self, **kwargs) -> None:
+            for k, v in kwargs.items():
+                setattr(self, k, v)
+
+    year = [tasklist_to_json(synthetic_tasks(3000, m)) for m in range(12)]
+    for name, load in (('dict', lambda s: [DictTask(**a) for a in json.loads(s)]),
+                       ('slots', json_to_tasklist)):
+        x, t, held, peak = measure(lambda: [load(s) for s in year])
+        print((f'  {name:>6}: {sum(map(len, x))} tasks, {t:.2f} s,'
+               f' held {held / 2**20:.1f} MiB, peak {peak / 2**20:.1f} MiB'))
+
+
+def bench_snapshots_load():
+    """Loading 50 synthetic snapshots of 3000 tasks for --snapshot_get: one process vs the process pool"""
+    class Provider(TaskProvider):
+        def get_tasks(self, pat, date_from, date_to) -> list[Task]:
+            return synthetic_tasks(3000, int(date_from[:2]) * 100 + int(date_from[3:5]))
+
+    d = mkdtemp()
+    try:
+        sm = SnapshotManager(DiskSnapshotStorage(d), Provider())
+        for i in range(50):
+            x = f'{i % 28 + 1:02}-{i // 28 + 1:02}-2023'
+            sm.draft_update('', x, x)
+            sm.draft_approve(x, x)
+        x = sm.snapshots_list()
+        for workers in (1, 4, None):
+            t = perf_counter()
+            n = len(sm.snapshots_get_tasks(x, workers))
+            print(f'  workers {workers or "all"}: {n} tasks, {perf_counter() - t:.2f} s')
+    finally:
+        rmtree(d)
+
+
+def synthetic_matrix(assignees: int, releases: int, tasks_per_assignee: int, seed: int = 0) -> Matrix:
+    r = Random(seed)
+    rs = [f'P{i % 20}_{i // 20}.0.0' for i in range(releases)] + ['']
+    return Matrix([Task(f'Задача {a}-{i} с довольно длинным названием, как в жизни', [f'Имя{a} Фамилия{a}'],
+                        r.choice(rs), f'https://tfs.content.ai/HQ/_workitems/edit/{a}{i}')
+                   for a in range(assignees) for i in range(tasks_per_assignee)])
+
+
+def _xlsx_write(streaming: bool) -> tuple[float, float, int]:
+    m = synthetic_matrix(1000, 200, 40)
+    rss = getrusage(RUSAGE_SELF).ru_maxrss
+    out = mkstemp(suffix='.xlsx')[1]
+    t = perf_counter()
+    with ExcelPrinter(out, '01-01-2023', '31-01-2023', streaming) as p:
+        p.print(m)
+    t = perf_counter() - t
+    remove(out)
+    return t, rss, getrusage(RUSAGE_SELF).ru_maxrss
+
+
+def bench_xlsx_streaming():
+    """Writing the .xlsx of 1000 assignees × 200 releases: the in-memory workbook vs --xlsx_streaming
+    (the latter lists the tasks on the sheet of tasks instead of the comments)"""
+    for streaming in (False, True):
+        with ProcessPoolExecutor(1) as e:  # a fresh process for a clean peak RSS
+            t, before, after = e.submit(_xlsx_write, streaming).result()
+        print((f'  {"streaming" if streaming else "in-memory":>9}: {t:.2f} s,'
+               f' peak RSS {after / 2**10:.0f} MiB ({(after - before) / 2**10:.0f} MiB over the matrix)'))
+
+
+def bench_xlsx_comments():
+    """Writing the .xlsx of 300 assignees × 100 releases: the tasks in the comments vs on the sheet of tasks"""
+    m = synthetic_matrix(300, 100, 40)
+    for name, options in (('comments', {}), ('tasks sheet', {'comments': False, 'tasks_sheet': True})):
+        out = mkstemp(suffix='.xlsx')[1]
+        t = perf_counter()
+        with ExcelPrinter(out, '01-01-2023', '31-01-2023', **options) as p:
+            p.print(m)
+        t = perf_counter() - t
+        print(f'  {name:>11}: {t:.2f} s, {getsize(out) / 2**20:.1f} MiB')
+        remove(out)
+
+
+def bench_formats():
+    """Writing the matrix of 1000 assignees × 200 releases in each of the --format"""
+    m = synthetic_matrix(1000, 200, 40)
+    for fmt in printers:
+        out = mkstemp(suffix=printers[fmt].suffix)[1]
+        t = perf_counter()
+        with get_printer(fmt, out, '01-01-2023', '31-01-2023') as p:
+            p.print(m)
+        t = perf_counter() - t
+        print(f'  {fmt:>7}: {t:.2f} s, {getsize(out) / 2**20:.1f} MiB')
+        remove(out)
+
+
+def bench_matrix_memory():
+    """Building the matrix of a 20000 tasks draft: from the loaded list vs from the iterator of the draft"""
+    class Provider(TaskProvider):
+        def get_tasks(self, pat, date_from, date_to) -> list[Task]:
+            return synthetic_tasks(20000, 0, 4000)
+
+    sm = SnapshotManager(MemorySnapshotStorage(), Provider())
+    sm.draft_update('', '01-01-2023', '31-01-2023')
+    for name, load in (('list', sm.draft_get_tasks), ('iterator', sm.draft_iter_tasks)):
+        m, t, held, peak = measure(lambda: Matrix(load('01-01-2023', '31-01-2023')))
+        print(f'  {name:>8}: {t:.2f} s, held {held / 2**20:.1f} MiB, peak {peak / 2**20:.1f} MiB')
+
+
+def synthetic_bundle_tasks(seed: int = 0) -> list[Task]:
+    """10 assignees × 10 releases, 2 tasks each"""
+    r = Random(seed)
+    tasks = []
+    for a in range(10):
+        for i in range(20):
+            t = Task(f'Задача {a}-{i}', [f'Имя{a} Фамилия{a}'], f'P{i % 10}_1.0.0', f'http://{a}/{i}')
+            t.essence = t.essence_completed = f'Сделано что-то полезное по задаче {a}-{i}' * r.randint(1, 3)
+            tasks.append(t)
+    return tasks
+
+
+def synthetic_templates(d: Path) -> None:
+    for doctype in ('todo', 'done'):
+        (d / doctype).mkdir()
+        for p in range(10):
+            copyfile('.test_files/test_template_good.docx', d / doctype / f'P{p}.docx')
+
+
+def bench_bundle_docx():
+    """Generating the docx of a bundle, 10 assignees × 10 releases: one process vs the process pool,
+    python-docx vs the precompiled templates"""
+    _, jobs = bundle_jobs(ServiceAssignmentsMatrix(synthetic_bundle_tasks()), '01-01-2023', '31-01-2023')
+    d = Path(mkdtemp())
+    try:
+        synthetic_templates(d)
+        for precompiled in (False, True):
+            for workers in (1, None):
+                dg = DocsGenerator(str(d), precompiled)
+                t = []
+                for _ in range(2):  # the templates are parsed and compiled the first time only
+                    t.append(perf_counter())
+                    x = [len(x) for x in iter_docx(jobs, dg, workers)]
+                    t[-1] = perf_counter() - t[-1]
+                print((f'  {"precompiled" if precompiled else "python-docx"}, workers {workers or "all"}:'
+                       f' {sum(x) / 2**20:.1f} MiB, first {t[0]:.2f} s, again {t[1]:.2f} s,'
+                       f' {t[1] / len(x) * 1000:.1f} ms per docx'))
+    finally:
+        rmtree(d)
+
+
+def bench_bundle_incremental():
+    """Re-issuing a bundle of 10 assignees × 10 releases after an essence is corrected: anew vs incremental"""
+    tasks = synthetic_bundle_tasks()
+    d = Path(mkdtemp())
+    try:
+        synthetic_templates(d)
+        dg = DocsGenerator(str(d))
+        t = perf_counter()
+        first = get_bundle_zip(ServiceAssignmentsMatrix(tasks), '01-01-2023', '31-01-2023', {}, dg)
+        print(f'  anew: {perf_counter() - t:.2f} s')
+        tasks[0].essence_completed += ' (исправлено)'
+        t = perf_counter()
+        get_bundle_zip(ServiceAssignmentsMatrix(tasks), '01-01-2023', '31-01-2023', {}, dg, previous=BytesIO(first))
+        print(f'  incremental: {perf_counter() - t:.2f} s')
+    finally:
+        rmtree(d)
+
+
+benchmarks = {'task_memory': bench_task_memory,
+              'snapshots_load': bench_snapshots_load,
+              'xlsx_streaming': bench_xlsx_streaming,
+              'xlsx_comments': bench_xlsx_comments,
+              'formats': bench_formats,
+              'matrix_memory': bench_matrix_memory,
+              'bundle_docx': bench_bundle_docx,
+              'bundle_incremental': bench_bundle_incremental}
+
+
+if __name__ == "__main__":
+    for name in argv[1:] or benchmarks:
+        print(f'{name}: {benchmarks[name].__doc__}')
+        benchmarks[name]()
@@ -4,7 +4,10 @@ from time import sleep
 from typing import List, Tuple
 from pathlib import Path
 from sqlite3 import connect, IntegrityError
+import gzip
+import json
 from copy import deepcopy
+from zlib import compress, decompress
 from progress.bar import Bar
 
 from src.Task import Task
@@ -22,7 +25,7 @@ class FastStorage:
         """
         raise NotImplementedError
 
-    def memorize_essense(self, task: Task):
+    def memorize_essense(self, task: Task, model: str = ''):
         raise NotImplementedError
 
 
@@ -45,10 +48,36 @@ class SQlite(FastStorage):
                          ");"))
             con.close()
         self.con = connect(self.db)
+        # deps injection points:
+        self.now = lambda: datetime.now().astimezone().timestamp()
+        self._migrate()
+
+    def _migrate(self):
+        """Brings the caches created by the older versions up to the current schema"""
+        cols = {x[1] for x in self.con.execute("PRAGMA table_info(essence_cache);")}
+        with self.con:
+            if 'last_used' not in cols:
+                self.con.execute(("ALTER TABLE essence_cache"
+                                  " ADD COLUMN last_used REAL NOT NULL DEFAULT 0;"))
+                # the usage history is unknown, so start counting from now
+                self.con.execute("UPDATE essence_cache SET last_used=?;", (self.now(),))
+            if 'model' not in cols:
+                self.con.execute(("ALTER TABLE essence_cache"
+                                  " ADD COLUMN model TEXT NOT NULL DEFAULT '';"))
+            if 'updated' not in cols:
+                self.con.execute(("ALTER TABLE essence_cache"
+                                  " ADD COLUMN updated REAL NOT NULL DEFAULT 0;"))
+            self.con.execute(("CREATE TABLE IF NOT EXISTS cache_stats ("
+                              "   name TEXT PRIMARY KEY, "
+                              "   value INTEGER NOT NULL"
+                              ");"))
+            self.con.execute(("CREATE INDEX IF NOT EXISTS essence_cache_last_used"
+                              " ON essence_cache (last_used);"))
 
     def read_essense(self, tasks: List[Task]) -> Tuple[List[Task], List[Task]]:
         known: List[Task] = []
         unknown: List[Task] = []
+        used = []
         for t in tasks:
             q = "SELECT essence, essence_completed FROM essence_cache WHERE project=? AND tid=?;"
             e = self.con.execute(q, (t.project, t.tid)).fetchone()
@@ -59,29 +88,187 @@ class SQlite(FastStorage):
                 c.essence = e[0]
                 c.essence_completed = e[1]
                 known.append(c)
+                used.append((t.project, t.tid))
+        now = self.now()
+        q = ('INSERT INTO cache_stats VALUES(?, ?)'
+             ' ON CONFLICT(name) DO UPDATE SET value=value+excluded.value;')
+        with self.con:
+            self.con.executemany(
+                "UPDATE essence_cache SET last_used=? WHERE project=? AND tid=?;",
+                [(now, p, i) for p, i in used])
+            self.con.executemany(q, (('hits', len(known)), ('misses', len(unknown))))
         return (known, unknown)
 
-    def memorize_essense(self, task: Task):
+    def memorize_essense(self, task: Task, model: str = ''):
         d = {'project': task.project,
              'tid': task.tid,
              'parent_title': task.parent_title,
              'title': task.title,
              'body': task.body,
              'essence': task.essence,
-             'essence_completed': task.essence_completed}
+             'essence_completed': task.essence_completed,
+             'model': model,
+             'last_used': self.now(),
+             'updated': self.now()}
         q = ('INSERT INTO essence_cache'
-             ' VALUES(:project, :tid, :parent_title, :title, :body, :essence, :essence_completed)'
+             '   (project, tid, parent_title, title, body, essence, essence_completed, model, last_used, updated)'
+             ' VALUES(:project, :tid, :parent_title, :title, :body, :essence, :essence_completed,'
+             '        :model, :last_used, :updated)'
              ' ON CONFLICT(project, tid) DO'
-             ' UPDATE SET parent_title=:parent_title, title=:title, essence=:essence, body=:body, essence_completed=:essence_completed;')
+             ' UPDATE SET parent_title=:parent_title, title=:title, essence=:essence, body=:body,'
+             ' essence_completed=:essence_completed, model=:model, last_used=:last_used, updated=:updated;')
         try:
             with self.con:
                 self.con.execute(q, d)
+                self._count_writes(1)
         except (IntegrityError) as e:
             raise RuntimeError(
                 f'SQlite error {e.sqlite_errorcode}: {e.sqlite_errorname}')
 
+    def _count_writes(self, n: int) -> None:
+        q = ('INSERT INTO cache_stats VALUES(?, ?)'
+             ' ON CONFLICT(name) DO UPDATE SET value=value+excluded.value;')
+        self.con.execute(q, ('writes', n))
+
+    def essences_version(self) -> int:
+        """Grows with every change of the essences, so the outputs made of them could be cached.
+        The timestamps can't tell it: a merge may bring in an essence older than the one replaced"""
+        x = self.con.execute("SELECT value FROM cache_stats WHERE name='writes';").fetchone()
+        return x[0] if x else 0
+
+    def stats(self) -> dict:
+        """Returns the size of the DB file in bytes, the count of rows and the hit ratio"""
+        rows, bodies_z = self.con.execute(("SELECT count(*), count(CASE typeof(body) WHEN 'blob' THEN 1 END)"
+                                           " FROM essence_cache;")).fetchone()
+        c = dict(self.con.execute("SELECT name, value FROM cache_stats;").fetchall())
+        hits, misses = c.get('hits', 0), c.get('misses', 0)
+        return {'size': self.db.stat().st_size,
+                'rows': rows,
+                'bodies_compressed': bodies_z,
+                'hits': hits,
+                'misses': misses,
+                'hit_ratio': hits / (hits + misses) if hits + misses else 0.0}
+
+    def evict_older_than(self, days: float) -> int:
+        """Deletes the entries not used for the given count of days, returns the count deleted"""
+        with self.con:
+            c = self.con.execute("DELETE FROM essence_cache WHERE last_used < ?;",
+                                 (self.now() - days * 86400,))
+        return c.rowcount
+
+    def evict_to_size(self, max_bytes: int) -> int:
+        """Deletes the least recently used entries until the payload fits into max_bytes.
+        The file itself shrinks only after vacuum()"""
+        q = ("SELECT rowid, ifnull(length(CAST(body AS BLOB)), 0) + length(CAST(title AS BLOB))"
+             " + ifnull(length(CAST(parent_title AS BLOB)), 0) + length(CAST(essence AS BLOB))"
+             " + length(CAST(essence_completed AS BLOB)) + length(project) + length(tid)"
+             " FROM essence_cache ORDER BY last_used DESC;")
+        ttl, victims = 0, []
+        for rowid, size in self.con.execute(q).fetchall():
+            ttl += size
+            if ttl > max_bytes:
+                victims.append((rowid,))
+        with self.con:
+            self.con.executemany("DELETE FROM essence_cache WHERE rowid=?;", victims)
+        return len(victims)
+
+    def compact_bodies(self, days: float, drop: bool = False) -> int:
+        """Compresses (or drops) the bodies of the entries not used for the given count of days.
+        The body is never read back to generate the essence, it is kept for the reference only"""
+        cutoff = self.now() - days * 86400
+        with self.con:
+            if drop:
+                c = self.con.execute(("UPDATE essence_cache SET body=NULL"
+                                      " WHERE last_used < ? AND body IS NOT NULL;"), (cutoff,))
+                return c.rowcount
+            q = "SELECT rowid, body FROM essence_cache WHERE last_used < ? AND typeof(body)='text';"
+            x = [(compress(b.encode('utf-8')), r)
+                 for r, b in self.con.execute(q, (cutoff,)).fetchall()]
+            self.con.executemany("UPDATE essence_cache SET body=? WHERE rowid=?;", x)
+        return len(x)
+
+    @staticmethod
+    def body_decode(body: str | bytes | None) -> str | None:
+        if isinstance(body, bytes):
+            return decompress(body).decode('utf-8')
+        return body
+
+    export_format = {'format': 'essence_cache', 'version': 1}
+    export_columns = ('project', 'tid', 'parent_title', 'title',
+                      'essence', 'essence_completed', 'model', 'updated')
+
+    def export(self, path: str, since: float = 0.0) -> int:
+        """Writes the essences generated since the timestamp into a gzipped JSON Lines file.
+        The bodies are left behind, they are not needed to skip the AI calls"""
+        q = f"SELECT {', '.join(self.export_columns)} FROM essence_cache WHERE updated >= ?;"
+        n = 0
+        with gzip.open(path, mode='wt', encoding='utf-8') as f:
+            f.write(json.dumps(self.export_format) + '\n')
+            for x in self.con.execute(q, (since,)):
+                f.write(json.dumps(dict(zip(self.export_columns, x)), ensure_ascii=False) + '\n')
+                n += 1
+        return n
+
+    def merge(self, path: str, prefer_model: str | None = None) -> int:
+        """Bulk merges an exported file into the cache, returns the count of entries changed.
+
+        On conflict the most recently generated essence wins, unless prefer_model is given:
+        then the essence generated by that model wins and the recency only breaks the ties."""
+        with gzip.open(path, mode='rt', encoding='utf-8') as f:
+            try:
+                header = json.loads(f.readline())
+            except ValueError:
+                header = None
+            if header != self.export_format:
+                raise RuntimeError(f'{path} is not an essence cache export')
+            rows = [self._export_row(path, i, x) for i, x in enumerate(f, 2)]
+        cols = ', '.join(self.export_columns)
+        wins = 'excluded.updated > essence_cache.updated'
+        if prefer_model is not None:
+            wins = ('(excluded.model = :m AND essence_cache.model != :m)'
+                    ' OR ((excluded.model = :m) = (essence_cache.model = :m)'
+                    f' AND {wins})')
+        q = (f'INSERT INTO essence_cache ({cols}, last_used)'
+             f' SELECT {cols}, :now FROM temp.essence_import WHERE true'
+             ' ON CONFLICT(project, tid) DO UPDATE SET'
+             ' parent_title=excluded.parent_title, title=excluded.title, essence=excluded.essence,'
+             ' essence_completed=excluded.essence_completed, model=excluded.model, updated=excluded.updated'
+             f' WHERE {wins};')
+        try:
+            with self.con:
+                self.con.execute(f'CREATE TEMP TABLE essence_import ({cols});')
+                self.con.executemany(
+                    f'INSERT INTO temp.essence_import VALUES ({", ".join("?" * len(self.export_columns))});', rows)
+                changes = self.con.total_changes
+                self.con.execute(q, {'now': self.now(), 'm': prefer_model})
+                changes = self.con.total_changes - changes
+                self._count_writes(changes)
+        finally:
+            # the DDL isn't a part of the transaction, the table would outlive a failed merge
+            self.con.execute('DROP TABLE IF EXISTS temp.essence_import;')
+        return changes
+
+    export_required = ('project', 'tid', 'title', 'essence', 'essence_completed')  # NOT NULL in the cache
+
+    def _export_row(self, path: str, line: int, x: str) -> tuple:
+        try:
+            d = json.loads(x)
+        except ValueError:
+            d = None
+        if not isinstance(d, dict) or any(k not in d for k in self.export_columns) \
+                or any(d[k] is None for k in self.export_required):
+            raise RuntimeError(f'{path}:{line} is not an exported essence')
+        return tuple(d[k] for k in self.export_columns)
+
+    def vacuum(self):
+        self.con.execute("ANALYZE;")
+        self.con.commit()
+        self.con.execute("VACUUM;")
+
 
 class AI:
+    model = ''
+
     def generate_essense(self, task: Task) -> Task:
         raise NotImplementedError
 
@@ -90,6 +277,7 @@ class ChatGPT(AI):
     def __init__(self, api_key: str, max_rpm: float) -> None:
         if api_key:  # could be also set through environment variable, check the docs
             openai.api_key = api_key
+        self.model = 'gpt-3.5-turbo'
         self.max_rate_sec = 60 / max_rpm
         self.last_request_ts: float = 0.0
         # deps injection points:
@@ -147,7 +335,7 @@ class ChatGPT(AI):
             raise RuntimeError("Task's title must not be empty")
         m = [{'role': 'user', 'content': p}]
         c = openai.ChatCompletion.create(
-            model='gpt-3.5-turbo', messages=m, temperature=0.5)
+            model=self.model, messages=m, temperature=0.5)
         return c.choices[0].message.content
 
     def ai_todo2done(self, todo: str) -> str:
@@ -156,7 +344,7 @@ class ChatGPT(AI):
              '\nСформулируй одно краткое предложение, отвечающее на вопрос "что сделано?".')
         m = [{'role': 'user', 'content': p}]
         c = openai.ChatCompletion.create(
-            model='gpt-3.5-turbo', messages=m, temperature=0.5)
+            model=self.model, messages=m, temperature=0.5)
         return c.choices[0].message.content
 
 
@@ -173,7 +361,7 @@ class Cache:
         with Bar('Talking with the AI:', max=len(unk)) as bar:
             for t in unk:
                 o = self.ai.generate_essense(t)
-                self.fs.memorize_essense(o)
+                self.fs.memorize_essense(o, self.ai.model)
                 gen.append(o)
                 bar.next()
         return k + gen
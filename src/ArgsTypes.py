@@ -1,4 +1,5 @@
 from argparse import ArgumentParser, ArgumentTypeError
+from datetime import datetime
 from json import loads
 from os import path
 from math import fsum
@@ -83,6 +84,18 @@ class ArgsTypes:
                                      "automatically based on the latest snapshot available."))
         return (f'{m.group(2)}-{m.group(3)}-{m.group(4)}', f'{m.group(6)}-{m.group(7)}-{m.group(8)}')
 
+    @staticmethod
+    def arg_date(i: str) -> float:
+        """parses dd.mm.YYYY into the local timestamp"""
+        m = re.fullmatch(r'(\d\d?)[-\.\/\s](\d\d?)[-\.\/\s](\d\d\d\d)', i)
+        if not m:
+            raise ArgumentTypeError(("Please provide the date in the following format "
+                                     "dd.mm.YYYY (you can use '-','/',' ' instead of '.')."))
+        try:
+            return datetime(int(m.group(3)), int(m.group(2)), int(m.group(1))).timestamp()
+        except ValueError as e:
+            raise ArgumentTypeError(f'Invalid date "{i}": {e}')
+
     @staticmethod
     def arg_range_or_single(i: str) -> list[int]:
         m = re.match(r'^(\d+)$', i)
@@ -94,6 +107,33 @@ class ArgsTypes:
         raise ArgumentTypeError(('Please supply either a single number'
                                  f' or a range like 2-4. Got "{i}"'))
 
+    @staticmethod
+    def arg_age_or_size(i: str) -> tuple[str, int]:
+        """parses either '90d' into ('age', 90) or '500MB' into ('size', 524288000)"""
+        m = re.fullmatch(r'(\d+)\s*d', i.strip(), re.IGNORECASE)
+        if m:
+            return ('age', int(m.group(1)))
+        try:
+            return ('size', ArgsTypes.arg_size(i))
+        except ArgumentTypeError:
+            raise ArgumentTypeError(('Please supply either the age in days like 90d'
+                                     f' or the size like 500MB. Got "{i}"'))
+
+    @staticmethod
+    def arg_size(i: str) -> int:
+        """parses '500MB' into 524288000"""
+        m = re.fullmatch(r'(\d+)\s*([KMG]?)B?', i.strip(), re.IGNORECASE)
+        if m:
+            return int(m.group(1)) * 1024 ** ' KMG'.index(m.group(2).upper() or ' ')
+        raise ArgumentTypeError(f'Please supply the size like 500MB. Got "{i}"')
+
+    @staticmethod
+    def arg_positive_int(i: str) -> int:
+        m = re.fullmatch(r'\d+', i.strip())
+        if m and int(i) > 0:
+            return int(i)
+        raise ArgumentTypeError(f'Please supply a positive number. Got "{i}"')
+
 
 def parse_args():
     parser = ArgumentParser()
@@ -133,6 +173,9 @@ def parse_args():
     mutex.add_argument("--drafts_list", action='store_true')
     mutex.add_argument("--draft_get", type=int, metavar='DRAFT#',
                        help="Generates the .xlsx from the draft")
+    mutex.add_argument("--draft_diff", type=int, metavar='DRAFT#',
+                       help=("Lists the tasks added, removed or moved between the releases and assignees "
+                             "by the latest update of the draft"))
     mutex.add_argument("--draft_delete", type=int, metavar='DRAFT#')
     mutex.add_argument("--draft_approve", type=int, metavar='DRAFT#',
                        help="Marks the draft as containing verified information.")
@@ -141,12 +184,83 @@ def parse_args():
                        help=("Generates .zip containing the time distribution's .xlsx "
                              "and the service assignments' .docx files. Accepts either "
                              "a single integer or a range like 1-4"))
+    mutex.add_argument("--report_periods", type=ArgsTypes.arg_range_or_single, metavar='# | #-#',
+                       help=("Generates the time distribution over the range of snapshots (e.g. a quarter or a year) "
+                             "with a column per calendar month and the total. The snapshots are computed in parallel "
+                             "and only once, see --jobs and --no_render_cache"))
+    mutex.add_argument("--manifest_rebuild", action='store_true',
+                       help=("Rereads all the drafts and snapshots to rebuild their manifest, "
+                             "needed only if the storage was modified by hand"))
+    mutex.add_argument("--snapshots_migrate", action='store_true',
+                       help=("Rewrites the drafts and snapshots kept in the legacy JSON format or with the task "
+                             "bodies inline into the compact JSON Lines with the bodies stored aside. See also --gzip"))
+    mutex.add_argument("--cache_stats", action='store_true',
+                       help="Prints the size, the count of rows and the hit ratio of the AI cache")
+    mutex.add_argument("--cache_evict", type=ArgsTypes.arg_age_or_size, metavar='DAYSd|SIZE[K|M|G]B',
+                       help=("Removes from the AI cache either the entries not used for the given count of days "
+                             "(like 180d) or the least recently used ones until the cache fits the size (like 200MB)"))
+    mutex.add_argument("--cache_compact", type=int, metavar='DAYS',
+                       help=("Compresses the task bodies of the AI cache entries not used for the given count "
+                             "of days. See also --drop_bodies"))
+    mutex.add_argument("--cache_vacuum", action='store_true',
+                       help="Refreshes the AI cache statistics and rebuilds the file to reclaim the free space")
+    mutex.add_argument("--cache_export", metavar='./FILE.jsonl.gz',
+                       help=("Exports the AI generated essences into a portable file to share them "
+                             "with the colleagues. See also --since"))
+    mutex.add_argument("--cache_import", metavar='./FILE.jsonl.gz',
+                       help=("Merges the essences exported by --cache_export into the AI cache. On conflict "
+                             "the most recently generated essence wins. See also --prefer_model"))
 
     parser.add_argument("--out",
                         metavar='./FILE_TO_WRITE_INTO.xlsx|.zip',
-                        help="File to put the results into. Defaults to a file in temp folder.")
+                        help=("File to put the results into. Defaults to a file in temp folder. "
+                              "'-' tells --snapshot_get to write the .zip into the stdout."))
     parser.add_argument("--no_open", action='store_true',
                         help="Tells if to open the resulting file immediately after creation")
+    parser.add_argument("--format", choices=('xlsx', 'csv', 'jsonl', 'columns'), default='xlsx',
+                        help=("Format of the time distribution written by --draft_update, --draft_get and "
+                              "--snapshot_get: the .xlsx for people, the .csv of the same grid, a json line per "
+                              "assignee or the json of the non-zero cells by columns. Defaults to 'xlsx'."))
+    parser.add_argument("--xlsx_streaming", action='store_true',
+                        help=("Writes the .xlsx row by row keeping the memory use constant, for the huge matrices. "
+                              "The column widths are then estimated instead of autofitted. As the cells' comments "
+                              "are kept in memory anyway, the tasks are then listed on the sheet of tasks instead "
+                              "of the comments, see --xlsx_tasks_sheet"))
+    parser.add_argument("--no_comments", action='store_true',
+                        help=("Tells not to list the tasks in the .xlsx cells' comments, they make the huge "
+                              ".xlsx slow to generate and to open. See also --xlsx_tasks_sheet"))
+    parser.add_argument("--xlsx_tasks_sheet", action='store_true',
+                        help=("Lists all the tasks on a separate sheet of the .xlsx sorted by assignee and release, "
+                              "each cell of the matrix links to its tasks there"))
+    parser.add_argument("--docx_precompiled", action='store_true',
+                        help=("Tells --snapshot_get to fill the templates precompiled once instead of building "
+                              "each .docx by python-docx, which is much faster for the large bundles"))
+    parser.add_argument("--incremental", action='store_true',
+                        help=("Tells --snapshot_get to generate only the .docx whose tasks, dates or template have "
+                              "changed since the bundle in --out was made, the rest are copied from it. Each bundle "
+                              "has the '.bundle_manifest.json' entry for that: the hashes of the .docx inputs "
+                              "and the version of the code"))
+    parser.add_argument("--no_render_cache", action='store_true',
+                        help=("Tells --draft_get and --snapshot_get to render the outputs anew instead of taking "
+                              "the ones rendered from the same data before out of the '.render_cache' folder"))
+    parser.add_argument("--render_cache_size", type=ArgsTypes.arg_size, default=512 * 2**20, metavar='SIZE[K|M|G]B',
+                        help="The size the '.render_cache' folder is kept within. Defaults to 512MB.")
+    parser.add_argument("--storage", choices=('disk', 'sqlite', 'dedup'), default='disk',
+                        help=("Where to keep the drafts and snapshots: a file per each in the '.db' folder, "
+                              "a row per task in the '.snapshots.sqlite' or each distinct task compressed once "
+                              "in the '.db_dedup' folder. Defaults to 'disk'."))
+    parser.add_argument("--gzip", action='store_true',
+                        help=("Tells to gzip the drafts and snapshots being written. "
+                              "Both gzipped and plain ones are read transparently"))
+    parser.add_argument("--jobs", type=ArgsTypes.arg_positive_int, metavar='N',
+                        help="Count of processes to use for the parallel work. Defaults to the count of CPUs.")
+    parser.add_argument("--drop_bodies", action='store_true',
+                        help="Tells --cache_compact to drop the task bodies instead of compressing them")
+    parser.add_argument("--since", type=ArgsTypes.arg_date, default=0.0, metavar='dd.mm.YYYY',
+                        help="Tells --cache_export to export only the essences generated since the date")
+    parser.add_argument("--prefer_model", metavar='MODEL',
+                        help=("Tells --cache_import to prefer the essences generated by the model "
+                              "(like gpt-3.5-turbo) over the more recent ones"))
     parser.add_argument('--names_reference', type=ArgsTypes.arg_names_reference_file,
                         default='name_filter.json', metavar='./A_SPECIAL_FILE.json',
                         help=("Path to the file containing json with name pairs. "
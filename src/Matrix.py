@@ -1,14 +1,28 @@
-from typing import List, OrderedDict, Dict, Tuple
+from typing import BinaryIO, Iterable, Iterator, List, OrderedDict, Dict, Tuple
 from math import fsum
 from xlsxwriter import Workbook
 from docx import Document
-from io import BytesIO
-from zipfile import ZipFile, ZIP_DEFLATED
+from io import BytesIO, TextIOWrapper
+import csv
+import json
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
 from pathlib import Path
 from re import match
-from datetime import datetime
+from struct import pack, unpack
+from xml.sax.saxutils import escape as xml_escape, unescape as xml_unescape
+from zlib import compressobj, crc32, DEFLATED
+import re
+from datetime import datetime, timedelta
+from functools import partial
+from contextlib import nullcontext
+from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor
+from os import cpu_count
+from hashlib import sha256
+from shutil import copyfileobj
 
-from src.Task import Task
+from src.Task import Task, SnapshotInfo, SnapshotManager, SnapshotStorage, iter_tasks
+from src.RenderCache import code_version
 
 
 class NameNormalizer:
@@ -24,47 +38,164 @@ class NameNormalizer:
 
 
 class Matrix:
+    """Assignees × releases of the tasks. It's sparse: a row keeps only the releases it has tasks in,
+    so the memory depends on the count of the tasks rather than on the count of the releases.
+    It's built in one pass over any iterable of tasks and keeps only the Entry of each."""
+
+    class Entry:
+        """What the matrix needs of a task, the bodies and the rest are not kept"""
+        __slots__ = ('title', 'link', 'essence', 'essence_completed')
+
+        def __init__(self, t: Task) -> None:
+            self.title = t.title
+            self.link = t.link
+            self.essence = t.essence
+            self.essence_completed = t.essence_completed
+
+        def __eq__(self, other) -> bool:
+            # the release and the assignees are the cell's ones
+            if not isinstance(other, (Matrix.Entry, Task)):
+                return NotImplemented
+            return self.title == other.title and self.link == other.link
+
+        def __hash__(self) -> int:
+            return hash((self.title, self.link))
+
     class AssigneeInfo:
-        def __init__(self, releases_ever_known: set, is_name_known: bool) -> None:
+        def __init__(self, is_name_known: bool) -> None:
             self.tasks_ttl = 0
-            self.releases = OrderedDict()
-            for r in releases_ever_known:
-                self.releases[r] = []
+            self.releases: Dict[str, List[Matrix.Entry]] = {}
             self.default = []  # here all not release related tasks go
             self.name_known = is_name_known
 
-        def add_task(self, release: str, task: Task):
+        def add_task(self, release: str, task: 'Matrix.Entry'):
             if release:
-                self.releases[release].append(task)
+                if release in self.releases:
+                    self.releases[release].append(task)
+                else:
+                    self.releases[release] = [task]
             else:
                 self.default.append(task)
             self.tasks_ttl += 1
 
-    def __init__(self, tasks: List[Task], names_reference={}):
-        self.releases_ever_known = {t.release for t in tasks if t.release}
-        nn = NameNormalizer(names_reference)
+        def remove_task(self, release: str, task: 'Matrix.Entry | Task'):
+            """raises ValueError if there's no such task"""
+            if release:
+                if release not in self.releases:
+                    raise ValueError(f"No tasks in the release '{release}'")
+                self.releases[release].remove(task)
+                if not self.releases[release]:
+                    del self.releases[release]
+            else:
+                self.default.remove(task)
+            self.tasks_ttl -= 1
+
+    def __init__(self, tasks: Iterable[Task], names_reference={}):
+        self.releases_ever_known = set()
+        self._release_refs: Dict[str, int] = {}  # release -> count of the tasks in it
+        self._by_product = None
+        self._nn = NameNormalizer(names_reference)
         self._rows = OrderedDict()
+        self.dirty: set[str] = set()  # the assignees whose rows are changed by the updates
         for t in tasks:
-            for a, k in OrderedDict([nn.normalize(x) for x in t.assignees]).items():
-                if a not in self._rows:
-                    self._rows[a] = Matrix.AssigneeInfo(
-                        self.releases_ever_known, k)
-                self._rows[a].add_task(t.release, t)
+            self._add(t)
         for x in [y for y in names_reference.values() if y not in self._rows]:
-            self._rows[x] = Matrix.AssigneeInfo(self.releases_ever_known, True)
+            self._rows[x] = Matrix.AssigneeInfo(True)
+
+    def _assignees(self, t: Task) -> OrderedDict[str, bool]:
+        """normalized name -> if it's known"""
+        return OrderedDict([self._nn.normalize(x) for x in t.assignees])
+
+    def _add(self, t: Task) -> bool:
+        """returns if the task is the first one of its release, i.e. added a column"""
+        added = False
+        if t.release:
+            self._release_refs[t.release] = self._release_refs.get(t.release, 0) + 1
+            if self._release_refs[t.release] == 1:
+                self.releases_ever_known.add(t.release)
+                added = True
+        e = Matrix.Entry(t)
+        for a, k in self._assignees(t).items():
+            if a not in self._rows:
+                self._rows[a] = Matrix.AssigneeInfo(k)
+            self._rows[a].add_task(t.release, e)
+        return added
+
+    def _columns_changed(self):
+        # the predefined spend depends on the count of the releases, so all the rows change
+        self._by_product = None
+        self.dirty.update(self._rows)
+
+    def add_task(self, t: Task):
+        if self._add(t):
+            self._columns_changed()
+        self.dirty.update(self._assignees(t))
+
+    def remove_task(self, t: Task):
+        """raises ValueError if there's no such task; the rows left without tasks are removed
+        unless the names reference lists them"""
+        for a in self._assignees(t):
+            if a not in self._rows:
+                raise ValueError(f"No tasks of '{a}'")
+            r = self._rows[a]
+            r.remove_task(t.release, t)
+            if not r.tasks_ttl and a not in self._nn.vals:
+                del self._rows[a]
+            self.dirty.add(a)
+        if t.release:
+            self._release_refs[t.release] -= 1
+            if not self._release_refs[t.release]:
+                del self._release_refs[t.release]
+                self.releases_ever_known.discard(t.release)
+                self._columns_changed()
+
+    def move_task(self, old: Task, new: Task):
+        """the same task got another release or assignees"""
+        self.remove_task(old)
+        self.add_task(new)
+
+    def apply_delta(self, delta: Dict[str, list]):
+        """applies the delta of the serialized tasks, see tasklist_delta and SnapshotManager.draft_diff"""
+        for x in delta['removed']:
+            self.remove_task(Task(**x))
+        for x in delta['moved'] + delta['changed']:
+            self.move_task(Task(**x['old']), Task(**x['new']))
+        for x in delta['added']:
+            self.add_task(Task(**x))
+
+    def take_dirty(self) -> set[str]:
+        """returns the assignees changed since the previous call, some may be removed already"""
+        x, self.dirty = self.dirty, set()
+        return x
 
     def num_tasks_in_release(self, person: str, release: str) -> int:
-        if release == 'DEFAULT':
-            return len(self._rows[person].default)
-        return len(self._rows[person].releases[release])
+        return len(self.get_tasks_in_release(person, release))
+
+    def has_assignee(self, person: str) -> bool:
+        return person in self._rows
 
     def num_tasks_ttl(self, person: str) -> int:
         return self._rows[person].tasks_ttl
 
-    def get_tasks_in_release(self, person: str, release: str) -> list[Task]:
+    def get_tasks_in_release(self, person: str, release: str) -> list[Entry]:
         if release == 'DEFAULT':
             return self._rows[person].default
-        return self._rows[person].releases[release]
+        return self._rows[person].releases.get(release, [])
+
+    def iter_cells(self) -> Iterator[Tuple[str, str, List[Entry]]]:
+        """Yields (person, release, tasks) for the cells having tasks only, row by row"""
+        for person, r in self._rows.items():
+            for release, tasks in r.releases.items():
+                yield (person, release, tasks)
+            if r.default:
+                yield (person, 'DEFAULT', r.default)
+
+    def releases_by_product(self) -> Dict[str, List[str]]:
+        """The product -> releases index, it's built once on the first call"""
+        if self._by_product is None:
+            self._by_product = index_releases_by_product(
+                self.releases_ever_known)
+        return self._by_product
 
     def is_assignee_known(self, person: str) -> bool:
         return self._rows[person].name_known
@@ -74,6 +205,7 @@ class Matrix:
 
 
 class MatrixPrinter:
+    comments = True  # if to compose the cells' comments listing the tasks
     msg_no_tasks = 'Нет задач за отчётный период, исправьте задачи в TFS и перегенерируйте отчёт.'
     msg_person_unknown = 'Имя отсутствует в списках коррекции, сломается автоматизация у бухгалтеров.'
     msg_control_spends = 'Учтено %.0f%% управленческих затрат времени на выпуск'
@@ -94,8 +226,11 @@ class MatrixPrinter:
         return round(x, 7)
 
     @staticmethod
-    def count_releases_of_type(releases_ever_known: set[str], rtype: str) -> int:
-        return len([x for x in releases_ever_known if x.startswith(f"{rtype}_")])
+    def count_releases_of_type(releases_ever_known: set[str] | Dict[str, List[str]], rtype: str) -> int:
+        """accepts either the releases or their index by product"""
+        if not isinstance(releases_ever_known, dict):
+            releases_ever_known = index_releases_by_product(releases_ever_known)
+        return len(releases_ever_known.get(rtype, []))
 
     @staticmethod
     def get_release_comment(percents_predefined_for_release: float, tasks: List[Task]) -> str:
@@ -110,13 +245,12 @@ class MatrixPrinter:
 
     class PredefinedSpend:
         class Metadata:
-            def __init__(self, distribution: Dict[str, float], releases_ever_known: set[str]) -> None:
+            def __init__(self, distribution: Dict[str, float], releases_ever_known: set[str],
+                         by_product: Dict[str, List[str]]) -> None:
                 self._distribution = {}
                 for d, p in distribution.items():
-                    l = len(
-                        [x for x in releases_ever_known if x.startswith(f'{d}_')])
-                    self._distribution.update(
-                        {r: p/l for r in releases_ever_known if r.startswith(f'{d}_')})
+                    rs = by_product.get(d, [])
+                    self._distribution.update({r: p/len(rs) for r in rs})
                 self._distribution.update(
                     {r: 0.0 for r in releases_ever_known if r not in self._distribution})
                 if 'DEFAULT' in distribution:
@@ -124,8 +258,11 @@ class MatrixPrinter:
                 self.ttl_percent = fsum(
                     [v for k, v in self._distribution.items()])
 
-        def __init__(self, predefined_spend: Dict[str, Dict[str, float]], releases_ever_known: set[str]) -> None:
-            self.assignees = {k: MatrixPrinter.PredefinedSpend.Metadata(v, releases_ever_known)
+        def __init__(self, predefined_spend: Dict[str, Dict[str, float]], releases_ever_known: set[str],
+                     by_product: Dict[str, List[str]] | None = None) -> None:
+            if by_product is None:
+                by_product = index_releases_by_product(releases_ever_known)
+            self.assignees = {k: MatrixPrinter.PredefinedSpend.Metadata(v, releases_ever_known, by_product)
                               for k, v in predefined_spend.items()}
 
         def get_percents_predefined_for_release(self, person: str, release: str) -> float:
@@ -138,68 +275,105 @@ class MatrixPrinter:
                 return 0.0
             return self.assignees[person].ttl_percent
 
-    def print(self, m: Matrix, predefined_spend: Dict[str, Dict[str, float]] = {}):
+    class Grid:
+        """The percents, the comments and the tasks of every cell computed at once.
+        The columns are the sorted releases and the DEFAULT as the last one."""
+        class Row:
+            def __init__(self, person: str, name_known: bool, tasks_ttl: int,
+                         percents: List[float], comments: List[str], tasks: List[List[Matrix.Entry]]) -> None:
+                self.person = person
+                self.name_known = name_known
+                self.tasks_ttl = tasks_ttl
+                self.percents = percents
+                self.comments = comments
+                self.tasks = tasks
+
+        def __init__(self, releases: List[str]) -> None:
+            self.releases = releases
+            self.rows: Iterable[MatrixPrinter.Grid.Row] = []
+
+    @staticmethod
+    def compute(m: Matrix, predefined_spend: Dict[str, Dict[str, float]] = {}, lazy: bool = False,
+                comments: bool = True, only: set[str] | None = None) -> Grid:
+        """Computes the whole grid row by row with the same rounding as get_release_percents.
+        lazy: the rows are computed while being iterated, only once then
+        comments: if to compose the cells' comments, they're left empty otherwise
+        only: the assignees to compute the rows of, e.g. Matrix.take_dirty()"""
         ps = MatrixPrinter.PredefinedSpend(
-            predefined_spend, m.releases_ever_known)
-        releases = [x for x in sorted(m.releases_ever_known)]
+            predefined_spend, m.releases_ever_known, m.releases_by_product())
+        g = MatrixPrinter.Grid(sorted(m.releases_ever_known) + ['DEFAULT'])
+        g.rows = MatrixPrinter._iter_rows(m, ps, g.releases, comments, only)
+        if not lazy:
+            g.rows = list(g.rows)
+        return g
+
+    @staticmethod
+    def _iter_rows(m: Matrix, ps: PredefinedSpend, releases: List[str], comments: bool,
+                   only: set[str] | None) -> Iterator[Grid.Row]:
+        nothing = [0.0] * len(releases)
+        no_comments = [''] * len(releases)
+        for person in m.list_assignees():
+            if only is not None and person not in only:
+                continue
+            ttl = m.num_tasks_ttl(person)
+            tasks = [m.get_tasks_in_release(person, r) for r in releases]
+            pre_ttl = ps.get_percents_preallocated_ttl(person)
+            pre = nothing
+            if person in ps.assignees:
+                pre = [ps.get_percents_predefined_for_release(person, r) for r in releases]
+            if ttl:
+                p = [round(x + (len(t) / ttl) * (1 - pre_ttl), 7) for x, t in zip(pre, tasks)]
+            elif pre_ttl > 0.0001:
+                p = [round(x / pre_ttl, 7) for x in pre]
+            else:
+                p = nothing
+            yield MatrixPrinter.Grid.Row(
+                person, m.is_assignee_known(person), ttl,
+                [0 if x < 0.0001 else x for x in p],
+                [MatrixPrinter.get_release_comment(x, t) if t or x >= 0.00001 else ''
+                 for x, t in zip(pre, tasks)] if comments else no_comments,
+                tasks)
+
+    def print(self, m: Matrix, predefined_spend: Dict[str, Dict[str, float]] = {}):
+        self.render(MatrixPrinter.compute(
+            m, predefined_spend, lazy=True, comments=self.comments))
+
+    def render(self, g: Grid):
         col = 0
         # печатаем первую строку, где выпуски
-        for x in [''] + releases + ['DEFAULT']:
+        for x in [''] + g.releases:
             self.brush(col, 0, x)
             col += 1
         row = 0
         # идём по строкам
-        for person in m.list_assignees():
-            col = 0
+        for r in g.rows:
             row += 1
             # сначала пропечатываем имя человека
-            if m.num_tasks_ttl(person) and m.is_assignee_known(person):
-                self.brush(col, row, person)
+            if r.tasks_ttl and r.name_known:
+                self.brush(0, row, r.person)
             else:
-                self.brush_highlight(col, row, person)
+                self.brush_highlight(0, row, r.person)
                 msg = []
-                if m.num_tasks_ttl(person) == 0:
+                if r.tasks_ttl == 0:
                     msg.append(MatrixPrinter.msg_no_tasks)
-                if not m.is_assignee_known(person):
+                if not r.name_known:
                     msg.append(MatrixPrinter.msg_person_unknown)
-                self.brush_comment(col, row, "\n\n".join(msg))
+                self.brush_comment(0, row, "\n\n".join(msg))
             # теперь идём по выпускам и печатаем, сколько там задач в %
-            for release in releases:
-                col += 1
-                p = MatrixPrinter.get_release_percents(
-                    m.num_tasks_in_release(person, release),
-                    m.num_tasks_ttl(person),
-                    ps.get_percents_predefined_for_release(person, release),
-                    ps.get_percents_preallocated_ttl(person))
-                if p < 0.0001:
-                    self.brush_percent(col, row, 0)
-                else:
-                    self.brush_percent(col, row, p)
-                comment = MatrixPrinter.get_release_comment(
-                    ps.get_percents_predefined_for_release(person, release),
-                    m.get_tasks_in_release(person, release))
+            for col, (release, p, comment, tasks) in enumerate(zip(g.releases, r.percents, r.comments, r.tasks), 1):
+                if tasks:
+                    self.brush_tasks(col, row, r.person, release, tasks)
+                self.brush_percent(col, row, p)
                 if comment:
                     self.brush_comment(col, row, comment)
-            # печатаем ячейку, соответствующую задачам не попавшим ни в один выпуск
-            col += 1
-            p = MatrixPrinter.get_release_percents(
-                m.num_tasks_in_release(person, 'DEFAULT'),
-                m.num_tasks_ttl(person),
-                ps.get_percents_predefined_for_release(person, 'DEFAULT'),
-                ps.get_percents_preallocated_ttl(person))
-            if p < 0.0001:
-                self.brush_percent(col, row, 0)
-            else:
-                self.brush_percent(col, row, p)
-            comment = MatrixPrinter.get_release_comment(
-                ps.get_percents_predefined_for_release(person, 'DEFAULT'),
-                m.get_tasks_in_release(person, 'DEFAULT'))
-            if comment:
-                self.brush_comment(col, row, comment)
 
     def brush(self, col, row, x):
         pass
 
+    def brush_tasks(self, col, row, person: str, release: str, tasks: List[Matrix.Entry]):
+        """is called for the non-empty cells before the percents are brushed"""
+        pass
+
     def brush_percent(self, col, row, x):
         self.brush(col, row, x)
 
@@ -211,13 +385,36 @@ class MatrixPrinter:
 
 
 class ExcelPrinter(MatrixPrinter):
-    def __init__(self, output: str | BytesIO, date_from: str, date_to: str) -> None:
+    suffix = '.xlsx'
+    comment_max_len = 32767  # the limit of Excel, xlsxwriter silently drops the longer comments
+    column_max_width = 255
+    url_max_count = 65530  # the limit of xlsxwriter per sheet, it drops the further links
+
+    tasks_sheet_name = 'Задачи'
+
+    def __init__(self, output: str | BinaryIO, date_from: str, date_to: str, streaming: bool = False,
+                 comments: bool | None = None, tasks_sheet: bool | None = None) -> None:
+        """streaming: flush each row as soon as it's written (constant memory), the column widths
+        are counted while writing instead of the autofit over the whole sheet
+        comments: if to list the tasks in the cells' comments, by default unless streaming:
+        xlsxwriter keeps all the comments in memory till the close even then
+        tasks_sheet: if to list all the tasks once on a separate sheet sorted by (assignee, release)
+        and to link each cell to its rows there, or each assignee's name to all their rows if the cells
+        are more than the links a sheet may have; by default only when streaming, instead of the comments"""
         self.output = output
         self.d_from = date_from
         self.d_to = date_to
+        self.streaming = streaming
+        self.comments = not streaming if comments is None else comments
+        self.tasks_sheet = streaming if tasks_sheet is None else tasks_sheet
+        self.widths: Dict[int, int] = {}
+        self._cells: List[Tuple[str, str, List[Matrix.Entry]]] = []
+        self._tasks_rows: Dict[Tuple[str, str], Tuple[int, int]] = {}
+        self._person_rows: Dict[str, Tuple[int, int]] = {}
+        self._link_persons = False
 
     def __enter__(self):
-        self.book = Workbook(self.output)
+        self.book = Workbook(self.output, {'constant_memory': self.streaming})
         self.sheet = self.book.add_worksheet(
             f'с {self.d_from} до {self.d_to} вкл.')
 
@@ -261,37 +458,306 @@ class ExcelPrinter(MatrixPrinter):
         for i, x in enumerate(ls):
             s.write(i, x[0], x[1])
 
+    def _fit(self, col: int, width: int):
+        if self.streaming and width > self.widths.get(col, 0):
+            self.widths[col] = width
+
+    def print(self, m: Matrix, predefined_spend: Dict[str, Dict[str, float]] = {}):
+        if self.tasks_sheet:
+            # заранее раскладываем задачи по строкам листа задач, чтобы ячейки могли на них ссылаться
+            self._cells = sorted(m.iter_cells(), key=lambda x: (x[0], x[1]))
+            first = 2  # первая строка — заголовок, нумерация Excel с 1
+            for a, r, tasks in self._cells:
+                self._tasks_rows[(a, r)] = (first, first + len(tasks) - 1)
+                self._person_rows[a] = (self._person_rows.get(a, (first,))[0], first + len(tasks) - 1)
+                first += len(tasks)
+            # на все ячейки ссылок не хватит: тогда ссылается имя человека, на все его задачи
+            self._link_persons = len(self._cells) > self.url_max_count
+        super().print(m, predefined_spend)
+
+    def _tasks_sheet_write(self):
+        s = self.book.add_worksheet(ExcelPrinter.tasks_sheet_name)
+        for col, x in enumerate(('Исполнитель', 'Выпуск', 'Задача', 'Ссылка')):
+            s.write(0, col, x)
+        row = 1
+        for a, r, tasks in self._cells:
+            for t in tasks:
+                s.write_string(row, 0, a)
+                s.write_string(row, 1, r)
+                s.write_string(row, 2, t.title)
+                s.write_string(row, 3, t.link)
+                row += 1
+        s.set_column(0, 1, 20)
+        s.set_column(2, 2, 80)
+        s.set_column(3, 3, 60)
+        s.freeze_panes(1, 0)
+        s.autofilter(0, 0, max(row - 1, 1), 3)
+
     def __exit__(self, *args):
-        self.sheet.autofit()
+        if self.tasks_sheet:
+            self._tasks_sheet_write()
+        if self.streaming:
+            for col, w in self.widths.items():
+                self.sheet.set_column(col, col, min(w + 1, ExcelPrinter.column_max_width))
+        else:
+            self.sheet.autofit()
         self.sheet.freeze_panes(1, 1)
         self._helpsheet_write()
         self.book.close()
 
+    def _link(self, col, row, first: int, last: int, string: str, tip: str, fmt=None):
+        self.sheet.write_url(row, col, f"internal:'{ExcelPrinter.tasks_sheet_name}'!A{first}:D{last}", fmt,
+                             string=string, tip=tip)
+
+    def _brush_person(self, col, row, x, fmt=None) -> bool:
+        if not (self._link_persons and col == 0 and row > 0 and x in self._person_rows):
+            return False
+        first, last = self._person_rows[x]
+        self._link(col, row, first, last, x, f'{last - first + 1}', fmt)
+        return True
+
     def brush(self, col, row, x):
-        self.sheet.write(row, col, x)
+        self._fit(col, len(str(x)))
+        if not self._brush_person(col, row, x):
+            self.sheet.write(row, col, x)
+
+    def brush_tasks(self, col, row, person: str, release: str, tasks: List[Matrix.Entry]):
+        if (person, release) in self._tasks_rows and not self._link_persons:
+            first, last = self._tasks_rows[(person, release)]
+            # ссылка пишется строкой, процент потом перезаписывает значение ячейки, ссылка остаётся
+            self._link(col, row, first, last, ' ', f'{len(tasks)}')
 
     def brush_percent(self, col, row, x):
+        self._fit(col, 7)  # 100.00%
         self.sheet.write(row, col, x, self.fmt_percent)
 
     def brush_highlight(self, col, row, x):
-        self.sheet.write(row, col, x, self.fmt_highlight)
+        self._fit(col, len(str(x)))
+        if not self._brush_person(col, row, x, self.fmt_highlight):
+            self.sheet.write(row, col, x, self.fmt_highlight)
 
     def brush_comment(self, col, row, x):
+        if len(x) > ExcelPrinter.comment_max_len:
+            x = x[:ExcelPrinter.comment_max_len - 1] + '…'
         self.sheet.write_comment(row, col, x)
 
 
+class TextPrinter(MatrixPrinter):
+    """Base of the machine readable printers: they write the computed grid directly without the brushes"""
+    comments = False
+    suffix = '.txt'
+
+    def __init__(self, output: str | BinaryIO, date_from: str, date_to: str) -> None:
+        self.output = output
+        self.d_from = date_from
+        self.d_to = date_to
+
+    def __enter__(self):
+        if isinstance(self.output, str):
+            self.f = open(self.output, 'w', encoding='utf-8', newline='')
+        else:
+            self.f = TextIOWrapper(self.output, encoding='utf-8', newline='')
+        return self
+
+    def __exit__(self, *args):
+        if isinstance(self.output, str):
+            self.f.close()
+        else:
+            self.f.flush()
+            self.f.detach()  # the caller's stream stays open
+
+    def print(self, m: Matrix, predefined_spend: Dict[str, Dict[str, float]] = {}):
+        self.write(MatrixPrinter.compute(m, predefined_spend, lazy=True, comments=False))
+
+    def write(self, g: MatrixPrinter.Grid):
+        pass
+
+
+class CsvPrinter(TextPrinter):
+    """The same grid as the .xlsx has: a row per assignee, a column per release"""
+    suffix = '.csv'
+
+    def write(self, g: MatrixPrinter.Grid):
+        w = csv.writer(self.f)
+        w.writerow([''] + g.releases)
+        w.writerows([r.person] + r.percents for r in g.rows)
+
+
+class JsonLinesPrinter(TextPrinter):
+    """A line per assignee, the releases without tasks and percents are omitted"""
+    suffix = '.jsonl'
+
+    def write(self, g: MatrixPrinter.Grid):
+        for r in g.rows:
+            self.f.write(json.dumps({'assignee': r.person,
+                                     'name_known': r.name_known,
+                                     'tasks_ttl': r.tasks_ttl,
+                                     'percents': {k: p for k, p in zip(g.releases, r.percents) if p},
+                                     'tasks': {k: [t.link for t in ts] for k, ts in zip(g.releases, r.tasks) if ts}},
+                                    ensure_ascii=False))
+            self.f.write('\n')
+
+
+class ColumnarPrinter(TextPrinter):
+    """The non-zero cells as a table of columns (like the Parquet's layout) in a single JSON object"""
+    suffix = '.columns.json'
+
+    def write(self, g: MatrixPrinter.Grid):
+        o = {'date_from': self.d_from, 'date_to': self.d_to,
+             'assignee': [], 'release': [], 'percent': [], 'tasks': []}
+        for r in g.rows:
+            for k, p, ts in zip(g.releases, r.percents, r.tasks):
+                if p or ts:
+                    o['assignee'].append(r.person)
+                    o['release'].append(k)
+                    o['percent'].append(p)
+                    o['tasks'].append([t.link for t in ts])
+        json.dump(o, self.f, ensure_ascii=False)
+
+
+printers = {'xlsx': ExcelPrinter,
+            'csv': CsvPrinter,
+            'jsonl': JsonLinesPrinter,
+            'columns': ColumnarPrinter}
+
+
+def get_printer(fmt: str, output: str | BinaryIO, date_from: str, date_to: str, **xlsx_options) -> MatrixPrinter:
+    """xlsx_options are passed to the ExcelPrinter only"""
+    if fmt == 'xlsx':
+        return ExcelPrinter(output, date_from, date_to, **xlsx_options)
+    return printers[fmt](output, date_from, date_to)
+
+
+def snapshot_percents(lines: Iterable[str], names_reference: Dict[str, str],
+                      predefined_spend: Dict[str, Dict[str, float]]) -> Dict[str, Dict[str, float]]:
+    """person -> release -> percent (the non-zero ones only) of the snapshot's JSON lines"""
+    g = MatrixPrinter.compute(Matrix(iter_tasks(lines), names_reference),
+                              predefined_spend, lazy=True, comments=False)
+    return {r.person: {k: p for k, p in zip(g.releases, r.percents) if p} for r in g.rows}
+
+
+_worker_storage: SnapshotStorage | None = None  # the storage of the pool's process, see snapshots_percents
+
+
+def _worker_storage_init(s: SnapshotStorage):
+    global _worker_storage
+    _worker_storage = s
+
+
+def _worker_percents(data_id: str, names_reference: Dict[str, str],
+                     predefined_spend: Dict[str, Dict[str, float]]) -> Dict[str, Dict[str, float]]:
+    return snapshot_percents(_worker_storage.read_lines('snapshots', data_id), names_reference, predefined_spend)
+
+
+def snapshots_percents(sm: SnapshotManager, snapshots: List[SnapshotInfo], names_reference: Dict[str, str],
+                       predefined_spend: Dict[str, Dict[str, float]],
+                       workers: int | None = None) -> List[Dict[str, Dict[str, float]]]:
+    """snapshot_percents of each of the snapshots, a matrix per process.
+    The workers read the snapshots themselves, only the percents are passed back"""
+    ids = [sm.id3_encode(x.date_from, x.date_to, x.mtime) for x in snapshots]
+    if (workers or cpu_count() or 1) == 1 or len(ids) < 2:
+        return [snapshot_percents(sm.s.read_lines('snapshots', x), names_reference, predefined_spend) for x in ids]
+    f = partial(_worker_percents, names_reference=names_reference, predefined_spend=predefined_spend)
+    with ProcessPoolExecutor(workers, initializer=_worker_storage_init, initargs=(sm.s,)) as e:
+        return list(e.map(f, ids))
+
+
+class PeriodReport:
+    """The time distribution over several periods (snapshots): a column per calendar month and the total.
+    A month is the mean of the snapshots' days in it, the total is the mean of the snapshots weighted
+    by their days; both among the snapshots the person worked in."""
+    formats = ('xlsx', 'csv')
+    suffix = {'xlsx': '.xlsx', 'csv': '.csv'}
+
+    def __init__(self, periods: List[Tuple[str, str]], percents: List[Dict[str, Dict[str, float]]]) -> None:
+        self.periods = periods
+        self.percents = percents
+        spans = [(datetime.strptime(a, '%d-%m-%Y'), datetime.strptime(b, '%d-%m-%Y')) for a, b in periods]
+        self.weights = [(b - a).days + 1 for a, b in spans]
+        # месяцы от первого до последнего, по каждому — сколько дней каждого снимка в него попало
+        first = min(a for a, _ in spans)
+        last = max(b for _, b in spans)
+        self.months = [(y, m) for y in range(first.year, last.year + 1) for m in range(1, 13)
+                       if (first.year, first.month) <= (y, m) <= (last.year, last.month)]
+        self.month_weights = [[PeriodReport._overlap(a, b, y, m) for a, b in spans] for y, m in self.months]
+
+    @staticmethod
+    def _overlap(a: datetime, b: datetime, year: int, month: int) -> int:
+        """the days of [a, b] in the month"""
+        m_from = datetime(year, month, 1)
+        m_to = datetime(year + month // 12, month % 12 + 1, 1)
+        return max(0, (min(b, m_to - timedelta(days=1)) - max(a, m_from)).days + 1)
+
+    @staticmethod
+    def _mean(weights: List[int], present: List[bool], v: List[float]) -> float:
+        days = sum(w for w, x in zip(weights, present) if x)
+        return round(fsum(w * x for w, x in zip(weights, v)) / days, 7) if days else 0
+
+    def rows(self) -> Iterator[Tuple[str, str, List[float], float]]:
+        """(person, release, percents per month, total) sorted by person, the DEFAULT is the last release"""
+        people = sorted({x for p in self.percents for x in p})
+        for person in people:
+            present = [p.get(person) for p in self.percents]
+            worked = [x is not None for x in present]
+            releases = sorted({r for x in present if x for r in x}, key=lambda r: (r == 'DEFAULT', r))
+            for r in releases:
+                v = [x.get(r, 0) if x else 0 for x in present]
+                yield (person, r, [PeriodReport._mean(w, worked, v) for w in self.month_weights],
+                       PeriodReport._mean(self.weights, worked, v))
+
+    def header(self) -> List[str]:
+        return ['', ''] + [f'{m:02}-{y}' for y, m in self.months] + ['Итого']
+
+    def write(self, fmt: str, output: str | BinaryIO):
+        if fmt == 'csv':
+            with TextPrinter(output, '', '') as p:
+                w = csv.writer(p.f)
+                w.writerow(self.header())
+                w.writerows([a, r] + v + [t] for a, r, v, t in self.rows())
+            return
+        with Workbook(output, {'constant_memory': True}) as book:
+            s = book.add_worksheet(f'с {self.periods[0][0]} до {self.periods[-1][1]} вкл.')
+            fmt_percent = book.add_format({'num_format': '0.00%'})
+            fmt_total = book.add_format({'num_format': '0.00%', 'bold': True})
+            s.write_row(0, 0, self.header())
+            for i, (a, r, v, t) in enumerate(self.rows(), 1):
+                s.write_row(i, 0, [a, r])
+                s.write_row(i, 2, v, fmt_percent)
+                s.write(i, 2 + len(v), t, fmt_total)
+            s.set_column(0, 1, 24)
+            s.set_column(2, 2 + len(self.months), 24)
+            s.freeze_panes(1, 2)
+
+
 class ServiceAssignmentsMatrix(Matrix):
-    def __init__(self, tasks: List[Task], names_reference={}):
+    def __init__(self, tasks: Iterable[Task], names_reference={}):
         super().__init__(tasks, names_reference)
         self._releases: dict[str, dict[str, List[Tuple[str, str]]]] = dict()
-        for r in self.releases_ever_known | {'DEFAULT'}:
-            for a in self.list_assignees():
-                tasks = self.get_tasks_in_release(a, r)
-                if tasks:
-                    if r not in self._releases:
-                        self._releases[r] = dict()
-                    self._releases[r][a] = [
-                        (t.essence, t.essence_completed) for t in tasks]
+        for a, r, tasks in self.iter_cells():
+            if r not in self._releases:
+                self._releases[r] = dict()
+            self._releases[r][a] = [
+                (t.essence, t.essence_completed) for t in tasks]
+
+    def _sync(self, t: Task):
+        r = t.release or 'DEFAULT'
+        for a in self._assignees(t):
+            tasks = self.get_tasks_in_release(a, r) if self.has_assignee(a) else []
+            if tasks:
+                self._releases.setdefault(r, dict())[a] = [
+                    (x.essence, x.essence_completed) for x in tasks]
+            elif a in self._releases.get(r, {}):
+                del self._releases[r][a]
+                if not self._releases[r]:
+                    del self._releases[r]
+
+    def add_task(self, t: Task):
+        super().add_task(t)
+        self._sync(t)
+
+    def remove_task(self, t: Task):
+        super().remove_task(t)
+        self._sync(t)
 
     def list_releases(self) -> List[str]:
         return [k for k in self._releases]
@@ -314,6 +780,20 @@ def get_product_from_release(release: str) -> str:
         f"Unable to extract product from relese '{release}'")
 
 
+def index_releases_by_product(releases: set[str]) -> Dict[str, List[str]]:
+    """product -> sorted releases of it; only the releases looking like '<product>_...' are indexed,
+    the same ones the predefined spend used to find with startswith"""
+    o: Dict[str, List[str]] = {}
+    for r in sorted(releases):
+        try:
+            p = get_product_from_release(r)
+        except RuntimeError:
+            continue
+        if r.startswith(f'{p}_'):
+            o.setdefault(p, []).append(r)
+    return o
+
+
 def docx_move_table_after(table, paragraph):
     tbl, p = table._tbl, paragraph._p
     p.addnext(tbl)
@@ -338,9 +818,129 @@ def docx_form_table(docx, assignee: str, date_from: str, date_to: str, tasks: Li
     return table
 
 
+def docx_fill(docx, assignee: str, date_from: str, date_to: str, tasks: List[str]):
+    table = docx_form_table(docx, assignee, date_from, date_to, tasks)
+    for p in docx.paragraphs:
+        if p.text.find('%INSERT_THE_TABLE_HERE%') != -1:
+            docx_move_table_after(table, p)
+            docx_delete_paragraph(p)
+            break
+
+    replace_map = {'%ASSIGNEE%': assignee,
+                   '%DATE_FROM%': date_from}
+    for p in docx.paragraphs:
+        for k, v in replace_map.items():
+            if p.text.find(k) != -1:
+                p.text = p.text.replace(k, v)
+
+
+class CompiledDocx:
+    """The template filled by python-docx once with the placeholders instead of the values and saved.
+    Rendering puts the values into the saved document.xml the same way python-docx puts the text into a run,
+    and the rest of the parts are copied compressed as they are."""
+    placeholder = re.compile(r'<w:t(?: xml:space="preserve")?>([^<]*⟦[^<]*)</w:t>')
+    token = re.compile(r'⟦(assignee|date_from|date_to|tasks)⟧')
+    not_xml = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+    run_splitter = re.compile(r'(\t|\r|\n)')
+
+    def __init__(self, docx) -> None:
+        docx = deepcopy(docx)
+        docx_fill(docx, '⟦assignee⟧', '⟦date_from⟧', '⟦date_to⟧', ['⟦tasks⟧'])
+        o = BytesIO()
+        docx.save(o)
+        self.entries: List[Tuple[ZipInfo, bytes]] = []  # the parts as stored in the zip
+        self.document: ZipInfo | None = None
+        with ZipFile(o) as z:
+            for x in z.infolist():
+                if x.filename == 'word/document.xml':
+                    self.document = x
+                    xml = z.read(x).decode('utf-8')
+                    self.entries.append((x, b''))
+                else:
+                    o.seek(x.header_offset + 26)
+                    n, m = unpack('<HH', o.read(4))
+                    o.seek(x.header_offset + 30 + n + m)
+                    self.entries.append((x, o.read(x.compress_size)))
+        # document.xml is split into the static pieces and the texts of the runs to be filled
+        self.pieces: List[str] = CompiledDocx.placeholder.split(xml)
+
+    @staticmethod
+    def _run(text: str) -> str:
+        """the content of a w:r element exactly as the python-docx's Run.text makes it"""
+        if CompiledDocx.not_xml.search(text):
+            raise ValueError('All strings must be XML compatible: Unicode or ASCII, no NULL bytes or control characters')
+        o = []
+        for x in CompiledDocx.run_splitter.split(text):
+            if x == '\t':
+                o.append('<w:tab/>')
+            elif x in ('\r', '\n'):
+                o.append('<w:br/>')
+            elif x:
+                if len(x.strip()) < len(x):
+                    o.append(f'<w:t xml:space="preserve">{xml_escape(x)}</w:t>')
+                else:
+                    o.append(f'<w:t>{xml_escape(x)}</w:t>')
+        return ''.join(o)
+
+    def render(self, assignee: str, date_from: str, date_to: str, tasks: List[str]) -> bytes:
+        values = {'assignee': assignee, 'date_from': date_from, 'date_to': date_to,
+                  'tasks': ';\n\n'.join(tasks)}
+        xml = ''.join(x if i % 2 == 0 else
+                      CompiledDocx._run(CompiledDocx.token.sub(lambda m: values[m.group(1)], xml_unescape(x)))
+                      for i, x in enumerate(self.pieces)).encode('utf-8')
+        c = compressobj(-1, DEFLATED, -15)
+        document = c.compress(xml) + c.flush()
+        return write_raw_zip([(x, document, crc32(xml), len(xml)) if x is self.document else
+                              (x, b, x.CRC, x.file_size) for x, b in self.entries])
+
+
+def write_raw_zip(entries: List[Tuple[ZipInfo, bytes, int, int]]) -> bytes:
+    """Assembles a zip of the already compressed (ZipInfo, data, crc, uncompressed size)"""
+    o, central = [], []
+    offset = 0
+    for x, data, crc, size in entries:
+        name = x.filename.encode('utf-8')
+        flags = 0x800 if not name.isascii() else 0
+        dt = x.date_time
+        t = (dt[3] << 11) | (dt[4] << 5) | (dt[5] // 2)
+        d = ((dt[0] - 1980) << 9) | (dt[1] << 5) | dt[2]
+        o.append(pack('<IHHHHHIIIHH', 0x04034b50, 20, flags, x.compress_type, t, d,
+                      crc, len(data), size, len(name), 0) + name)
+        o.append(data)
+        central.append(pack('<IHHHHHHIIIHHHHHII', 0x02014b50, 20, 20, flags, x.compress_type, t, d,
+                            crc, len(data), size, len(name), 0, 0, 0, 0, x.external_attr, offset) + name)
+        offset += 30 + len(name) + len(data)
+    cd = b''.join(central)
+    return b''.join(o) + cd + pack('<IHHHHIIH', 0x06054b50, 0, 0, len(central), len(central), len(cd), offset, 0)
+
+
 class DocsGenerator:
-    def __init__(self, dir_templates: str) -> None:
+    def __init__(self, dir_templates: str, precompiled: bool = False) -> None:
+        """precompiled: get_docx_bytes fills the precompiled templates instead of the python-docx's objects"""
         self.dir_templates = Path(dir_templates)
+        self.precompiled = precompiled
+        # template -> (mtime, parsed document, if valid); the documents are cloned of the parsed ones
+        self._templates: Dict[Path, Tuple[int, object, bool]] = {}
+        self._compiled: Dict[Path, Tuple[int, CompiledDocx]] = {}
+
+    def __getstate__(self):
+        # the parsed documents aren't picklable, the cache is filled anew in another process
+        return {'dir_templates': self.dir_templates, 'precompiled': self.precompiled}
+
+    def __setstate__(self, state):
+        self.__init__(state['dir_templates'], state['precompiled'])
+
+    def _load_template(self, template: Path) -> Tuple[object, bool]:
+        """the parsed and validated template, it's parsed again only if the file is modified"""
+        mtime = template.stat().st_mtime_ns
+        x = self._templates.get(template)
+        if x is None or x[0] != mtime:
+            docx = Document(template)
+            # проверяем копию: после обхода параграфов документ кэширует body,
+            # и deepcopy такого документа сохраняет исходный, незаполненный текст
+            x = (mtime, docx, DocsGenerator._is_valid(deepcopy(docx)))
+            self._templates[template] = x
+        return x[1], x[2]
 
     def locate_template(self, doctype: str, release: str) -> Path:
         if doctype not in ('todo', 'done'):
@@ -353,7 +953,10 @@ class DocsGenerator:
         raise RuntimeError(f"Template {o.absolute()} is not found")
 
     def is_template_valid(self, template: Path) -> bool:
-        docx = Document(template)
+        return self._load_template(template)[1]
+
+    @staticmethod
+    def _is_valid(docx) -> bool:
         must = {'%INSERT_THE_TABLE_HERE%': False, '%ASSIGNEE%': False}
         for p in docx.paragraphs:
             for k in must:
@@ -369,41 +972,146 @@ class DocsGenerator:
                  tasks: List[str]):
 
         template = self.locate_template(doctype, release)
-        if not self.is_template_valid(template):
+        docx, valid = self._load_template(template)
+        if not valid:
             raise RuntimeError(f'Invalid template: {template}')
-        docx = Document(template)
-
-        table = docx_form_table(docx, assignee, date_from, date_to, tasks)
-        for p in docx.paragraphs:
-            if p.text.find('%INSERT_THE_TABLE_HERE%') != -1:
-                docx_move_table_after(table, p)
-                docx_delete_paragraph(p)
-                break
-
-        replace_map = {'%ASSIGNEE%': assignee,
-                       '%DATE_FROM%': date_from}
-        for p in docx.paragraphs:
-            for k, v in replace_map.items():
-                if p.text.find(k) != -1:
-                    p.text = p.text.replace(k, v)
+        docx = deepcopy(docx)
+        docx_fill(docx, assignee, date_from, date_to, tasks)
         return docx
 
+    def _compile_template(self, template: Path) -> 'CompiledDocx':
+        mtime = template.stat().st_mtime_ns
+        x = self._compiled.get(template)
+        if x is None or x[0] != mtime:
+            docx, valid = self._load_template(template)
+            if not valid:
+                raise RuntimeError(f'Invalid template: {template}')
+            x = (mtime, CompiledDocx(docx))
+            self._compiled[template] = x
+        return x[1]
 
-def get_bundle_zip(sam: ServiceAssignmentsMatrix, date_from: str, date_to: str, predef_spend, dg: DocsGenerator) -> bytes:
-    z = BytesIO()
-    with ZipFile(z, 'a', ZIP_DEFLATED, False) as zf:
+    def input_hash(self, doctype: str, release: str, assignee: str,
+                   date_from: str, date_to: str, tasks: List[str]) -> str:
+        """The hash of everything the docx is made of, the template is identified by its mtime and size"""
+        t = self.locate_template(doctype, release).stat()
+        s = json.dumps([doctype, release, assignee, date_from, date_to, tasks, t.st_mtime_ns, t.st_size],
+                       ensure_ascii=False)
+        return sha256(s.encode('utf-8')).hexdigest()
+
+    def get_docx_bytes(self, doctype: str, release: str, assignee: str,
+                       date_from: str, date_to: str, tasks: List[str]) -> bytes:
+        """The saved .docx, made of the precompiled template if the generator is the precompiled one"""
+        if self.precompiled:
+            c = self._compile_template(self.locate_template(doctype, release))
+            return c.render(assignee, date_from, date_to, tasks)
         o = BytesIO()
-        with ExcelPrinter(o, date_from, date_to) as p:
+        self.get_docx(doctype, release, assignee, date_from, date_to, tasks).save(o)
+        return o.getvalue()
+
+
+_worker_dg: DocsGenerator | None = None  # the generator of the pool's process, keeps its own templates cache
+
+
+def _worker_init(dg: DocsGenerator):
+    global _worker_dg
+    _worker_dg = dg
+
+
+def _worker_docx(job: Tuple[str, str, str, str, str, List[str]]) -> bytes:
+    return _worker_dg.get_docx_bytes(*job)
+
+
+def bundle_jobs(sam: ServiceAssignmentsMatrix, date_from: str, date_to: str) -> Tuple[List[str], List[tuple]]:
+    """The entry names and the get_docx arguments of each release, assignee and doctype in the bundle's order"""
+    names, jobs = [], []
+    for r in sam.list_releases():
+        for a in sam.list_assignees_by_release(r):
+            names.append(f'{r}/todo/{a}.docx')
+            jobs.append(('todo', r, a, date_from, date_to, sam.list_essences(r, a)))
+            names.append(f'{r}/done/{a}.docx')
+            jobs.append(('done', r, a, date_from, date_to, sam.list_completed_essences(r, a)))
+    return names, jobs
+
+
+def iter_docx(jobs: List[tuple], dg: DocsGenerator, workers: int | None = 1) -> Iterator[bytes]:
+    """Yields the docx of each of the get_docx arguments in their order.
+    The documents are generated by a pool of processes unless workers is 1, None means a process per CPU."""
+    if (workers or cpu_count() or 1) == 1 or len(jobs) < 2:
+        yield from (dg.get_docx_bytes(*x) for x in jobs)
+        return
+    with ProcessPoolExecutor(workers, initializer=_worker_init, initargs=(dg,)) as e:
+        # map keeps the order, the finished documents are passed on as soon as their turn comes
+        yield from e.map(_worker_docx, jobs, chunksize=4)
+
+
+def _zip_entry(name: str, compress_type: int) -> ZipInfo:
+    x = ZipInfo(name, datetime.now().timetuple()[:6])
+    x.compress_type = compress_type
+    return x
+
+
+# the entry of the bundle the users get too, hidden by the dot; no secrets, only the versions and hashes
+bundle_manifest = '.bundle_manifest.json'
+
+
+def read_bundle_manifest(zf: ZipFile) -> Dict[str, str]:
+    """entry name -> the input hash of the docx in the bundle, empty if the bundle was made by another code"""
+    try:
+        m = json.loads(zf.read(bundle_manifest))
+    except (KeyError, ValueError):
+        return {}
+    if m.get('version') != code_version():
+        return {}
+    return m['entries']
+
+
+def write_bundle_zip(output: str | BinaryIO, sam: ServiceAssignmentsMatrix, date_from: str, date_to: str,
+                     predef_spend, dg: DocsGenerator, fmt: str = 'xlsx', workers: int | None = 1,
+                     previous: str | BinaryIO | None = None, **xlsx_options):
+    """Writes the bundle into the file or the stream (which may be unseekable, like stdout) entry by entry.
+    The documents are saved right into their entries; the .xlsx and .docx are zips already, so they're stored
+    as is rather than deflated again. The manifest entry (bundle_manifest, the last one) keeps the code version
+    and the input hash of each docx: the ones of the previous bundle with the same hash are copied from it
+    instead of being generated anew. It stays in the bundle handed to the users, so any copy of the bundle
+    serves as the previous one.
+    See get_bundle_zip for the rest of the arguments."""
+    names, jobs = bundle_jobs(sam, date_from, date_to)
+    hashes = [dg.input_hash(*x) for x in jobs]
+    with ZipFile(output, 'w', ZIP_DEFLATED, False) as zf, \
+         (ZipFile(previous) if previous is not None else nullcontext()) as zp:
+        old = read_bundle_manifest(zp) if zp is not None else {}
+        x = _zip_entry(f'{date_from}-{date_to}{printers[fmt].suffix}',
+                       ZIP_STORED if fmt == 'xlsx' else ZIP_DEFLATED)
+        with zf.open(x, 'w') as o, get_printer(fmt, o, date_from, date_to, **xlsx_options) as p:
             p.print(sam, predef_spend)
-        zf.writestr(f'{date_from}-{date_to}.xlsx', o.getvalue())
-        for r in sam.list_releases():
-            for a in sam.list_assignees_by_release(r):
-                o = BytesIO()
-                dg.get_docx('todo', r, a, date_from, date_to,
-                            sam.list_essences(r, a)).save(o)
-                zf.writestr(f'{r}/todo/{a}.docx', o.getvalue())
-                o = BytesIO()
-                dg.get_docx('done', r, a, date_from, date_to,
-                            sam.list_completed_essences(r, a)).save(o)
-                zf.writestr(f'{r}/done/{a}.docx', o.getvalue())
+        fresh = [i for i, (n, h) in enumerate(zip(names, hashes)) if old.get(n) != h]
+        if (workers or cpu_count() or 1) == 1:
+            docx = None
+        else:
+            docx = iter_docx([jobs[i] for i in fresh], dg, workers)
+        fresh = set(fresh)
+        for i, (name, job) in enumerate(zip(names, jobs)):
+            with zf.open(_zip_entry(name, ZIP_STORED), 'w') as o:
+                if i not in fresh:
+                    # the docx is stored, so it's copied as it is
+                    with zp.open(name) as x:
+                        copyfileobj(x, o)
+                elif docx is not None:
+                    o.write(next(docx))
+                elif dg.precompiled:
+                    o.write(dg.get_docx_bytes(*job))
+                else:
+                    dg.get_docx(*job).save(o)
+        m = {'version': code_version(), 'entries': dict(zip(names, hashes))}
+        zf.writestr(_zip_entry(bundle_manifest, ZIP_DEFLATED), json.dumps(m, ensure_ascii=False))
+
+
+def get_bundle_zip(sam: ServiceAssignmentsMatrix, date_from: str, date_to: str, predef_spend, dg: DocsGenerator,
+                   fmt: str = 'xlsx', workers: int | None = 1, previous: str | BinaryIO | None = None,
+                   **xlsx_options) -> bytes:
+    """fmt is the format of the matrix, one of the printers; workers is the count of processes generating
+    the docx, see iter_docx; previous is the bundle made before, the docx with the same inputs are
+    taken from it; xlsx_options are passed to the ExcelPrinter"""
+    z = BytesIO()
+    write_bundle_zip(z, sam, date_from, date_to, predef_spend, dg, fmt, workers, previous, **xlsx_options)
     return z.getvalue()
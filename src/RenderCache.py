@@ -0,0 +1,121 @@
+from hashlib import sha256
+from pathlib import Path
+from os import close, replace, utime
+from shutil import copyfile
+from tempfile import mkstemp
+import json
+
+
+def code_version() -> str:
+    """The hash of the sources, so that any change of the code invalidates the rendered outputs.
+    The entry point is hashed too, as it prepares the inputs"""
+    h = sha256()
+    src = Path(__file__).parent
+    for p in sorted(src.glob('*.py')) + [src.parent / 'tfs_excel.py']:
+        if not p.name.startswith('test_') and p.is_file():
+            h.update(p.name.encode('utf-8'))
+            h.update(p.read_bytes())
+    return h.hexdigest()
+
+
+def dir_stamp(path: str) -> list[tuple[str, int, int]]:
+    """(relative path, mtime, size) of all the files in the folder, e.g. to catch the edited templates"""
+    d = Path(path)
+    if not d.is_dir():
+        return []
+    return [(x.relative_to(d).as_posix(), x.stat().st_mtime_ns, x.stat().st_size)
+            for x in sorted(d.rglob('*')) if x.is_file()]
+
+
+class RenderCache:
+    """The rendered outputs (.xlsx, .zip, ...) by the hash of everything they're made of.
+    The least recently used ones are evicted to keep the folder within max_bytes."""
+
+    def __init__(self, path: str, max_bytes: int = 512 * 2**20, version: str | None = None) -> None:
+        self.dir = Path(path)
+        self.max_bytes = max_bytes
+        self.version = code_version() if version is None else version
+
+    def key(self, *inputs) -> str:
+        """inputs must be json serializable, the dicts are compared regardless of the keys order"""
+        s = json.dumps([self.version, inputs], sort_keys=True, ensure_ascii=False, default=str)
+        return sha256(s.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.dir / key[:2] / key[2:]
+
+    def get(self, key: str) -> bytes | None:
+        p = self._path(key)
+        try:
+            data = p.read_bytes()
+        except FileNotFoundError:
+            return None
+        utime(p)  # the mtime is the time of the last use
+        return data
+
+    def get_file(self, key: str, path: str) -> bool:
+        """copies the output into the file without reading it into memory, returns False if it's missing"""
+        p = self._path(key)
+        try:
+            copyfile(p, path)
+        except FileNotFoundError:
+            return False
+        utime(p)
+        return True
+
+    def put(self, key: str, data: bytes) -> None:
+        p = self._path(key)
+        p.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = mkstemp(dir=p.parent)
+        with open(fd, 'wb') as f:
+            f.write(data)
+        replace(tmp, p)
+        self.evict(self.max_bytes)
+
+    def put_file(self, key: str, path: str) -> None:
+        """stores a copy of the file, see get_file"""
+        p = self._path(key)
+        p.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = mkstemp(dir=p.parent)
+        close(fd)
+        copyfile(path, tmp)
+        replace(tmp, p)
+        self.evict(self.max_bytes)
+
+    def size(self) -> int:
+        return sum(x.stat().st_size for x in self.dir.glob('*/*'))
+
+    def evict(self, max_bytes: int) -> int:
+        """Deletes the least recently used outputs until they fit max_bytes, returns the count deleted"""
+        if not self.dir.is_dir():
+            return 0
+        files = sorted(((x.stat().st_mtime_ns, x.stat().st_size, x) for x in self.dir.glob('*/*')),
+                       key=lambda x: x[0])
+        ttl = sum(x[1] for x in files)
+        n = 0
+        for _, size, p in files:
+            if ttl <= max_bytes:
+                break
+            p.unlink(missing_ok=True)
+            ttl -= size
+            n += 1
+        return n
+
+
+class NoRenderCache(RenderCache):
+    """Misses always, for --no_render_cache"""
+
+    def __init__(self) -> None:
+        self.version = ''
+
+    def get(self, key: str) -> bytes | None:
+        return None
+
+    def get_file(self, key: str, path: str) -> bool:
+        return False
+
+    def put(self, key: str, data: bytes) -> None:
+        pass
+
+    def put_file(self, key: str, path: str) -> None:
+        pass
@@ -1,48 +1,203 @@
 from datetime import datetime as dt
+import gzip
 import json
 import pathlib
-from typing import List
+from sqlite3 import connect
+from hashlib import sha1, sha256
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+from os import cpu_count
+from sys import intern
+from typing import Callable, Iterable, Iterator, List
+
+
+def _intern(x: str | None) -> str | None:
+    return intern(x) if isinstance(x, str) else x
 
 
 class Task:
+    # the categorical fields repeat across the tasks, so they are interned
+    __slots__ = ('assignees', 'title', 'release', 'link', 'tid', 'parent_title',
+                 'project', 'essence', 'essence_completed', '_body', 'body_ref', 'body_loader')
+    _serialized = ('assignees', 'title', 'release', 'link', 'tid', 'parent_title',
+                   'project', 'essence', 'essence_completed')
+
     def __init__(self, title: str, assignees: List[str], release: str, link: str, **kwargs) -> None:
-        self.assignees = [x for x in sorted(
+        self.assignees = [_intern(x) for x in sorted(
             set(kwargs['assignees'] if 'assignees' in kwargs else assignees))]
         self.title = kwargs['title'] if 'title' in kwargs else title
-        self.release = kwargs['release'] if 'release' in kwargs else release
+        self.release = _intern(kwargs['release'] if 'release' in kwargs else release)
         self.link = kwargs['link'] if 'link' in kwargs else link
         self.tid = kwargs['tid'] if 'tid' in kwargs else None
         self.parent_title = kwargs['parent_title'] if 'parent_title' in kwargs else None
-        self.project = kwargs['project'] if 'project' in kwargs else None
+        self.project = _intern(kwargs['project'] if 'project' in kwargs else None)
         self.essence = ''
         self.essence_completed = ''
-        self.body = kwargs['body'] if 'body' in kwargs else None
+        self._body = kwargs['body'] if 'body' in kwargs else None
+        # the body could be kept out of line, then it is loaded by the ref on the first access
+        self.body_ref: str | None = kwargs['body_ref'] if 'body_ref' in kwargs else None
+        self.body_loader: Callable[[str], str] | None = None
+
+    @property
+    def body(self) -> str | None:
+        if self._body is None and self.body_ref is not None and self.body_loader is not None:
+            self._body = self.body_loader(self.body_ref)
+        return self._body
+
+    @body.setter
+    def body(self, x: str | None) -> None:
+        self._body = x
+
+    def _key(self) -> tuple:
+        return (self.title, self.release, self.link, tuple(self.assignees))
 
     def __eq__(self, other) -> bool:
-        if len(self.assignees) != len(other.assignees):
-            return False
-        for x in zip(self.assignees, other.assignees):
-            if x[0] != x[1]:
-                return False
-        for k in ('title', 'release', 'link'):
-            if k not in other.__dict__ or self.__dict__[k] != other.__dict__[k]:
-                return False
-        return True
+        if not isinstance(other, Task):
+            return NotImplemented
+        return self._key() == other._key()
+
+    def __hash__(self) -> int:
+        return hash(self._key())
+
+    def __deepcopy__(self, memo) -> 'Task':
+        # the strings are immutable and the body loader is meant to be shared
+        o = Task.__new__(Task)
+        for k in self.__slots__:
+            setattr(o, k, getattr(self, k))
+        o.assignees = list(self.assignees)
+        return o
+
+    def __getstate__(self) -> dict:
+        return {k: getattr(self, k) for k in self.__slots__ if k != 'body_loader'}
+
+    def __setstate__(self, state: dict) -> None:
+        for k, v in state.items():
+            setattr(self, k, v)
+        self.body_loader = None
+
+    def to_row(self) -> tuple:
+        """The compact form to pass the task between the processes, see from_row"""
+        return (tuple(self.assignees), self.title, self.release, self.link, self.tid, self.parent_title,
+                self.project, self._body, self.body_ref)
+
+    @staticmethod
+    def from_row(row: tuple) -> 'Task':
+        # the row is made of a task, so the assignees are sorted and unique already
+        o = Task.__new__(Task)
+        a, o.title, r, o.link, o.tid, o.parent_title, p, o._body, o.body_ref = row
+        o.assignees = [_intern(x) for x in a]
+        o.release, o.project = _intern(r), _intern(p)
+        o.essence = o.essence_completed = ''
+        o.body_loader = None
+        return o
+
+    def to_dict(self) -> dict:
+        d = {k: getattr(self, k) for k in self._serialized}
+        if self.body_ref is None:
+            d['body'] = self._body
+        else:
+            d['body'] = None
+            d['body_ref'] = self.body_ref
+        return d
 
 
 def tasklist_to_json(tasklist: List[Task]) -> str:
-    return json.dumps([x.__dict__ for x in tasklist], sort_keys=True, indent=4)
+    return json.dumps([x.to_dict() for x in tasklist], sort_keys=True, indent=4)
 
 
 def json_to_tasklist(tasklist_json: str) -> List[Task]:
-    return [Task(**a) for a in json.loads(tasklist_json)]
+    return list(iter_tasks(jsonl_lines(tasklist_json)))
+
+
+def tasklist_to_jsonl(tasklist: Iterable[Task]) -> str:
+    """The compact snapshot format: a task per line, so it could be decoded as a stream"""
+    return ''.join(json.dumps(x.to_dict(), ensure_ascii=False, separators=(',', ':'), sort_keys=True) + '\n'
+                   for x in tasklist)
+
+
+def jsonl_lines(data: str) -> List[str]:
+    """The lines of JSON Lines. Unlike str.splitlines, splits on \\n only: U+2028, U+2029 and U+0085
+    are written unescaped by ensure_ascii=False and may be inside a record"""
+    return data.split('\n')
+
+
+def iter_task_dicts(lines: Iterable[str]) -> Iterator[dict]:
+    """Decodes the tasks one by one from either JSON Lines or the legacy JSON array"""
+    it = iter(lines)
+    for first in it:
+        if first.strip():
+            break
+    else:
+        return
+    if first.lstrip().startswith('['):  # legacy, has to be parsed as a whole
+        yield from json.loads(first + ''.join(it))
+        return
+    yield json.loads(first)
+    for x in it:
+        if x.strip():
+            yield json.loads(x)
+
+
+def iter_tasks(lines: Iterable[str]) -> Iterator[Task]:
+    return (Task(**a) for a in iter_task_dicts(lines))
+
+
+def dedup_tasks(tasks: Iterable[Task]) -> list[Task]:
+    """Keeps only the first occurrence of every (project, tid), the tasks without the tid are kept as is"""
+    seen, out = set(), []
+    for t in tasks:
+        if t.tid is not None:
+            k = (t.project, t.tid)
+            if k in seen:
+                continue
+            seen.add(k)
+        out.append(t)
+    return out
+
+
+def task_key(d: dict) -> tuple:
+    """Identifies the serialized task across the draft updates"""
+    if d.get('tid') is not None:
+        return (d.get('project'), d['tid'])
+    return (d.get('project'), d['link'], d['title'])
+
+
+def tasklist_delta(old: Iterable[dict], new: Iterable[dict]) -> dict[str, list]:
+    """Compares the serialized tasklists in linear time by indexing them on task_key.
+    Moved are the tasks whose release or assignees changed, changed are the ones otherwise different."""
+    o = {task_key(x): x for x in old}
+    added, moved, changed, seen = [], [], [], set()
+    for x in new:
+        k = task_key(x)
+        seen.add(k)
+        y = o.get(k)
+        if y is None:
+            added.append(x)
+        elif y['release'] != x['release'] or sorted(y['assignees']) != sorted(x['assignees']):
+            moved.append({'old': y, 'new': x})
+        elif y != x:
+            changed.append({'old': y, 'new': x})
+    removed = [y for k, y in o.items() if k not in seen]
+    return {'added': added, 'removed': removed, 'moved': moved, 'changed': changed}
+
+
+def is_legacy_json(lines: Iterable[str]) -> bool:
+    for x in lines:
+        if x.strip():
+            return x.lstrip().startswith('[')
+    return False
 
 
 class SnapshotInfo:
-    def __init__(self, date_from, date_to, mtime: float):
+    def __init__(self, date_from, date_to, mtime: float,
+                 count: int | None = None, size: int | None = None, checksum: str | None = None):
         self.date_from = date_from
         self.date_to = date_to
         self.mtime = mtime
+        self.count = count
+        self.size = size
+        self.checksum = checksum
 
 class TaskProvider:
     def get_tasks(self, pat, date_from, date_to) -> list[Task]:
@@ -62,42 +217,392 @@ class SnapshotStorage:
         """
         raise NotImplementedError
 
+    def exists(self, storage_id: str, data_id: str) -> bool:
+        """Same as data_id in list(storage_id), the storages are free to do it without listing"""
+        return data_id in self.list(storage_id)
+
     def read(self, storage_id: str, data_id: str) -> str:
         """Reads the data identified by the data_id from the storage identified by the storage_id"""
         raise NotImplementedError
 
+    def read_lines(self, storage_id: str, data_id: str) -> Iterator[str]:
+        """Same as read, but lets to consume the data line by line without loading it as a whole"""
+        return iter(jsonl_lines(self.read(storage_id, data_id)))
+
     def delete(self, storage_id: str, data_id: str) -> None:
         raise NotImplementedError
 
+    def move(self, storage_id: str, data_id: str, new_storage_id: str, new_data_id: str) -> None:
+        """Moves the data under the other id, the storages are free to do it without copying"""
+        self.write(new_storage_id, new_data_id, self.read(storage_id, data_id))
+        self.delete(storage_id, data_id)
+
+    def query(self, storage_id: str, data_id: str, release: str | None = None,
+              assignees: Iterable[str] | None = None, project: str | None = None) -> Iterator[str]:
+        """Same as read_lines for a tasklist, but yields only the tasks matching all the given criteria:
+        the release, any of the assignees, the project"""
+        a = set(assignees) if assignees is not None else None
+        for x in iter_task_dicts(self.read_lines(storage_id, data_id)):
+            if release is not None and x['release'] != release:
+                continue
+            if a is not None and a.isdisjoint(x['assignees']):
+                continue
+            if project is not None and x.get('project') != project:
+                continue
+            yield json.dumps(x, ensure_ascii=False, separators=(',', ':'))
+
 
 class DiskSnapshotStorage(SnapshotStorage):
-    def __init__(self, path_to_the_storage: str) -> None:
+    def __init__(self, path_to_the_storage: str, compress: bool = False) -> None:
         self.path = pathlib.Path(path_to_the_storage)
+        self.compress = compress
         if not self.path.exists():
             self.path.mkdir()
 
+    @staticmethod
+    def _open(path: pathlib.Path):
+        """Opens either plain or gzipped file for reading as text, the line endings are kept as written"""
+        with open(path, mode='rb') as f:
+            gzipped = f.read(2) == b'\x1f\x8b'
+        if gzipped:
+            return gzip.open(path, mode='rt', encoding='utf-8', newline='')
+        return open(path, mode='r', encoding='utf-8', newline='')
+
     def write(self, storage_id: str, data_id: str, data: str) -> None:
         s_id = self.path / storage_id
         if not s_id.exists():
             s_id.mkdir()
-        with open(s_id / data_id, mode='w') as f:
+        # newline='': the data is stored exactly, the bodies are named by the hash of it
+        if self.compress:
+            with gzip.open(s_id / data_id, mode='wt', encoding='utf-8', newline='') as f:
+                f.write(data)
+            return
+        with open(s_id / data_id, mode='w', encoding='utf-8', newline='') as f:
             f.write(data)
 
     def list(self, storage_id: str) -> dict[str, float]:
-        return {x.name: x.stat().st_mtime for x in (self.path / storage_id).iterdir()}
+        s_id = self.path / storage_id
+        if not s_id.exists():
+            return {}
+        return {x.name: x.stat().st_mtime for x in s_id.iterdir()}
+
+    def exists(self, storage_id: str, data_id: str) -> bool:
+        return (self.path / storage_id / data_id).is_file()
 
     def read(self, storage_id: str, data_id: str) -> str:
-        with open(self.path / storage_id / data_id, mode='r') as f:
+        with self._open(self.path / storage_id / data_id) as f:
             return f.read()
 
+    def read_lines(self, storage_id: str, data_id: str) -> Iterator[str]:
+        with self._open(self.path / storage_id / data_id) as f:
+            yield from f
+
     def delete(self, storage_id: str, data_id: str) -> None:
         (self.path / storage_id / data_id).unlink()
 
+    def move(self, storage_id: str, data_id: str, new_storage_id: str, new_data_id: str) -> None:
+        s_id = self.path / new_storage_id
+        if not s_id.exists():
+            s_id.mkdir()
+        (self.path / storage_id / data_id).replace(s_id / new_data_id)
+
+
+class DedupSnapshotStorage(DiskSnapshotStorage):
+    """Keeps every distinct task once, compressed, in a file named by the hash of its contents.
+    A draft or snapshot is just the list of the hashes, so the same tasks found in the overlapping
+    periods cost nothing. The storages not listed in the tasklists keep the data as is."""
+
+    def __init__(self, path_to_the_storage: str, tasklists=('drafts', 'snapshots')) -> None:
+        super().__init__(path_to_the_storage)
+        self.tasklists = set(tasklists)
+        self.objects = self.path / 'objects'
+        if not self.objects.exists():
+            self.objects.mkdir()
+
+    def _object(self, h: str) -> pathlib.Path:
+        return self.objects / h[:2] / h[2:]
+
+    def write(self, storage_id: str, data_id: str, data: str) -> None:
+        if storage_id not in self.tasklists:
+            return super().write(storage_id, data_id, data)
+        old = self._refs(storage_id, data_id)
+        refs = []
+        for x in iter_task_dicts(jsonl_lines(data)):
+            b = json.dumps(x, ensure_ascii=False, separators=(',', ':'), sort_keys=True).encode('utf-8')
+            h = sha256(b).hexdigest()
+            o = self._object(h)
+            if not o.exists():
+                o.parent.mkdir(exist_ok=True)
+                o.write_bytes(zlib.compress(b))
+            refs.append(h)
+        super().write(storage_id, data_id, ''.join(f'{h}\n' for h in refs))
+        # a draft is rewritten by every update, the tasks it doesn't have anymore are dropped right away
+        self._collect(old.difference(refs))
+
+    def _refs(self, storage_id: str, data_id: str) -> set[str]:
+        """the hashes of the tasks in the tasklist, empty if there's none"""
+        try:
+            return {h.strip() for h in super().read_lines(storage_id, data_id)}
+        except FileNotFoundError:
+            return set()
+
+    def _used(self) -> set[str]:
+        used = set()
+        for storage_id in self.tasklists:
+            for data_id in self.list(storage_id):
+                used.update(self._refs(storage_id, data_id))
+        return used
+
+    def _collect(self, candidates: set[str]) -> int:
+        """Removes those of the candidates no tasklist refers to, returns the count removed"""
+        if not candidates:
+            return 0
+        unused = candidates.difference(self._used())
+        for h in unused:
+            self._object(h).unlink(missing_ok=True)
+        return len(unused)
+
+    def read(self, storage_id: str, data_id: str) -> str:
+        if storage_id not in self.tasklists:
+            return super().read(storage_id, data_id)
+        return ''.join(f'{x}\n' for x in self.read_lines(storage_id, data_id))
+
+    def read_lines(self, storage_id: str, data_id: str) -> Iterator[str]:
+        if storage_id not in self.tasklists:
+            yield from super().read_lines(storage_id, data_id)
+            return
+        for h in super().read_lines(storage_id, data_id):
+            yield zlib.decompress(self._object(h.strip()).read_bytes()).decode('utf-8')
+
+    def delete(self, storage_id: str, data_id: str) -> None:
+        old = self._refs(storage_id, data_id) if storage_id in self.tasklists else set()
+        super().delete(storage_id, data_id)
+        self._collect(old)
+
+    def move(self, storage_id: str, data_id: str, new_storage_id: str, new_data_id: str) -> None:
+        # the tasklist moved over may replace another one
+        old = self._refs(new_storage_id, new_data_id) if new_storage_id in self.tasklists else set()
+        super().move(storage_id, data_id, new_storage_id, new_data_id)
+        self._collect(old)
+
+    def collect_garbage(self) -> int:
+        """Removes the tasks no longer referenced, returns the count removed"""
+        used = self._used()
+        n = 0
+        for o in self.objects.glob('*/*'):
+            if o.parent.name + o.name not in used:
+                o.unlink()
+                n += 1
+        return n
+
+
+class SQliteSnapshotStorage(SnapshotStorage):
+    """Keeps a row per task, so the slices by release, assignee or project are read by the index.
+    The storages not listed in the tasklists keep the data as is."""
+
+    def __init__(self, path_db: str, tasklists=('drafts', 'snapshots')) -> None:
+        self.path_db = path_db
+        self.tasklists = set(tasklists)
+        self.con = connect(path_db)
+        # deps injection points:
+        self.now = lambda: dt.now().astimezone().timestamp()
+        with self.con:
+            self.con.executescript(("CREATE TABLE IF NOT EXISTS entries ("
+                                    "   storage_id TEXT NOT NULL, "
+                                    "   data_id TEXT NOT NULL, "
+                                    "   mtime REAL NOT NULL, "
+                                    "   data TEXT, "
+                                    "   PRIMARY KEY (storage_id, data_id)"
+                                    ");"
+                                    "CREATE TABLE IF NOT EXISTS tasks ("
+                                    "   storage_id TEXT NOT NULL, "
+                                    "   data_id TEXT NOT NULL, "
+                                    "   pos INTEGER NOT NULL, "
+                                    "   release TEXT, "
+                                    "   project TEXT, "
+                                    "   task TEXT NOT NULL, "
+                                    "   PRIMARY KEY (storage_id, data_id, pos)"
+                                    ");"
+                                    "CREATE TABLE IF NOT EXISTS task_assignees ("
+                                    "   storage_id TEXT NOT NULL, "
+                                    "   data_id TEXT NOT NULL, "
+                                    "   pos INTEGER NOT NULL, "
+                                    "   assignee TEXT NOT NULL, "
+                                    "   PRIMARY KEY (storage_id, data_id, pos, assignee)"
+                                    ");"
+                                    "CREATE INDEX IF NOT EXISTS tasks_release"
+                                    "   ON tasks (storage_id, data_id, release);"
+                                    "CREATE INDEX IF NOT EXISTS tasks_project"
+                                    "   ON tasks (storage_id, data_id, project);"
+                                    "CREATE INDEX IF NOT EXISTS task_assignees_assignee"
+                                    "   ON task_assignees (storage_id, data_id, assignee);"))
+
+    def __getstate__(self):
+        # the connection isn't picklable, another process connects anew
+        return (self.path_db, self.tasklists)
+
+    def __setstate__(self, state) -> None:
+        self.__init__(*state)
+
+    def _delete(self, storage_id: str, data_id: str) -> int:
+        for t in ('tasks', 'task_assignees'):
+            self.con.execute(f"DELETE FROM {t} WHERE storage_id=? AND data_id=?;", (storage_id, data_id))
+        return self.con.execute("DELETE FROM entries WHERE storage_id=? AND data_id=?;",
+                                (storage_id, data_id)).rowcount
+
+    def write(self, storage_id: str, data_id: str, data: str) -> None:
+        k = (storage_id, data_id)
+        with self.con:
+            self._delete(storage_id, data_id)
+            if storage_id not in self.tasklists:
+                self.con.execute("INSERT INTO entries VALUES(?, ?, ?, ?);", k + (self.now(), data))
+                return
+            self.con.execute("INSERT INTO entries VALUES(?, ?, ?, NULL);", k + (self.now(),))
+            tasks, assignees = [], []
+            for i, x in enumerate(iter_task_dicts(jsonl_lines(data))):
+                tasks.append(k + (i, x['release'], x.get('project'),
+                                  json.dumps(x, ensure_ascii=False, separators=(',', ':'))))
+                assignees += [k + (i, a) for a in set(x['assignees'])]
+            self.con.executemany("INSERT INTO tasks VALUES(?, ?, ?, ?, ?, ?);", tasks)
+            self.con.executemany("INSERT INTO task_assignees VALUES(?, ?, ?, ?);", assignees)
+
+    def list(self, storage_id: str) -> dict[str, float]:
+        q = "SELECT data_id, mtime FROM entries WHERE storage_id=?;"
+        return dict(self.con.execute(q, (storage_id,)).fetchall())
+
+    def exists(self, storage_id: str, data_id: str) -> bool:
+        q = "SELECT 1 FROM entries WHERE storage_id=? AND data_id=?;"
+        return self.con.execute(q, (storage_id, data_id)).fetchone() is not None
+
+    def read(self, storage_id: str, data_id: str) -> str:
+        if storage_id not in self.tasklists:
+            q = "SELECT data FROM entries WHERE storage_id=? AND data_id=?;"
+            x = self.con.execute(q, (storage_id, data_id)).fetchone()
+            if not x:
+                raise KeyError(f'{storage_id}/{data_id}')
+            return x[0]
+        return ''.join(x + '\n' for x in self.read_lines(storage_id, data_id))
+
+    def read_lines(self, storage_id: str, data_id: str) -> Iterator[str]:
+        if storage_id not in self.tasklists:
+            return iter(jsonl_lines(self.read(storage_id, data_id)))
+        return self.query(storage_id, data_id)
+
+    def query(self, storage_id: str, data_id: str, release: str | None = None,
+              assignees: Iterable[str] | None = None, project: str | None = None) -> Iterator[str]:
+        if storage_id not in self.tasklists:
+            return super().query(storage_id, data_id, release, assignees, project)
+        k = (storage_id, data_id)
+        q = "SELECT 1 FROM entries WHERE storage_id=? AND data_id=?;"
+        if not self.con.execute(q, k).fetchone():
+            raise KeyError(f'{storage_id}/{data_id}')
+        q = "SELECT t.task FROM tasks t WHERE t.storage_id=? AND t.data_id=?"
+        args = list(k)
+        if release is not None:
+            q += " AND t.release=?"
+            args.append(release)
+        if project is not None:
+            q += " AND t.project=?"
+            args.append(project)
+        if assignees is not None:
+            a = list(set(assignees))
+            q += (" AND t.pos IN (SELECT pos FROM task_assignees WHERE storage_id=? AND data_id=?"
+                  f" AND assignee IN ({', '.join('?' * len(a))}))")
+            args += list(k) + a
+        return (x[0] for x in self.con.execute(q + " ORDER BY t.pos;", args))
+
+    def delete(self, storage_id: str, data_id: str) -> None:
+        with self.con:
+            if not self._delete(storage_id, data_id):
+                raise KeyError(f'{storage_id}/{data_id}')
+
+    def move(self, storage_id: str, data_id: str, new_storage_id: str, new_data_id: str) -> None:
+        with self.con:
+            self._delete(new_storage_id, new_data_id)
+            n = 0
+            for t in ('entries', 'tasks', 'task_assignees'):
+                n += self.con.execute(f"UPDATE {t} SET storage_id=?, data_id=? WHERE storage_id=? AND data_id=?;",
+                                      (new_storage_id, new_data_id, storage_id, data_id)).rowcount
+            if not n:
+                raise KeyError(f'{storage_id}/{data_id}')
+
+
+_worker_storage: SnapshotStorage | None = None  # the storage of the pool's process
+
+
+def _worker_init(s: SnapshotStorage) -> None:
+    global _worker_storage
+    _worker_storage = s
+
+
+def _worker_snapshot_rows(data_id: str) -> list[tuple]:
+    """the rows of the snapshot's tasks without the ones it repeats, see Task.to_row"""
+    return [x.to_row() for x in dedup_tasks(iter_tasks(_worker_storage.read_lines('snapshots', data_id)))]
+
 
 class SnapshotManager:
+    """Keeps the drafts and snapshots in the storage along with the manifest describing them,
+    so listing and selection never touch the drafts and snapshots themselves.
+
+    A draft is kept whole as of its latest update, every update also stores the delta against
+    the previous one, so the earlier revisions could be restored and the changes reviewed."""
+
     def __init__(self, ss: SnapshotStorage, tp: TaskProvider):
         self.s = ss
         self.p = tp
+        self._manifest: dict[str, dict[str, dict]] | None = None
+        self._sorted: dict[str, list[SnapshotInfo]] = {}
+        # deps injection points:
+        self.now = lambda: dt.now().astimezone().timestamp()
+
+    @staticmethod
+    def _describe(date_from: str, date_to: str, mtime: float, data: str, count: int) -> dict:
+        return {'date_from': date_from,
+                'date_to': date_to,
+                'mtime': mtime,
+                'count': count,
+                'size': len(data.encode('utf-8')),
+                'checksum': sha1(data.encode('utf-8')).hexdigest(),
+                'sort_key': dt.strptime(date_from, '%d-%m-%Y').strftime('%Y%m%d')}
+
+    def manifest_rebuild(self) -> dict[str, dict[str, dict]]:
+        """Describes the drafts and snapshots by reading them all, the only time it's done"""
+        m: dict[str, dict[str, dict]] = {'drafts': {}, 'snapshots': {}}
+        deltas = list(self.s.list('draft_deltas'))
+        for data_id, mtime in self.s.list('drafts').items():
+            date_from, date_to = self.id2_decode(data_id)
+            x = self.s.read('drafts', data_id)
+            n = sum(1 for _ in iter_task_dicts(jsonl_lines(x)))
+            m['drafts'][data_id] = self._describe(date_from, date_to, mtime, x, n)
+            m['drafts'][data_id]['revision'] = len([d for d in deltas if d.startswith(f'{data_id}_')])
+        for data_id in self.s.list('snapshots'):
+            date_from, date_to, mtime = self.id3_decode(data_id)
+            x = self.s.read('snapshots', data_id)
+            n = sum(1 for _ in iter_task_dicts(jsonl_lines(x)))
+            m['snapshots'][data_id] = self._describe(date_from, date_to, mtime, x, n)
+        self._manifest_save(m)
+        return m
+
+    def _manifest_get(self) -> dict[str, dict[str, dict]]:
+        if self._manifest is None:
+            if 'index' in self.s.list('manifest'):
+                self._manifest = json.loads(self.s.read('manifest', 'index'))
+            else:
+                self._manifest = self.manifest_rebuild()
+        return self._manifest
+
+    def _manifest_save(self, m: dict[str, dict[str, dict]]) -> None:
+        self.s.write('manifest', 'index', json.dumps(m, ensure_ascii=False))
+        self._manifest = m
+        self._sorted = {}
+
+    def _list(self, storage_id: str) -> list[SnapshotInfo]:
+        if storage_id not in self._sorted:
+            d = sorted(self._manifest_get()[storage_id].values(), key=lambda x: x['sort_key'])
+            self._sorted[storage_id] = [
+                SnapshotInfo(x['date_from'], x['date_to'], x['mtime'], x['count'], x['size'], x['checksum'])
+                for x in d]
+        return self._sorted[storage_id]
 
     @staticmethod
     def id2_encode(date_from: str, date_to: str) -> str:
@@ -118,41 +623,169 @@ class SnapshotManager:
         y = data_id.index('_', x+1)
         return (data_id[:x], data_id[x+1:y], float(data_id[y+1:]))
 
+    def _body_read(self, body_ref: str) -> str:
+        return self.s.read('bodies', body_ref)
+
+    def _bodies_out_of_line(self, tasks: Iterable[Task]) -> Iterator[Task]:
+        """Moves the bodies into the 'bodies' storage named by their hashes, as only the AI needs them"""
+        known = set()
+        for t in tasks:
+            b = t.body
+            if b is not None and t.body_ref is None:
+                h = sha256(b.encode('utf-8')).hexdigest()
+                if h not in known and not self.s.exists('bodies', h):
+                    self.s.write('bodies', h, b)
+                known.add(h)
+                t.body_ref, t.body_loader = h, self._body_read
+                t.body = None  # dropped from memory, loaded back on demand
+            yield t
+
+    def _bodies_used(self) -> set[str]:
+        """the refs of the bodies of the drafts, the snapshots and the deltas of the drafts"""
+        used = set()
+        for storage_id in ('drafts', 'snapshots'):
+            for data_id in self.s.list(storage_id):
+                used.update(x.get('body_ref') for x in iter_task_dicts(self.s.read_lines(storage_id, data_id)))
+        for data_id in self.s.list('draft_deltas'):
+            d = json.loads(self.s.read('draft_deltas', data_id))
+            used.update(x.get('body_ref') for x in d['added'] + d['removed'])
+            used.update(x[k].get('body_ref') for x in d['moved'] + d['changed'] for k in ('old', 'new'))
+        return used
+
+    def collect_bodies(self) -> int:
+        """Deletes the bodies nothing refers to anymore, returns the count deleted"""
+        bodies = self.s.list('bodies')
+        if not bodies:
+            return 0  # nothing to collect, the drafts and snapshots are not read
+        used = self._bodies_used()
+        n = 0
+        for h in bodies:
+            if h not in used:
+                self.s.delete('bodies', h)
+                n += 1
+        return n
+
+    def _bodies_attach(self, tasks: Iterable[Task]) -> Iterator[Task]:
+        for t in tasks:
+            t.body_loader = self._body_read
+            yield t
+
     def draft_update(self, pat, date_from, date_to):
-        t = self.p.get_tasks(pat, date_from, date_to)
+        t = list(self._bodies_out_of_line(self.p.get_tasks(pat, date_from, date_to)))
+        x = self.id2_encode(date_from, date_to)
+        data = tasklist_to_jsonl(t)
+        m = self._manifest_get()
+        rev = 0
+        if x in m['drafts']:
+            rev = m['drafts'][x].get('revision', 0) + 1
+            d = tasklist_delta(iter_task_dicts(self.s.read_lines('drafts', x)), (y.to_dict() for y in t))
+            self.s.write('draft_deltas', f'{x}_{rev}', json.dumps(d, ensure_ascii=False))
+        self.s.write('drafts', x, data)
+        m['drafts'][x] = self._describe(date_from, date_to, self.now(), data, len(t))
+        m['drafts'][x]['revision'] = rev
+        self._manifest_save(m)
+
+    def _deltas_delete(self, data_id: str, revision: int) -> None:
+        for r in range(1, revision + 1):
+            self.s.delete('draft_deltas', f'{data_id}_{r}')
+
+    def draft_diff(self, date_from, date_to, revision: int | None = None) -> dict[str, list] | None:
+        """Returns what the update into the revision changed (the latest one by default)
+        as a delta of serialized tasks, see tasklist_delta. None if the draft was never updated."""
+        x = self.id2_encode(date_from, date_to)
+        r = self._manifest_get()['drafts'][x]['revision'] if revision is None else revision
+        if r < 1:
+            return None
+        return json.loads(self.s.read('draft_deltas', f'{x}_{r}'))
+
+    def draft_get_revision_tasks(self, date_from, date_to, revision: int) -> list[Task]:
+        """Restores the draft as it was after the given update, 0 is the very first one"""
         x = self.id2_encode(date_from, date_to)
-        self.s.write('drafts', x, tasklist_to_json(t))
+        tasks = {task_key(d): d for d in iter_task_dicts(self.s.read_lines('drafts', x))}
+        for r in range(self._manifest_get()['drafts'][x]['revision'], revision, -1):
+            d = json.loads(self.s.read('draft_deltas', f'{x}_{r}'))
+            for y in d['added']:
+                del tasks[task_key(y)]
+            for y in d['removed']:
+                tasks[task_key(y)] = y
+            for y in d['moved'] + d['changed']:
+                tasks[task_key(y['old'])] = y['old']
+        return list(self._bodies_attach(Task(**d) for d in tasks.values()))
 
     def drafts_list(self) -> list[SnapshotInfo]:
-        out = []
-        for data_id, mtime in self.s.list('drafts').items():
-            date_from, date_to = self.id2_decode(data_id)
-            out.append(SnapshotInfo(date_from, date_to, mtime))
-        return out
+        return self._list('drafts')
 
     def draft_delete(self, date_from: str, date_to: str) -> None:
-        self.s.delete('drafts', self.id2_encode(date_from, date_to))
+        x = self.id2_encode(date_from, date_to)
+        m = self._manifest_get()
+        self.s.delete('drafts', x)
+        self._deltas_delete(x, m['drafts'].pop(x, {}).get('revision', 0))
+        self._manifest_save(m)
+        self.collect_bodies()
 
     def draft_get_tasks(self, date_from, date_to) -> list[Task]:
-        x = self.s.read('drafts', self.id2_encode(date_from, date_to))
-        return json_to_tasklist(x)
+        return list(self.draft_iter_tasks(date_from, date_to))
+
+    def draft_iter_tasks(self, date_from, date_to) -> Iterator[Task]:
+        return self._bodies_attach(iter_tasks(self.s.read_lines('drafts', self.id2_encode(date_from, date_to))))
+
+    def draft_query_tasks(self, date_from, date_to, **criteria) -> Iterator[Task]:
+        """Reads only the tasks matching the criteria, see SnapshotStorage.query"""
+        return self._bodies_attach(iter_tasks(self.s.query('drafts', self.id2_encode(date_from, date_to), **criteria)))
 
     def draft_approve(self, date_from, date_to):
         id2 = self.id2_encode(date_from, date_to)
-        f = self.s.list('drafts')[id2]
-        x = self.s.read('drafts', id2)
-        self.s.write('snapshots', self.id3_encode(date_from, date_to, f), x)
-        self.s.delete('drafts', id2)
+        m = self._manifest_get()
+        d = m['drafts'][id2]
+        id3 = self.id3_encode(date_from, date_to, d['mtime'])
+        self.s.move('drafts', id2, 'snapshots', id3)
+        m['snapshots'][id3] = m['drafts'].pop(id2)
+        self._deltas_delete(id2, m['snapshots'][id3].pop('revision', 0))
+        self._manifest_save(m)
+        self.collect_bodies()  # the bodies only the deltas referred to
 
     def snapshots_list(self) -> list[SnapshotInfo]:
-        out: list[SnapshotInfo] = []
-        for data_id in self.s.list('snapshots'):
-            date_from, date_to, mtime = self.id3_decode(data_id)
-            out.append(SnapshotInfo(date_from, date_to, mtime))
-        d = [(dt.strptime(x.date_from, '%d-%m-%Y'), x) for x in out]
-        return [x[1] for x in sorted(d)]
+        return self._list('snapshots')
 
     def snapshot_get_tasks(self, date_from, date_to, mtime) -> list[Task]:
-        x = self.s.read('snapshots', self.id3_encode(
-            date_from, date_to, mtime))
-        return json_to_tasklist(x)
+        return list(self.snapshot_iter_tasks(date_from, date_to, mtime))
+
+    def snapshot_iter_tasks(self, date_from, date_to, mtime) -> Iterator[Task]:
+        x = self.s.read_lines('snapshots', self.id3_encode(date_from, date_to, mtime))
+        return self._bodies_attach(iter_tasks(x))
+
+    def snapshots_get_tasks(self, snapshots: list[SnapshotInfo], workers: int | None = None) -> list[Task]:
+        """Loads several snapshots parsing them in parallel processes, keeps the snapshots order
+        and drops the tasks repeated in the overlapping snapshots"""
+        ids = [self.id3_encode(x.date_from, x.date_to, x.mtime) for x in snapshots]
+        if (workers or cpu_count() or 1) == 1 or len(ids) < 2:
+            return dedup_tasks(self._bodies_attach(chain.from_iterable(
+                iter_tasks(self.s.read_lines('snapshots', x)) for x in ids)))
+        # the workers read the snapshots themselves and pass back the rows, which are cheaper to unpickle
+        with ProcessPoolExecutor(workers, initializer=_worker_init, initargs=(self.s,)) as e:
+            rows = chain.from_iterable(e.map(_worker_snapshot_rows, ids))
+            return dedup_tasks(self._bodies_attach(map(Task.from_row, rows)))
+
+    def snapshot_query_tasks(self, date_from, date_to, mtime, **criteria) -> Iterator[Task]:
+        """Reads only the tasks matching the criteria, see SnapshotStorage.query"""
+        x = self.s.query('snapshots', self.id3_encode(date_from, date_to, mtime), **criteria)
+        return self._bodies_attach(iter_tasks(x))
+
+    def migrate(self) -> int:
+        """Rewrites the drafts and snapshots still kept as legacy JSON or having the bodies inline
+        into JSON Lines with the bodies out of line, returns the count of the rewritten ones"""
+        n = 0
+        m = self._manifest_get()
+        for storage_id in ('drafts', 'snapshots'):
+            for data_id, d in m[storage_id].items():
+                t = list(iter_tasks(self.s.read_lines(storage_id, data_id)))
+                if not is_legacy_json(self.s.read_lines(storage_id, data_id)) \
+                        and all(x.body_ref is not None or x.body is None for x in t):
+                    continue
+                x = tasklist_to_jsonl(self._bodies_out_of_line(t))
+                self.s.write(storage_id, data_id, x)
+                d.update(self._describe(d['date_from'], d['date_to'], d['mtime'], x, d['count']))
+                n += 1
+        self._manifest_save(m)
+        self.collect_bodies()
+        return n
@@ -3,6 +3,9 @@ from unittest import TestCase
 from unittest.mock import MagicMock, call
 from copy import deepcopy
 from tempfile import mkstemp
+from sqlite3 import connect
+import gzip
+import json
 
 from src.AI import ChatGPT, FastStorage, SQlite, AI, Cache
 from src.Task import Task
@@ -21,7 +24,7 @@ class MockFastStorage(FastStorage):
             k.essence_completed = f'KNOWN_{k.tid}_COMPL'
         return (known, [deepcopy(t) for t in tasks if t.tid not in self.known_ids])
 
-    def memorize_essense(self, task: Task):
+    def memorize_essense(self, task: Task, model: str = ''):
         self.known_ids |= {task.tid}
 
 
@@ -121,6 +124,122 @@ class TestFastStorage(TestCase):
         with self.assertRaises(RuntimeError):
             s.memorize_essense(t)
 
+    def test_usage_tracking_and_eviction(self):
+        a = {'assignees': [], 'release': '', 'link': '', 'project': 'X'}
+        s = SQlite(mkstemp(suffix='.db')[1])
+        s.now = MagicMock(return_value=0)
+        for i in range(1, 4):
+            t = Task(**a, tid=f'{i}', title=f'T{i}', body='B' * 100)
+            t.essence, t.essence_completed = 'E', 'EC'
+            s.memorize_essense(t)
+
+        s.now = MagicMock(return_value=10 * 86400)
+        s.read_essense([Task(**a, tid='1', title='T1'), Task(**a, tid='7', title='T7')])
+        x = s.stats()
+        self.assertEqual((3, 1, 1), (x['rows'], x['hits'], x['misses']))
+        self.assertAlmostEqual(0.5, x['hit_ratio'])
+
+        self.assertEqual(0, s.evict_older_than(11))
+        self.assertEqual(2, s.evict_older_than(5))  # only the '1' was used recently
+        known, unknown = s.read_essense([Task(**a, tid=f'{i}', title='T') for i in range(1, 4)])
+        self.assertEqual(['1'], [t.tid for t in known])
+
+        s.now = MagicMock(return_value=11 * 86400)
+        t = Task(**a, tid='2', title='T2', body='B' * 100)
+        t.essence, t.essence_completed = 'E', 'EC'
+        s.memorize_essense(t)  # the most recent one
+        self.assertEqual(1, s.evict_to_size(150))
+        known, unknown = s.read_essense([Task(**a, tid=f'{i}', title='T') for i in range(1, 4)])
+        self.assertEqual(['2'], [t.tid for t in known])
+        s.vacuum()
+
+    def test_bodies_compaction(self):
+        a = {'assignees': [], 'release': '', 'link': '', 'project': 'X'}
+        s = SQlite(mkstemp(suffix='.db')[1])
+        s.now = MagicMock(return_value=0)
+        for i in range(1, 3):
+            t = Task(**a, tid=f'{i}', title=f'T{i}', body='тело ' * 100)
+            t.essence, t.essence_completed = 'E', 'EC'
+            s.memorize_essense(t)
+        s.now = MagicMock(return_value=30 * 86400)
+        self.assertEqual(2, s.compact_bodies(7))
+        self.assertEqual(0, s.compact_bodies(7))  # already compressed
+        self.assertEqual(2, s.stats()['bodies_compressed'])
+        b = s.con.execute("SELECT body FROM essence_cache WHERE tid='1';").fetchone()[0]
+        self.assertEqual('тело ' * 100, SQlite.body_decode(b))
+        self.assertEqual(2, s.compact_bodies(7, drop=True))
+        b = s.con.execute("SELECT body FROM essence_cache WHERE tid='1';").fetchone()[0]
+        self.assertIsNone(b)
+
+    def test_legacy_schema_migration(self):
+        p = mkstemp(suffix='.db')[1]
+        con = connect(p)
+        con.execute(("CREATE TABLE essence_cache (project TEXT NOT NULL, tid TEXT NOT NULL,"
+                     " parent_title TEXT, title TEXT NOT NULL, body TEXT, essence TEXT NOT NULL,"
+                     " essence_completed TEXT NOT NULL, PRIMARY KEY (project, tid));"))
+        con.execute("INSERT INTO essence_cache VALUES('X', '1', NULL, 'T', NULL, 'E', 'EC');")
+        con.commit()
+        con.close()
+
+        s = SQlite(p)
+        known, _ = s.read_essense([Task('T', [], '', '', project='X', tid='1')])
+        self.assertEqual('E', known[0].essence)
+        self.assertEqual(0, s.evict_older_than(1))
+
+    def test_export_merge(self):
+        a = {'assignees': [], 'release': '', 'link': '', 'project': 'X'}
+
+        def put(s: SQlite, tid: str, essence: str, model: str, now: float):
+            s.now = MagicMock(return_value=now)
+            t = Task(**a, tid=tid, title=f'T{tid}', body='B')
+            t.essence, t.essence_completed = essence, f'{essence}_done'
+            s.memorize_essense(t, model)
+
+        src = SQlite(mkstemp(suffix='.db')[1])
+        put(src, '1', 'src_old', 'gpt-4', 100)
+        put(src, '2', 'src_new', 'gpt-3.5', 300)
+        put(src, '3', 'src_only', 'gpt-3.5', 300)
+        dst = SQlite(mkstemp(suffix='.db')[1])
+        put(dst, '1', 'dst_new', 'gpt-3.5', 200)
+        put(dst, '2', 'dst_old', 'gpt-4', 200)
+
+        f = mkstemp(suffix='.jsonl.gz')[1]
+        self.assertEqual(2, src.export(f, since=200))
+        self.assertEqual(3, src.export(f))
+
+        def essences(s: SQlite) -> dict:
+            k, _ = s.read_essense([Task(**a, tid=f'{i}', title='T') for i in range(1, 4)])
+            return {t.tid: t.essence for t in k}
+
+        r = SQlite(mkstemp(suffix='.db')[1])
+        put(r, '1', 'dst_new', 'gpt-3.5', 200)
+        put(r, '2', 'dst_old', 'gpt-4', 200)
+        self.assertEqual(2, r.merge(f))  # the most recent wins
+        self.assertDictEqual({'1': 'dst_new', '2': 'src_new', '3': 'src_only'}, essences(r))
+
+        v = dst.essences_version()
+        self.assertEqual(2, v)
+        self.assertEqual(2, dst.merge(f, prefer_model='gpt-4'))
+        self.assertDictEqual({'1': 'src_old', '2': 'dst_old', '3': 'src_only'}, essences(dst))
+        self.assertEqual(v + 2, dst.essences_version())  # though the newest essence is as old as before
+        self.assertEqual(0, dst.merge(f, prefer_model='gpt-4'))
+        self.assertEqual(v + 2, dst.essences_version())
+
+        with open(f, mode='wb') as x:
+            x.write(gzip.compress(b'{"format": "garbage"}\n'))
+        with self.assertRaises(RuntimeError):
+            dst.merge(f)
+
+        header = json.dumps(SQlite.export_format).encode('utf-8')
+        for row in (b'{"project": "X"}', b'not json', b'[]'):
+            with open(f, mode='wb') as x:
+                x.write(gzip.compress(header + b'\n' + row + b'\n'))
+            with self.assertRaisesRegex(RuntimeError, ':2 is not'):
+                dst.merge(f)
+        src.export(f)
+        self.assertEqual(0, dst.merge(f, prefer_model='gpt-4'))  # the failed merges left no temp table behind
+
+
 
 class TestAI(TestCase):
     # def test_for_manual_prompt_debugging(self):
@@ -1,4 +1,5 @@
 from argparse import ArgumentTypeError
+from datetime import datetime
 from json import loads
 from unittest import TestCase
 
@@ -13,6 +14,37 @@ class TestIntRange(TestCase):
             ArgsTypes.arg_range_or_single("WTF")
 
 
+class TestAgeOrSize(TestCase):
+    def test_various(self):
+        self.assertTupleEqual(('age', 90), ArgsTypes.arg_age_or_size("90d"))
+        self.assertTupleEqual(('size', 500 * 1024 ** 2), ArgsTypes.arg_age_or_size("500MB"))
+        self.assertTupleEqual(('size', 2 * 1024 ** 3), ArgsTypes.arg_age_or_size("2g"))
+        self.assertTupleEqual(('size', 100), ArgsTypes.arg_age_or_size("100"))
+        with self.assertRaises(ArgumentTypeError):
+            ArgsTypes.arg_age_or_size("WTF")
+        self.assertEqual(512 * 1024 ** 2, ArgsTypes.arg_size("512MB"))
+        with self.assertRaises(ArgumentTypeError):
+            ArgsTypes.arg_size("90d")
+
+
+class TestPositiveInt(TestCase):
+    def test_various(self):
+        self.assertEqual(4, ArgsTypes.arg_positive_int("4"))
+        for i in ("0", "-1", "WTF"):
+            with self.assertRaises(ArgumentTypeError):
+                ArgsTypes.arg_positive_int(i)
+
+
+class TestDate(TestCase):
+    def test_various(self):
+        self.assertEqual(datetime(2023, 5, 31).timestamp(), ArgsTypes.arg_date("31.05.2023"))
+        self.assertEqual(datetime(2023, 5, 1).timestamp(), ArgsTypes.arg_date("1-5-2023"))
+        with self.assertRaises(ArgumentTypeError):
+            ArgsTypes.arg_date("31.02.2023")
+        with self.assertRaises(ArgumentTypeError):
+            ArgsTypes.arg_date("WTF")
+
+
 class TestNamesReferenceValidator(TestCase):
     def test_valid(self):
         j = '{"a" : "b", "s" : "b", "d" : "f"}'
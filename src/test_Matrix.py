@@ -2,9 +2,17 @@ from unittest import TestCase
 from tempfile import mkdtemp, mkstemp
 from pathlib import Path
 from shutil import copy, rmtree
+from random import Random
+from io import BytesIO
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
+import json
+import pickle
+from docx import Document
+from os import utime
 
-from src.Task import Task
-from src.Matrix import ExcelPrinter, Matrix, MatrixPrinter, NameNormalizer, ServiceAssignmentsMatrix, get_bundle_zip, DocsGenerator, get_product_from_release
+from src.Task import Task, TaskProvider, SnapshotManager, DiskSnapshotStorage, tasklist_delta, tasklist_to_jsonl, \
+    jsonl_lines
+from src.Matrix import ExcelPrinter, Matrix, MatrixPrinter, NameNormalizer, ServiceAssignmentsMatrix, get_bundle_zip, write_bundle_zip, bundle_manifest, DocsGenerator, get_product_from_release, index_releases_by_product, get_printer, PeriodReport, snapshot_percents, snapshots_percents
 
 
 class TestDocsGenerator(TestCase):
@@ -61,7 +69,65 @@ class TestDocsGenerator(TestCase):
 
             docx = dg.get_docx('todo', 'CC_13.3.7', 'Тест Тестович',
                                '01-12-2023', '31-12-2023', ['A', 'B'])
-            docx.save('test_out_get_docx_output.docx')
+            docx.save(dir_root / 'test_out_get_docx_output.docx')
+        finally:
+            rmtree(dir_root)
+
+    def test_precompiled_docx(self):
+        dir_root = Path(mkdtemp())
+        try:
+            dir_todo = dir_root / 'todo'
+            dir_todo.mkdir()
+            copy('.test_files/test_template_good.docx', dir_todo / 'CC.docx')
+            slow, fast = DocsGenerator(str(dir_root)), DocsGenerator(str(dir_root), precompiled=True)
+            for args in (('Тест Тестович', '01-12-2023', '31-12-2023', ['A', 'B']),
+                         (' Спереди & <сзади> ', '01-12-2023', '31-12-2023', ['\tтаб', 'строка\r\nещё  ', '']),
+                         ('', '', '', [])):
+                a = ZipFile(BytesIO(slow.get_docx_bytes('todo', 'CC_13.3.7', *args)))
+                b = ZipFile(BytesIO(fast.get_docx_bytes('todo', 'CC_13.3.7', *args)))
+                self.assertIsNone(b.testzip())
+                self.assertListEqual(a.namelist(), b.namelist())
+                for x in a.namelist():
+                    if x == 'word/document.xml' and not args[0]:
+                        continue  # python-docx writes an empty run as <w:r/>
+                    self.assertEqual(a.read(x), b.read(x), x)
+                Document(BytesIO(fast.get_docx_bytes('todo', 'CC_13.3.7', *args)))
+            self.assertIn('Тест Тестович', '\n'.join(p.text for p in Document(BytesIO(
+                fast.get_docx_bytes('todo', 'CC_13.3.7', 'Тест Тестович', '', '', []))).paragraphs))
+            with self.assertRaises(ValueError):
+                fast.get_docx_bytes('todo', 'CC_13.3.7', 'Null\x00', '', '', [])
+        finally:
+            rmtree(dir_root)
+
+    def test_template_cache(self):
+        dir_root = Path(mkdtemp())
+        try:
+            dir_todo = dir_root / 'todo'
+            dir_todo.mkdir()
+            file_CC = dir_todo / 'CC.docx'
+            copy('.test_files/test_template_good.docx', file_CC)
+            dg = DocsGenerator(str(dir_root))
+
+            a = dg.get_docx('todo', 'CC_13.3.7', 'Петр', '01-12-2023', '31-12-2023', ['A'])
+            b = dg.get_docx('todo', 'CC_13.3.7', 'Фома', '01-12-2023', '31-12-2023', ['B'])
+            self.assertEqual(1, len(dg._templates))
+            text = ['\n'.join(p.text for p in x.paragraphs) for x in (a, b)]
+            self.assertIn('Петр', text[0])
+            self.assertNotIn('Фома', text[0])
+            self.assertIn('Фома', text[1])
+            self.assertTrue(dg.is_template_valid(file_CC))
+            o = BytesIO()
+            b.save(o)
+            self.assertIn('Фома', ZipFile(o).read('word/document.xml').decode('utf-8'))
+
+            copy('.test_files/test_template_bad.docx', file_CC)
+            utime(file_CC, ns=(1, 1))  # surely another mtime
+            with self.assertRaises(RuntimeError):
+                dg.get_docx('todo', 'CC_13.3.7', 'Петр', '01-12-2023', '31-12-2023', ['A'])
+
+            x = pickle.loads(pickle.dumps(dg))
+            self.assertEqual(dg.dir_templates, x.dir_templates)
+            self.assertDictEqual({}, x._templates)
         finally:
             rmtree(dir_root)
 
@@ -75,6 +141,19 @@ class TestMatrix(TestCase):
         self.assertEqual(m.num_tasks_ttl('Foma'), 1)
         self.assertTrue('FTW_13.3.7' in m._rows['Petr'].releases)
 
+    def test_sparseness(self):
+        t1 = Task('A', ['Petr'], 'FTW_13.3.7', 'http://')
+        t2 = Task('B', ['Foma', 'Petr'], 'OMG_13.3.8', 'http://')
+        t3 = Task('C', ['Foma'], '', 'http://')
+        m = Matrix([t1, t2, t3], {'x': 'Empty'})
+        self.assertNotIn('FTW_13.3.7', m._rows['Foma'].releases)
+        self.assertDictEqual({}, m._rows['Empty'].releases)
+        self.assertEqual(0, m.num_tasks_in_release('Foma', 'FTW_13.3.7'))
+        self.assertListEqual([], m.get_tasks_in_release('Empty', 'OMG_13.3.8'))
+        self.assertListEqual([('Petr', 'FTW_13.3.7', ['A']), ('Petr', 'OMG_13.3.8', ['B']),
+                              ('Foma', 'OMG_13.3.8', ['B']), ('Foma', 'DEFAULT', ['C'])],
+                             [(a, r, [t.title for t in x]) for a, r, x in m.iter_cells()])
+
     def test_name_normalization(self):
         t1 = Task('A', ['Petr'], 'FTW_13.3.7', 'http://')
         t2 = Task('B', ['Foma', 'Petr'], 'OMG_13.3.8', 'http://')
@@ -109,6 +188,16 @@ class TestMatrix(TestCase):
         s = {'FTW_13.3.7', 'FTW_14.0.0', 'OMG_15.2.3'}
         self.assertEqual(2, MatrixPrinter.count_releases_of_type(s, 'FTW'))
         self.assertEqual(0, MatrixPrinter.count_releases_of_type(s, 'XXX'))
+        i = index_releases_by_product(s)
+        self.assertEqual(2, MatrixPrinter.count_releases_of_type(i, 'FTW'))
+        self.assertEqual(0, MatrixPrinter.count_releases_of_type(i, 'XXX'))
+
+    def test_index_releases_by_product(self):
+        s = {'FTW_14.0.0', 'FTW_13.3.7', 'IS_5.2', 'LLB', 'lower_1.0.0'}
+        self.assertDictEqual({'FTW': ['FTW_13.3.7', 'FTW_14.0.0'], 'IS': ['IS_5.2']},
+                             index_releases_by_product(s))
+        m = Matrix([Task('A', ['Petr'], 'FTW_13.3.7', 'hA')])
+        self.assertIs(m.releases_by_product(), m.releases_by_product())
 
     def test_cell_comments_generator(self):
         s = MatrixPrinter.msg_control_spends % 20
@@ -243,6 +332,28 @@ class TestMatrixPrinter(TestCase):
         for i, col in enumerate(l.paper_comments):
             self.assertListEqual(out[i], col)
 
+    def test_grid_matches_cell_by_cell(self):
+        r = Random(1)
+        releases = [f'{p}_1.{i}.0' for p in ('CC', 'CR', 'CRS') for i in range(4)] + ['']
+        people = [f'P{i}' for i in range(12)]
+        tsks = [Task(f'T{i}', r.sample(people, r.choice((1, 2))), r.choice(releases), f'h{i}')
+                for i in range(200)]
+        predefined = {'P1': {'CR': 0.2, 'DEFAULT': 0.1}, 'P2': {'CRS': 0.5}, 'Nobody': {'CC': 0.3}}
+        m = Matrix(tsks, {'x': 'Nobody'})
+        ps = MatrixPrinter.PredefinedSpend(predefined, m.releases_ever_known)
+        g = MatrixPrinter.compute(m, predefined)
+        self.assertListEqual(m.list_assignees(), [x.person for x in g.rows])
+        for x in g.rows:
+            for release, p, c in zip(g.releases, x.percents, x.comments):
+                e = MatrixPrinter.get_release_percents(
+                    m.num_tasks_in_release(x.person, release), m.num_tasks_ttl(x.person),
+                    ps.get_percents_predefined_for_release(x.person, release),
+                    ps.get_percents_preallocated_ttl(x.person))
+                self.assertEqual(0 if e < 0.0001 else e, p)
+                self.assertEqual(MatrixPrinter.get_release_comment(
+                    ps.get_percents_predefined_for_release(x.person, release),
+                    m.get_tasks_in_release(x.person, release)), c)
+
     def test_comments(self):
         t1 = Task('A', ['Petr'], 'FTW_13.3.7', 'http://A')
         t2 = Task('B', ['Foma', 'Petr'], 'OMG_13.3.8', 'http://B')
@@ -254,6 +365,23 @@ class TestMatrixPrinter(TestCase):
         for i, col in enumerate(l.paper_comments):
             self.assertListEqual(out[i], col)
 
+    def test_brush_tasks(self):
+        t1 = Task('A', ['Petr'], 'FTW_13.3.7', 'http://A')
+        t2 = Task('B', ['Foma', 'Petr'], 'OMG_13.3.8', 'http://B')
+        cells = []
+
+        class P(MatrixPrinter):
+            comments = False
+
+            def brush_tasks(self, col, row, person, release, tasks):
+                cells.append((col, row, person, release, [t.title for t in tasks]))
+
+            def brush_comment(self, col, row, x):
+                raise AssertionError(x)
+        P().print(Matrix([t1, t2], {'p': 'Petr', 'f': 'Foma'}))
+        self.assertListEqual([(1, 1, 'Petr', 'FTW_13.3.7', ['A']), (2, 1, 'Petr', 'OMG_13.3.8', ['B']),
+                              (2, 2, 'Foma', 'OMG_13.3.8', ['B'])], cells)
+
     def test_hightlights_if_no_tasks(self):
         t1 = Task('A', ['Petr'], 'FTW_13.3.7', 'http://A')
         t2 = Task('B', ['Foma', 'Petr'], 'OMG_13.3.8', 'http://B')
@@ -280,8 +408,256 @@ class TestMatrixPrinter(TestCase):
         t3 = Task('Task 3 with very very long description like you can find in real life',
                   ['Petr'], 'FTW_13.3.7', 'http://task3/asdfupfasdfbdsfdsfasdfadv/asdfefwewdf')
         predef_spend = {'Sheph': {'FTW': 0.4, 'DEFAULT': 0.2}}
-        with ExcelPrinter('test_out_excel_printer.xlsx', '31-01-2023', '28-02-2023') as printer:
-            printer.print(Matrix([t1, t2, t3], {'x': 'Empty'}), predef_spend)
+        d = mkdtemp()
+        try:
+            with ExcelPrinter(str(Path(d) / 'test_out_excel_printer.xlsx'), '31-01-2023', '28-02-2023') as printer:
+                printer.print(Matrix([t1, t2, t3], {'x': 'Empty'}), predef_spend)
+        finally:
+            rmtree(d)
+
+    def test_excel_printer_streaming(self):
+        t1 = Task('T' * 40000, ['Petr'], 'FTW_13.3.7', 'http://task1')
+        t2 = Task('Task 2', ['Sheph', 'Petr'], 'OMG_13.3.8', 'http://task2')
+        o = BytesIO()
+        with ExcelPrinter(o, '31-01-2023', '28-02-2023', streaming=True, comments=True) as printer:
+            printer.print(Matrix([t1, t2], {'x': 'Empty'}))
+        with ZipFile(o) as z:
+            sheet = z.read('xl/worksheets/sheet1.xml').decode('utf-8')
+            comments = z.read('xl/comments1.xml').decode('utf-8')
+        self.assertIn('<cols>', sheet)
+        self.assertIn('Sheph', sheet)  # the strings are inlined when streaming
+        self.assertIn('T' * 1000, comments)  # truncated but not dropped
+        self.assertNotIn('T' * ExcelPrinter.comment_max_len, comments)
+
+        o = BytesIO()
+        with ExcelPrinter(o, '31-01-2023', '28-02-2023', streaming=True) as printer:
+            printer.print(Matrix([t1, t2], {'p': 'Petr', 's': 'Sheph'}))
+        with ZipFile(o) as z:
+            names = z.namelist()
+        self.assertNotIn('xl/comments1.xml', names)  # the comments are in memory till the close
+        self.assertIn('xl/worksheets/sheet2.xml', names)  # the tasks are on their sheet instead
+
+    def test_excel_printer_tasks_sheet(self):
+        t1 = Task('Task 1', ['Petr'], 'FTW_13.3.7', 'http://task1')
+        t2 = Task('Task 2', ['Foma', 'Petr'], 'OMG_13.3.8', 'http://task2')
+        t3 = Task('Task 3', ['Petr'], 'FTW_13.3.7', 'http://task3')
+        for streaming in (False, True):
+            o = BytesIO()
+            with ExcelPrinter(o, '31-01-2023', '28-02-2023', streaming, comments=False, tasks_sheet=True) as p:
+                p.print(Matrix([t1, t2, t3], {'p': 'Petr', 'f': 'Foma'}))
+            with ZipFile(o) as z:
+                names = z.namelist()
+                sheet = z.read('xl/worksheets/sheet1.xml').decode('utf-8')
+                tasks = z.read('xl/worksheets/sheet2.xml').decode('utf-8')
+                if 'xl/sharedStrings.xml' in names:
+                    tasks += z.read('xl/sharedStrings.xml').decode('utf-8')
+            self.assertNotIn('xl/comments1.xml', names)
+            # Foma/OMG, Petr/FTW ×2, Petr/OMG
+            self.assertIn("location=\"'Задачи'!A3:D4\"", sheet)
+            self.assertIn("location=\"'Задачи'!A2:D2\"", sheet)
+            self.assertIn('<c r="B2" s="1"><v>0.666', sheet)  # the percent is kept under the link
+            self.assertIn('http://task3', tasks)
+
+    def test_excel_printer_tasks_sheet_links_limit(self):
+        t1 = Task('Task 1', ['Petr'], 'FTW_13.3.7', 'http://task1')
+        t2 = Task('Task 2', ['Foma', 'Petr'], 'OMG_13.3.8', 'http://task2')
+        t3 = Task('Task 3', ['Petr'], 'FTW_13.3.7', 'http://task3')
+
+        class Limited(ExcelPrinter):
+            pass
+        for limit, links in ((3, 3), (2, 2)):  # 3 cells: at the limit and over it
+            Limited.url_max_count = limit
+            o = BytesIO()
+            with Limited(o, '31-01-2023', '28-02-2023', comments=False, tasks_sheet=True) as p:
+                p.print(Matrix([t1, t2, t3], {'p': 'Petr', 'f': 'Foma'}))
+            with ZipFile(o) as z:
+                sheet = z.read('xl/worksheets/sheet1.xml').decode('utf-8')
+            self.assertEqual(links, sheet.count('<hyperlink '))
+            if limit == 3:
+                self.assertIn("location=\"'Задачи'!A3:D4\"", sheet)
+            else:  # Petr's rows are 3-5, Foma's is 2
+                self.assertIn("location=\"'Задачи'!A3:D5\"", sheet)
+                self.assertIn("location=\"'Задачи'!A2:D2\"", sheet)
+                self.assertRegex(sheet, r'<c r="B2" s="\d+"><v>0\.666')  # the percents are plain
+
+
+class TestTextPrinters(TestCase):
+    def setUp(self) -> None:
+        t1 = Task('A', ['Petr'], 'FTW_13.3.7', 'http://A')
+        t2 = Task('B', ['Foma', 'Petr'], 'OMG_13.3.8', 'http://B')
+        self.m = Matrix([t1, t2], {'x': 'Empty'})
+
+    def _print(self, fmt: str) -> str:
+        o = BytesIO()
+        with get_printer(fmt, o, '31-01-2023', '28-02-2023') as p:
+            p.print(self.m, {'Empty': {'FTW': 0.5}})
+        return o.getvalue().decode('utf-8')
+
+    def test_csv(self):
+        self.assertEqual(('\r\n'.join([',FTW_13.3.7,OMG_13.3.8,DEFAULT',
+                                        'Petr,0.5,0.5,0',
+                                        'Foma,0,1.0,0',
+                                        'Empty,1.0,0,0']) + '\r\n'), self._print('csv'))
+
+    def test_jsonl(self):
+        l = [json.loads(x) for x in self._print('jsonl').splitlines()]
+        self.assertDictEqual({'assignee': 'Petr', 'name_known': False, 'tasks_ttl': 2,
+                              'percents': {'FTW_13.3.7': 0.5, 'OMG_13.3.8': 0.5},
+                              'tasks': {'FTW_13.3.7': ['http://A'], 'OMG_13.3.8': ['http://B']}}, l[0])
+        self.assertDictEqual({'FTW_13.3.7': 1.0}, l[2]['percents'])
+        self.assertDictEqual({}, l[2]['tasks'])
+
+    def test_columns(self):
+        o = json.loads(self._print('columns'))
+        self.assertListEqual(['Petr', 'Petr', 'Foma', 'Empty'], o['assignee'])
+        self.assertListEqual(['FTW_13.3.7', 'OMG_13.3.8', 'OMG_13.3.8', 'FTW_13.3.7'], o['release'])
+        self.assertListEqual([0.5, 0.5, 1.0, 1.0], o['percent'])
+        self.assertListEqual([['http://A'], ['http://B'], ['http://B'], []], o['tasks'])
+
+
+class TestMatrixUpdates(TestCase):
+    def _tasks(self):
+        return [Task('A', ['Petr'],         'FTW_13.3.7', 'http://A', tid='1'),
+                Task('B', ['Foma', 'Petr'], 'OMG_13.3.8', 'http://B', tid='2'),
+                Task('C', ['Ptr'],          'FTW_13.3.7', 'http://C', tid='3'),
+                Task('D', ['Ptr'],          '',           'http://D', tid='4'),
+                Task('E', ['Oleg'],         '',           'http://E', tid='5')]
+
+    def _assertSame(self, m: Matrix, tasks: list):
+        e = Matrix(tasks, {'Ptr': 'Petr', 'x': 'y'})
+        self.assertSetEqual(e.releases_ever_known, m.releases_ever_known)
+        self.assertSetEqual(set(e.list_assignees()), set(m.list_assignees()))
+        self.assertSetEqual({(a, r, tuple(t)) for a, r, t in e.iter_cells()},
+                            {(a, r, tuple(t)) for a, r, t in m.iter_cells()})
+        for a in e.list_assignees():
+            self.assertEqual(e.num_tasks_ttl(a), m.num_tasks_ttl(a))
+            self.assertEqual(e.is_assignee_known(a), m.is_assignee_known(a))
+        self.assertDictEqual(e.releases_by_product(), m.releases_by_product())
+
+    def test_add_remove_move(self):
+        t = self._tasks()
+        m = Matrix(t[:3], {'Ptr': 'Petr', 'x': 'y'})
+        m.releases_by_product()
+        self.assertSetEqual(set(), m.take_dirty())
+        m.add_task(t[3])
+        m.add_task(t[4])
+        self.assertSetEqual({'Petr', 'Oleg'}, m.take_dirty())
+        self._assertSame(m, t)
+
+        m.remove_task(t[1])  # OMG is gone, all the rows change
+        self.assertSetEqual({'Petr', 'Foma', 'Oleg', 'y'}, m.take_dirty())
+        self.assertFalse(m.has_assignee('Foma'))
+        self._assertSame(m, [t[0], t[2], t[3], t[4]])
+
+        n = Task('C', ['Oleg'], 'FTW_13.3.7', 'http://C', tid='3')
+        m.move_task(t[2], n)
+        self.assertSetEqual({'Petr', 'Oleg'}, m.take_dirty())
+        self._assertSame(m, [t[0], n, t[3], t[4]])
+        with self.assertRaises(ValueError):
+            m.remove_task(t[2])
+
+    def test_apply_delta(self):
+        t = self._tasks()
+        n = [t[0], Task('B', ['Foma'], 'OMG_13.3.8', 'http://B', tid='2'),
+             Task('C', ['Ptr'], 'FTW_13.3.7', 'http://C2', tid='3'), t[4],
+             Task('F', ['Oleg'], 'IS_5.2', 'http://F', tid='6')]
+        m = Matrix(t, {'Ptr': 'Petr', 'x': 'y'})
+        m.apply_delta(tasklist_delta([x.to_dict() for x in t], [x.to_dict() for x in n]))
+        self._assertSame(m, n)
+        self.assertListEqual(['http://C2'], [x.link for x in m.get_tasks_in_release('Petr', 'FTW_13.3.7')
+                                             if x.title == 'C'])
+
+    def test_from_iterator(self):
+        t = self._tasks()
+        for x in t:
+            x.body = 'a long body ' * 100
+            x.essence = f'AI_{x.title}'
+        m = Matrix(iter(t), {'Ptr': 'Petr', 'x': 'y'})
+        self._assertSame(m, t)
+        e = m.get_tasks_in_release('Petr', 'FTW_13.3.7')
+        self.assertListEqual(['A', 'C'], [x.title for x in e])
+        self.assertListEqual(['AI_A', 'AI_C'], [x.essence for x in e])
+        self.assertIsInstance(e[0], Matrix.Entry)
+        self.assertFalse(hasattr(e[0], 'body'))
+
+    def test_dirty_rows_rendering(self):
+        t = self._tasks()
+        m = Matrix(t, {'Ptr': 'Petr', 'x': 'y'})
+        m.add_task(Task('F', ['Oleg'], 'FTW_13.3.7', 'http://F', tid='6'))
+        g = MatrixPrinter.compute(m, only=m.take_dirty())
+        self.assertListEqual(['Oleg'], [r.person for r in g.rows])
+        full = {r.person: r.percents for r in MatrixPrinter.compute(m).rows}
+        self.assertListEqual(full['Oleg'], g.rows[0].percents)
+
+    def test_service_assignments(self):
+        t = self._tasks()
+        for x in t:
+            x.essence = x.title
+            x.essence_completed = f'{x.title}_done'
+        s = ServiceAssignmentsMatrix(t[:2], {'Ptr': 'Petr', 'x': 'y'})
+        s.add_task(t[2])
+        s.add_task(t[3])
+        s.remove_task(t[1])
+        e = ServiceAssignmentsMatrix([t[0], t[2], t[3]], {'Ptr': 'Petr', 'x': 'y'})
+        self.assertSetEqual(set(e.list_releases()), set(s.list_releases()))
+        for r in e.list_releases():
+            self.assertSetEqual(set(e.list_assignees_by_release(r)), set(s.list_assignees_by_release(r)))
+            for a in e.list_assignees_by_release(r):
+                self.assertListEqual(e.list_essences(r, a), s.list_essences(r, a))
+                self.assertListEqual(e.list_completed_essences(r, a), s.list_completed_essences(r, a))
+
+
+class TestPeriodReport(TestCase):
+    def test_snapshot_percents(self):
+        t = [Task('A\u2028a', ['Petr'], 'FTW_13.3.7', 'http://A'),
+             Task('B', ['Foma', 'Petr'], 'OMG_13.3.8', 'http://B')]
+        p = snapshot_percents(jsonl_lines(tasklist_to_jsonl(t)), {'x': 'Empty'}, {'Empty': {'FTW': 0.5}})
+        self.assertDictEqual({'Petr': {'FTW_13.3.7': 0.5, 'OMG_13.3.8': 0.5},
+                              'Foma': {'OMG_13.3.8': 1.0},
+                              'Empty': {'FTW_13.3.7': 1.0}}, p)
+
+        class Provider(TaskProvider):
+            def get_tasks(self, pat, date_from, date_to) -> list[Task]:
+                return t
+
+        d = mkdtemp()
+        try:
+            sm = SnapshotManager(DiskSnapshotStorage(d), Provider())
+            for a, b in (('01-01-2023', '31-01-2023'), ('01-02-2023', '28-02-2023')):
+                sm.draft_update('patpatpatpat', a, b)
+                sm.draft_approve(a, b)
+            x = sm.snapshots_list()
+            for workers in (1, 2):  # the workers read the snapshots themselves
+                self.assertListEqual([p, p], snapshots_percents(sm, x, {'x': 'Empty'},
+                                                                {'Empty': {'FTW': 0.5}}, workers))
+        finally:
+            rmtree(d)
+
+    def test_aggregation(self):
+        r = PeriodReport([('01-01-2023', '31-01-2023'), ('01-02-2023', '28-02-2023')],
+                         [{'Petr': {'FTW_13.3.7': 0.5, 'DEFAULT': 0.5}, 'Foma': {'OMG_13.3.8': 1.0}},
+                          {'Petr': {'FTW_13.3.7': 1.0}}])
+        rows = list(r.rows())
+        self.assertListEqual([('Foma', 'OMG_13.3.8', [1.0, 0], 1.0),
+                              ('Petr', 'FTW_13.3.7', [0.5, 1.0], round((31 * 0.5 + 28) / 59, 7)),
+                              ('Petr', 'DEFAULT', [0.5, 0], round(31 * 0.5 / 59, 7))], rows)
+        o = BytesIO()
+        r.write('csv', o)
+        self.assertTrue(o.getvalue().decode('utf-8').startswith(',,01-2023,02-2023,Итого'))
+        o = BytesIO()
+        r.write('xlsx', o)
+        with ZipFile(o) as z:
+            self.assertIn('xl/worksheets/sheet1.xml', z.namelist())
+
+    def test_months(self):
+        # две половины марта — один столбец; снимок через границу месяцев делится по дням
+        r = PeriodReport([('01-03-2023', '15-03-2023'), ('16-03-2023', '31-03-2023'), ('20-04-2023', '10-05-2023')],
+                         [{'Petr': {'FTW': 1.0}}, {'Petr': {'OMG': 1.0}, 'Foma': {'OMG': 1.0}},
+                          {'Petr': {'FTW': 1.0}}])
+        self.assertListEqual(['', '', '03-2023', '04-2023', '05-2023', 'Итого'], r.header())
+        self.assertListEqual([('Foma', 'OMG', [1.0, 0, 0], 1.0),
+                              ('Petr', 'FTW', [round(15 / 31, 7), 1.0, 1.0], round(36 / 52, 7)),
+                              ('Petr', 'OMG', [round(16 / 31, 7), 0.0, 0.0], round(16 / 52, 7))], list(r.rows()))
 
 
 class TestNameFilter(TestCase):
@@ -356,8 +732,86 @@ class TestZipper(TestCase):
             dg = DocsGenerator(str(dir_root))
 
             s = ServiceAssignmentsMatrix(t, {"Ptr": "Petr", "x": "y"})
-            with open('test_out.zip', mode='wb') as f:
+            with open(dir_root / 'test_out.zip', mode='wb') as f:
                 f.write(get_bundle_zip(s, '01-01-2023', '02-02-2023', {}, dg))
+            with ZipFile(BytesIO(get_bundle_zip(s, '01-01-2023', '02-02-2023', {}, dg, 'csv'))) as z:
+                self.assertIn('01-01-2023-02-02-2023.csv', z.namelist())
+                self.assertIn('CC_13.3.7/todo/Petr.docx', z.namelist())
+                sequential = [(x, z.read(x)) for x in z.namelist()]
+            class Unseekable:  # like the stdout
+                def __init__(self) -> None:
+                    self.b = BytesIO()
+
+                def write(self, x):
+                    return self.b.write(x)
+
+                def flush(self):
+                    pass
+            o = Unseekable()
+            write_bundle_zip(o, s, '01-01-2023', '02-02-2023', {}, dg)
+            with ZipFile(o.b) as z:
+                self.assertIsNone(z.testzip())
+                self.assertTrue(all(x.compress_type == ZIP_STORED for x in z.infolist() if x.filename != bundle_manifest))
+                self.assertListEqual(['01-01-2023-02-02-2023.xlsx'] + [x for x, _ in sequential[1:]], z.namelist())
+            with ZipFile(BytesIO(get_bundle_zip(s, '01-01-2023', '02-02-2023', {}, dg, 'csv'))) as z:
+                self.assertEqual(ZIP_DEFLATED, z.infolist()[0].compress_type)
+            with ZipFile(BytesIO(get_bundle_zip(s, '01-01-2023', '02-02-2023', {}, dg, 'csv', 2))) as z:
+                self.assertListEqual([x for x, _ in sequential], z.namelist())
+                for x, b in sequential[1:-1]:
+                    d1, d2 = Document(BytesIO(b)), Document(BytesIO(z.read(x)))
+                    self.assertListEqual([p.text for p in d1.paragraphs], [p.text for p in d2.paragraphs])
+                    self.assertListEqual([c.text for t in d1.tables for c in t._cells],
+                                         [c.text for t in d2.tables for c in t._cells])
 
         finally:
             rmtree(dir_root)
+
+    def test_incremental(self):
+        t = [Task('A', ['Petr'], 'CC_13.3.7', 'http://a'),
+             Task('B', ['Foma'], 'CC_13.3.7', 'http://b'),
+             Task('C', ['Oleg'], 'CR_13.3.8', 'http://c')]
+        for x in t:
+            x.essence = f'AI_{x.title}'
+            x.essence_completed = f'AI2_{x.title}'
+        dir_root = Path(mkdtemp())
+        try:
+            for x in ('todo', 'done'):
+                (dir_root / x).mkdir()
+                for y in ('CC', 'CR'):
+                    copy('.test_files/test_template_good.docx', dir_root / x / f'{y}.docx')
+
+            class Counting(DocsGenerator):
+                def get_docx(self, doctype, release, assignee, *args):
+                    self.generated.append((doctype, release, assignee))
+                    return super().get_docx(doctype, release, assignee, *args)
+            dg = Counting(str(dir_root))
+            dg.generated = []
+            first = get_bundle_zip(ServiceAssignmentsMatrix(t), '01-01-2023', '02-02-2023', {}, dg)
+            self.assertEqual(6, len(dg.generated))
+            with ZipFile(BytesIO(first)) as z:
+                self.assertEqual(bundle_manifest, z.namelist()[-1])
+                self.assertEqual(6, len(json.loads(z.read(bundle_manifest))['entries']))
+
+            dg.generated = []
+            t[1].essence_completed = 'AI2_B fixed'
+            utime(dir_root / 'todo' / 'CR.docx', ns=(1, 1))  # the template is edited
+            second = get_bundle_zip(ServiceAssignmentsMatrix(t), '01-01-2023', '02-02-2023', {}, dg,
+                                    previous=BytesIO(first))
+            self.assertListEqual([('done', 'CC_13.3.7', 'Foma'), ('todo', 'CR_13.3.8', 'Oleg')], dg.generated)
+            dg.generated = []
+            with ZipFile(BytesIO(first)) as a, ZipFile(BytesIO(second)) as b, \
+                 ZipFile(BytesIO(get_bundle_zip(ServiceAssignmentsMatrix(t), '01-01-2023', '02-02-2023', {}, dg))) as c:
+                self.assertIsNone(b.testzip())
+                self.assertListEqual(c.namelist(), b.namelist())
+                self.assertEqual(a.read('CC_13.3.7/todo/Foma.docx'), b.read('CC_13.3.7/todo/Foma.docx'))
+                self.assertIn('AI2_B fixed', '\n'.join(
+                    x.text for x in Document(BytesIO(b.read('CC_13.3.7/done/Foma.docx'))).tables[-1]._cells))
+                self.assertDictEqual(json.loads(c.read(bundle_manifest)), json.loads(b.read(bundle_manifest)))
+
+            dg.generated = []
+            get_bundle_zip(ServiceAssignmentsMatrix(t), '01-01-2023', '02-02-2023', {}, dg,
+                           previous=BytesIO(get_bundle_zip(ServiceAssignmentsMatrix(t), '01-01-2023', '02-02-2023', {},
+                                                           DocsGenerator(str(dir_root)), 'csv', 2)))
+            self.assertListEqual([], dg.generated)
+        finally:
+            rmtree(dir_root)
@@ -0,0 +1,58 @@
+from unittest import TestCase
+from tempfile import mkdtemp
+from pathlib import Path
+from shutil import rmtree
+from os import utime
+
+from src.RenderCache import RenderCache, code_version, dir_stamp
+
+
+class TestRenderCache(TestCase):
+    def setUp(self) -> None:
+        self.dir = mkdtemp()
+
+    def tearDown(self) -> None:
+        rmtree(self.dir)
+
+    def test_hit_and_miss(self):
+        c = RenderCache(self.dir, version='1')
+        k = c.key('draft_get', '01-01-2023', {'a': 'A', 'b': 'B'})
+        self.assertIsNone(c.get(k))
+        c.put(k, b'xlsx')
+        self.assertEqual(b'xlsx', c.get(k))
+        self.assertEqual(k, c.key('draft_get', '01-01-2023', {'b': 'B', 'a': 'A'}))
+        self.assertNotEqual(k, c.key('draft_get', '01-01-2023', {'a': 'A', 'b': 'C'}))
+        self.assertIsNone(RenderCache(self.dir, version='2').get(
+            RenderCache(self.dir, version='2').key('draft_get', '01-01-2023', {'a': 'A', 'b': 'B'})))
+
+    def test_files(self):
+        c = RenderCache(self.dir, version='1')
+        src, dst = Path(self.dir) / 'src.zip', Path(self.dir) / 'dst.zip'
+        src.write_bytes(b'zip')
+        self.assertFalse(c.get_file(c.key('a'), str(dst)))
+        c.put_file(c.key('a'), str(src))
+        self.assertTrue(c.get_file(c.key('a'), str(dst)))
+        self.assertEqual(b'zip', dst.read_bytes())
+        self.assertEqual(b'zip', c.get(c.key('a')))
+
+    def test_lru_eviction(self):
+        c = RenderCache(self.dir, max_bytes=35, version='1')
+        keys = [c.key(i) for i in range(3)]
+        for i, k in enumerate(keys):
+            c.put(k, b'x' * 10)
+            utime(c._path(k), ns=(i * 10**9, i * 10**9))
+        c.get(keys[0])  # the oldest one is used recently now
+        c.put(c.key(3), b'x' * 10)
+        self.assertIsNotNone(c.get(keys[0]))
+        self.assertIsNone(c.get(keys[1]))
+        self.assertIsNotNone(c.get(keys[2]))
+        self.assertEqual(30, c.size())
+        self.assertEqual(2, c.evict(10))
+
+    def test_stamps(self):
+        self.assertEqual(64, len(code_version()))
+        self.assertListEqual([], dir_stamp(str(Path(self.dir) / 'nothing')))
+        (Path(self.dir) / 'todo').mkdir()
+        (Path(self.dir) / 'todo' / 'CC.docx').write_bytes(b'123')
+        s = dir_stamp(self.dir)
+        self.assertEqual(('todo/CC.docx', 3), (s[0][0], s[0][2]))
@@ -1,7 +1,15 @@
 from datetime import datetime
+from json import loads
+from copy import deepcopy
+from pickle import dumps, loads as unpickle
 from unittest import TestCase
+from tempfile import mkdtemp, mkstemp
+from shutil import rmtree
+from pathlib import Path
+from hashlib import sha256
 
-from src.Task import Task, SnapshotManager, SnapshotStorage, TaskProvider, tasklist_to_json, json_to_tasklist
+from src.Task import Task, SnapshotManager, SnapshotStorage, DiskSnapshotStorage, SQliteSnapshotStorage, \
+    DedupSnapshotStorage, TaskProvider, tasklist_to_json, json_to_tasklist, tasklist_to_jsonl, iter_tasks
 
 
 class MockSnapshotStorage(SnapshotStorage):
@@ -18,7 +26,7 @@ class MockSnapshotStorage(SnapshotStorage):
             self.s[storage_id] = {data_id: x}
 
     def list(self, storage_id: str) -> dict[str, float]:
-        return {k: v[1] for k, v in self.s[storage_id].items()}
+        return {k: v[1] for k, v in self.s.get(storage_id, {}).items()}
 
     def read(self, storage_id: str, data_id: str) -> str:
         return self.s[storage_id][data_id][0]
@@ -37,6 +45,48 @@ class TestTaskSerialization(TestCase):
     def test_serialize_deserialize(self):
         self.assertListEqual(apr, json_to_tasklist(tasklist_to_json(apr)))
 
+    def test_legacy_snapshot(self):
+        j = ('[{"assignees": ["A1"], "body": null, "essence": "", "essence_completed": "",'
+             ' "link": "", "parent_title": null, "project": null, "release": "CC_13.3.7",'
+             ' "tid": null, "title": "April1"}]')
+        self.assertListEqual(apr[:1], json_to_tasklist(j))
+        self.assertEqual(loads(j), loads(tasklist_to_json(json_to_tasklist(j))))
+
+    def test_jsonl_streaming(self):
+        x = tasklist_to_jsonl(apr)
+        self.assertEqual(len(apr), len(x.splitlines()))
+        t = iter_tasks(x.splitlines())
+        self.assertEqual(apr[0], next(t))
+        self.assertEqual(apr[1], next(t))
+        self.assertListEqual([], list(t))
+        self.assertListEqual(apr, json_to_tasklist(x))
+        self.assertListEqual([], json_to_tasklist(tasklist_to_jsonl([])))
+        self.assertListEqual(apr, list(iter_tasks(tasklist_to_json(apr).splitlines(keepends=True))))
+
+
+class TestTask(TestCase):
+    def test_compactness(self):
+        t = Task('T', ['B', 'A', 'B'], ''.join(['CC_', '13.3.7']), '', project=''.join(['H', 'Q']))
+        self.assertFalse(hasattr(t, '__dict__'))
+        self.assertListEqual(['A', 'B'], t.assignees)
+        self.assertIs(t.release, apr[0].release)  # interned
+        self.assertIs(t.project, 'HQ')
+
+    def test_equality(self):
+        a = Task('T', ['A', 'B'], 'R', 'L', tid='1')
+        b = Task('T', ['B', 'A'], 'R', 'L', tid='2', body='B')
+        self.assertEqual(a, b)
+        self.assertEqual(hash(a), hash(b))
+        self.assertEqual(1, len({a, b}))
+        self.assertNotEqual(a, Task('T', ['A'], 'R', 'L'))
+        self.assertNotEqual(a, Task('T', ['A', 'B'], 'R2', 'L'))
+        self.assertNotEqual(a, 'T')
+
+    def test_rows(self):
+        t = Task('T', ['B', 'A'], 'CC_13.3.7', 'L', tid='1', parent_title='P', project='HQ', body_ref='ref')
+        x = Task.from_row(unpickle(dumps(t.to_row())))
+        self.assertListEqual([getattr(t, k) for k in Task.__slots__], [getattr(x, k) for k in Task.__slots__])
+
 
 class MockTasksProvider(TaskProvider):
     def get_tasks(self, pat, date_from, date_to) -> list[Task]:
@@ -137,5 +187,332 @@ class TestSnapshotManager(TestCase):
         self.assertListEqual(b, apr)
 
 
+    def test_migration(self):
+        ss = MockSnapshotStorage()
+        sm = SnapshotManager(ss, MockTasksProvider())
+        ss.write('drafts', SnapshotManager.id2_encode('01-04-2023', '30-04-2023'), tasklist_to_json(apr))
+        ss.write('drafts', SnapshotManager.id2_encode('01-03-2023', '31-03-2023'),
+                 tasklist_to_jsonl([Task('March1', ['M1'], '', '', body='B')]))
+        sm.draft_update('patpatpatpat', '01-05-2023', '31-05-2023')
+        self.assertListEqual(apr, sm.draft_get_tasks('01-04-2023', '30-04-2023'))
+
+        self.assertEqual(2, sm.migrate())
+        self.assertEqual(0, sm.migrate())
+        self.assertEqual('B', sm.draft_get_tasks('01-03-2023', '31-03-2023')[0].body)
+        self.assertEqual(['B'], [ss.read('bodies', k) for k in ss.list('bodies')])
+        x = ss.read('drafts', SnapshotManager.id2_encode('01-04-2023', '30-04-2023'))
+        self.assertEqual(tasklist_to_jsonl(apr), x)
+        self.assertListEqual(apr, sm.draft_get_tasks('01-04-2023', '30-04-2023'))
+
+    def test_bodies_out_of_line(self):
+        class Provider(TaskProvider):
+            def get_tasks(self, pat, date_from, date_to) -> list[Task]:
+                return [Task('T1', ['A'], '', '', body='Тело'), Task('T2', ['A'], '', '', body='Тело'),
+                        Task('T3', ['A'], '', '')]
+
+        ss = MockSnapshotStorage()
+        sm = SnapshotManager(ss, Provider())
+        sm.draft_update('patpatpatpat', '01-04-2023', '30-04-2023')
+        self.assertNotIn('Тело', ss.read('drafts', SnapshotManager.id2_encode('01-04-2023', '30-04-2023')))
+        self.assertEqual(1, len(ss.list('bodies')))  # the same body is kept once
+
+        t = sm.draft_get_tasks('01-04-2023', '30-04-2023')
+        self.assertListEqual([None, None, None], [x._body for x in t])
+        c = deepcopy(t[0])
+        self.assertEqual('Тело', c.body)
+        self.assertIsNone(t[0]._body)  # the original is not loaded
+        self.assertEqual('Тело', t[1].body)
+        self.assertIsNone(t[2].body)
+        self.assertIsNone(unpickle(dumps(t[0])).body_loader)
+
+        sm.draft_approve('01-04-2023', '30-04-2023')
+        x = sm.snapshots_list()[0]
+        self.assertEqual('Тело', sm.snapshots_get_tasks([x, x], 1)[0].body)
+
+        class Lookups(MockSnapshotStorage):
+            def list(self, storage_id: str) -> dict[str, float]:
+                if storage_id == 'bodies':
+                    raise AssertionError('the bodies are looked up by the hash, not listed')
+                return super().list(storage_id)
+
+            def exists(self, storage_id: str, data_id: str) -> bool:
+                return data_id in self.s.get(storage_id, {})
+
+        ss = Lookups()
+        sm = SnapshotManager(ss, Provider())
+        sm.draft_update('patpatpatpat', '01-04-2023', '30-04-2023')
+        sm.draft_update('patpatpatpat', '01-04-2023', '30-04-2023')
+        self.assertEqual(1, len(ss.s['bodies']))
+
+        ss = MockSnapshotStorage()
+        sm = SnapshotManager(ss, Provider())
+        sm.draft_update('patpatpatpat', '01-04-2023', '30-04-2023')
+        sm.draft_update('patpatpatpat', '01-05-2023', '31-05-2023')
+        sm.draft_approve('01-05-2023', '31-05-2023')
+        sm.draft_delete('01-04-2023', '30-04-2023')
+        self.assertEqual(1, len(ss.list('bodies')))  # the snapshot still has it
+        ss.write('bodies', 'orphan', 'Тело')
+        self.assertEqual(0, sm.migrate())
+        self.assertEqual(1, len(ss.list('bodies')))
+        sm.draft_update('patpatpatpat', '01-04-2023', '30-04-2023')
+        ss.delete('snapshots', next(iter(ss.list('snapshots'))))  # as if by hand
+        sm.draft_delete('01-04-2023', '30-04-2023')
+        self.assertDictEqual({}, ss.list('bodies'))
+
+        class Changing(TaskProvider):
+            body = 'Тело'
+
+            def get_tasks(self, pat, date_from, date_to) -> list[Task]:
+                return [Task('T1', ['A'], '', '', tid='1', body=self.body)]
+
+        p = Changing()
+        ss = MockSnapshotStorage()
+        sm = SnapshotManager(ss, p)
+        sm.draft_update('patpatpatpat', '01-04-2023', '30-04-2023')
+        p.body = 'Другое тело'
+        sm.draft_update('patpatpatpat', '01-04-2023', '30-04-2023')
+        self.assertEqual(2, len(ss.list('bodies')))  # the old one is kept by the delta
+        sm.draft_approve('01-04-2023', '30-04-2023')
+        self.assertEqual(1, len(ss.list('bodies')))  # the deltas are gone, so is the body
+        self.assertEqual('Другое тело', sm.snapshots_get_tasks(sm.snapshots_list(), 1)[0].body)
+
+    def test_bodies_line_separators(self):
+        class Provider(TaskProvider):
+            def get_tasks(self, pat, date_from, date_to) -> list[Task]:
+                return [Task('T1', ['A'], '', '', body='Строка 1\r\nСтрока 2\rСтрока 3\n')]
+
+        d = mkdtemp()
+        try:
+            for compress in (False, True):
+                ss = DiskSnapshotStorage(d, compress)
+                sm = SnapshotManager(ss, Provider())
+                sm.draft_update('patpatpatpat', '01-04-2023', '30-04-2023')
+                h = next(iter(ss.list('bodies')))
+                b = ss.read('bodies', h)
+                self.assertEqual('Строка 1\r\nСтрока 2\rСтрока 3\n', b)
+                self.assertEqual(h, sha256(b.encode('utf-8')).hexdigest())
+                self.assertEqual(0, sm.migrate())
+                self.assertEqual(b, sm.draft_get_tasks('01-04-2023', '30-04-2023')[0].body)
+                sm.draft_delete('01-04-2023', '30-04-2023')
+        finally:
+            rmtree(d)
+
+    def test_draft_deltas(self):
+        class Provider(TaskProvider):
+            def __init__(self) -> None:
+                self.tasks = []
+
+            def get_tasks(self, pat, date_from, date_to) -> list[Task]:
+                return self.tasks
+
+        p = Provider()
+        ss = MockSnapshotStorage()
+        sm = SnapshotManager(ss, p)
+        p.tasks = [Task('T1', ['A'], 'CC_1.0.0', 'L1', tid='1', project='P'),
+                   Task('T2', ['A'], 'CC_1.0.0', 'L2', tid='2', project='P'),
+                   Task('T3', ['B'], '', 'L3', tid='3', project='P')]
+        sm.draft_update('patpatpatpat', '01-04-2023', '30-04-2023')
+        self.assertIsNone(sm.draft_diff('01-04-2023', '30-04-2023'))
+
+        p.tasks = [Task('T1', ['A'], 'CC_1.0.1', 'L1', tid='1', project='P'),  # moved to the other release
+                   Task('T2', ['A'], 'CC_1.0.0', 'L2', tid='2', project='P'),
+                   Task('T3 edited', ['B'], '', 'L3', tid='3', project='P'),
+                   Task('T4', ['A', 'B'], '', 'L4', tid='4', project='P')]
+        sm.draft_update('patpatpatpat', '01-04-2023', '30-04-2023')
+        p.tasks = [Task('T2', ['B'], 'CC_1.0.0', 'L2', tid='2', project='P')]  # moved to the other assignee
+        sm.draft_update('patpatpatpat', '01-04-2023', '30-04-2023')
+
+        d = sm.draft_diff('01-04-2023', '30-04-2023', 1)
+        self.assertListEqual(['T4'], [x['title'] for x in d['added']])
+        self.assertListEqual([], d['removed'])
+        self.assertListEqual([('CC_1.0.0', 'CC_1.0.1')], [(x['old']['release'], x['new']['release'])
+                                                          for x in d['moved']])
+        self.assertListEqual([('T3', 'T3 edited')], [(x['old']['title'], x['new']['title'])
+                                                     for x in d['changed']])
+        d = sm.draft_diff('01-04-2023', '30-04-2023')
+        self.assertListEqual(['T1', 'T3 edited', 'T4'], [x['title'] for x in d['removed']])
+        self.assertListEqual([(['A'], ['B'])], [(x['old']['assignees'], x['new']['assignees'])
+                                                for x in d['moved']])
+
+        r0 = sm.draft_get_revision_tasks('01-04-2023', '30-04-2023', 0)
+        self.assertSetEqual({'CC_1.0.0/T1', 'CC_1.0.0/T2', '/T3'}, {f'{t.release}/{t.title}' for t in r0})
+        r1 = sm.draft_get_revision_tasks('01-04-2023', '30-04-2023', 1)
+        self.assertSetEqual({'CC_1.0.1/T1', 'CC_1.0.0/T2', '/T3 edited', '/T4'},
+                            {f'{t.release}/{t.title}' for t in r1})
+
+        sm.draft_approve('01-04-2023', '30-04-2023')
+        self.assertDictEqual({}, ss.list('draft_deltas'))
+
+    def test_parallel_load(self):
+        class Provider(TaskProvider):
+            def get_tasks(self, pat, date_from, date_to) -> list[Task]:
+                m = int(date_from[3:5])
+                return [Task(f'T{m}{i}', ['A'], '', '', project='P', tid=f'{m + i}') for i in range(3)]
+
+        sm = SnapshotManager(MockSnapshotStorage(), Provider())
+        for m in range(1, 5):
+            sm.draft_update('patpatpatpat', f'01-{m:02}-2023', f'28-{m:02}-2023')
+            sm.draft_approve(f'01-{m:02}-2023', f'28-{m:02}-2023')
+        x = sm.snapshots_list()
+        a = sm.snapshots_get_tasks(x, 1)
+        b = sm.snapshots_get_tasks(x, 2)
+        self.assertListEqual(['1', '2', '3', '4', '5', '6'], [t.tid for t in a])
+        self.assertListEqual(['T10', 'T11', 'T12', 'T22', 'T32', 'T42'], [t.title for t in a])
+        self.assertListEqual(a, b)
+
+    def test_manifest(self):
+        class CountingStorage(MockSnapshotStorage):
+            reads = 0
+
+            def read(self, storage_id: str, data_id: str) -> str:
+                if storage_id != 'manifest':
+                    CountingStorage.reads += 1
+                return super().read(storage_id, data_id)
+
+        ss = CountingStorage()
+        sm = SnapshotManager(ss, MockTasksProvider())
+        sm.draft_update('patpatpatpat', '01-05-2023', '31-05-2023')
+        sm.draft_update('patpatpatpat', '01-04-2023', '30-04-2023')
+        sm.draft_approve('01-04-2023', '30-04-2023')
+        sm.draft_approve('01-05-2023', '31-05-2023')
+        self.assertEqual(2, CountingStorage.reads)  # by the approvals only
+
+        sm = SnapshotManager(ss, MockTasksProvider())  # as if the next run
+        a = sm.snapshots_list()
+        self.assertListEqual(['01-04-2023', '01-05-2023'], [x.date_from for x in a])
+        self.assertListEqual([2, 2], [x.count for x in a])
+        self.assertEqual(len(tasklist_to_jsonl(apr).encode('utf-8')), a[0].size)
+        self.assertEqual(2, CountingStorage.reads)
+
+        del ss.s['manifest']  # the lost manifest is rebuilt from the snapshots
+        sm = SnapshotManager(ss, MockTasksProvider())
+        b = sm.snapshots_list()
+        self.assertListEqual([x.__dict__ for x in a], [x.__dict__ for x in b])
+        self.assertEqual(4, CountingStorage.reads)
+
+
 class TestSnapshotStorage(TestCase):
-    pass
+    def test_disk_storage(self):
+        d = mkdtemp()
+        try:
+            for compress in (False, True):
+                s = DiskSnapshotStorage(d, compress)
+                self.assertDictEqual({}, s.list('drafts'))
+                s.write('drafts', 'x', tasklist_to_jsonl(apr))
+                self.assertEqual(tasklist_to_jsonl(apr), s.read('drafts', 'x'))
+                self.assertListEqual(apr, list(iter_tasks(s.read_lines('drafts', 'x'))))
+                self.assertListEqual(['x'], [k for k in s.list('drafts')])
+                s.delete('drafts', 'x')
+                for x in ('a\r\nb\rc\n', 'a\r\n'):  # stored exactly, no newline translation
+                    s.write('other', 'x', x)
+                    self.assertEqual(x, s.read('other', 'x'))
+                    self.assertEqual(x, ''.join(s.read_lines('other', 'x')))
+        finally:
+            rmtree(d)
+
+    def test_dedup_storage(self):
+        d = mkdtemp()
+        try:
+            s = DedupSnapshotStorage(d)
+            s.write('drafts', 'x', tasklist_to_jsonl(apr + may))
+            s.write('drafts', 'y', tasklist_to_jsonl(may))
+            s.write('manifest', 'index', 'not a tasklist')
+            objects = list(Path(d, 'objects').glob('*/*'))
+            self.assertEqual(4, len(objects))  # the may tasks are kept once
+            self.assertEqual(tasklist_to_jsonl(apr + may), s.read('drafts', 'x'))
+            self.assertListEqual(may, list(iter_tasks(s.read_lines('drafts', 'y'))))
+            self.assertEqual('not a tasklist', s.read('manifest', 'index'))
+
+            s.write('drafts', 'x', tasklist_to_jsonl(apr))  # the may tasks are still in y
+            self.assertEqual(4, len(list(Path(d, 'objects').glob('*/*'))))
+            for i in range(3):  # the updates of a draft leave nothing behind
+                s.write('drafts', 'x', tasklist_to_jsonl([Task(f'A{i}', ['A'], '', '')]))
+            self.assertEqual(3, len(list(Path(d, 'objects').glob('*/*'))))
+            s.write('drafts', 'x', tasklist_to_jsonl(apr + may))
+
+            s.move('drafts', 'y', 'snapshots', 'z')
+            self.assertDictEqual({}, {k: v for k, v in s.list('drafts').items() if k == 'y'})
+            self.assertListEqual(may, list(iter_tasks(s.read_lines('snapshots', 'z'))))
+
+            s.delete('drafts', 'x')  # the apr tasks are not referenced anymore
+            self.assertEqual(2, len(list(Path(d, 'objects').glob('*/*'))))
+            self.assertListEqual(may, list(iter_tasks(s.read_lines('snapshots', 'z'))))
+        finally:
+            rmtree(d)
+
+    def test_moves(self):
+        d = mkdtemp()
+        try:
+            for s in (MockSnapshotStorage(), DiskSnapshotStorage(d),
+                      SQliteSnapshotStorage(mkstemp(suffix='.db')[1])):
+                s.write('drafts', 'x', tasklist_to_jsonl(apr))
+                s.move('drafts', 'x', 'snapshots', 'y')
+                self.assertNotIn('x', s.list('drafts'))
+                self.assertFalse(s.exists('drafts', 'x'))
+                self.assertTrue(s.exists('snapshots', 'y'))
+                self.assertListEqual(apr, list(iter_tasks(s.read_lines('snapshots', 'y'))))
+        finally:
+            rmtree(d)
+
+    def test_sqlite_storage(self):
+        s = SQliteSnapshotStorage(mkstemp(suffix='.db')[1])
+        self.assertDictEqual({}, s.list('drafts'))
+        t = apr + [Task('April3', ['A1', 'A2'], '', '', project='P')]
+        s.write('drafts', 'x', tasklist_to_jsonl(t))
+        s.write('other', 'x', 'not a tasklist')
+        self.assertListEqual(['x'], [k for k in s.list('drafts')])
+        self.assertEqual(tasklist_to_jsonl(t), s.read('drafts', 'x'))
+        self.assertEqual('not a tasklist', s.read('other', 'x'))
+
+        def q(**kwargs) -> list[str]:
+            return [x.title for x in iter_tasks(s.query('drafts', 'x', **kwargs))]
+        self.assertListEqual(['April1', 'April2', 'April3'], q())
+        self.assertListEqual(['April1', 'April2'], q(release='CC_13.3.7'))
+        self.assertListEqual(['April1', 'April3'], q(assignees=['A1']))
+        self.assertListEqual(['April2', 'April3'], q(assignees=['A2', 'A3']))
+        self.assertListEqual(['April2'], q(assignees=['A2'], release='CC_13.3.7'))
+        self.assertListEqual(['April3'], q(project='P'))
+
+        s.write('drafts', 'x', tasklist_to_jsonl(may))  # rewrite drops the previous rows
+        self.assertListEqual(may, list(iter_tasks(s.read_lines('drafts', 'x'))))
+        self.assertListEqual([], q(assignees=['A1']))
+        s.delete('drafts', 'x')
+        with self.assertRaises(KeyError):
+            s.read('drafts', 'x')
+        with self.assertRaises(KeyError):
+            s.delete('drafts', 'x')
+
+    def test_line_separators(self):
+        class Provider(TaskProvider):
+            def get_tasks(self, pat, date_from, date_to) -> list[Task]:
+                return [Task('Заголовок\u2028вторая строка', ['A\u0085B'], '', '', parent_title='P\u2029', tid='1'),
+                        Task('T', ['A'], '', '', tid='2')]
+
+        t = Provider().get_tasks('', '', '')
+        self.assertListEqual(t, json_to_tasklist(tasklist_to_jsonl(t)))
+        d = mkdtemp()
+        try:
+            for ss in (MockSnapshotStorage(), DiskSnapshotStorage(d), DedupSnapshotStorage(str(Path(d, 'dedup'))),
+                       SQliteSnapshotStorage(mkstemp(suffix='.db')[1])):
+                sm = SnapshotManager(ss, Provider())
+                sm.draft_update('patpatpatpat', '01-04-2023', '30-04-2023')
+                sm.draft_approve('01-04-2023', '30-04-2023')
+                sm.manifest_rebuild()
+                x = sm.snapshots_list()
+                self.assertListEqual([2], [y.count for y in x])
+                self.assertListEqual(t, sm.snapshots_get_tasks(x, 1))
+                self.assertListEqual(t, sm.snapshots_get_tasks(x, 2))
+        finally:
+            rmtree(d)
+
+    def test_query_fallback(self):
+        for ss in (MockSnapshotStorage(), SQliteSnapshotStorage(mkstemp(suffix='.db')[1])):
+            sm = SnapshotManager(ss, MockTasksProvider())
+            sm.draft_update('patpatpatpat', '01-04-2023', '30-04-2023')
+            self.assertListEqual(apr[1:], list(sm.draft_query_tasks('01-04-2023', '30-04-2023', assignees=['A2'])))
+            sm.draft_approve('01-04-2023', '30-04-2023')
+            x = sm.snapshots_list()[0]
+            self.assertListEqual(apr, list(sm.snapshot_query_tasks(x.date_from, x.date_to, x.mtime,
+                                                                   release='CC_13.3.7')))
+            self.assertListEqual([], list(sm.snapshot_query_tasks(x.date_from, x.date_to, x.mtime,
+                                                                  release='CC_13.3.8')))
@@ -1,16 +1,19 @@
 #!/usr/bin/python3
 from subprocess import call
-from sys import platform
+from sys import platform, stdout
 from datetime import datetime as dt, timezone, timedelta
 from tempfile import mkstemp
 from typing import Tuple
+from io import BytesIO
 from progress.bar import Bar
+import json
 import os
 
 from src.ArgsTypes import parse_args
 from src.Handlers import HandlerCai, HandlerIS, HandlerLingvo
-from src.Matrix import Matrix, ExcelPrinter, ServiceAssignmentsMatrix, get_bundle_zip, DocsGenerator
-from src.Task import DiskSnapshotStorage, SnapshotManager, Task, TaskProvider
+from src.Matrix import Matrix, PeriodReport, ServiceAssignmentsMatrix, write_bundle_zip, get_printer, printers, snapshots_percents, DocsGenerator
+from src.Task import DiskSnapshotStorage, DedupSnapshotStorage, SQliteSnapshotStorage, SnapshotInfo, SnapshotManager, Task, TaskProvider
+from src.RenderCache import RenderCache, NoRenderCache, dir_stamp
 from src.AI import Cache, SQlite, ChatGPT
 
 
@@ -33,6 +36,10 @@ def get_next(sm: SnapshotManager) -> Tuple[str, str]:
     return (date_fr, date_to)
 
 
+def snapshot_stamp(x: SnapshotInfo) -> Tuple[str, str, float, str | None]:
+    return (x.date_from, x.date_to, x.mtime, x.checksum)
+
+
 def get_the_earliest(dates: list[str]) -> str:
     d = [(dt.strptime(x, '%d-%m-%Y'), x) for x in dates]
     return sorted(d, reverse=False)[0][1]
@@ -44,8 +51,11 @@ def get_the_latest(dates: list[str]) -> str:
 
 
 path_db_dir = './.db'
+path_db_dedup_dir = './.db_dedup'
 path_sqlite = './.essence_cache.sqlite'
+path_snapshots_sqlite = './.snapshots.sqlite'
 path_templates = './templates'
+path_render_cache = './.render_cache'
 fname_xslsx = {'prefix': 'tfs_excel_', 'suffix': '.xlsx'}
 fname_zip = {'prefix': 'tfs_excel_', 'suffix': '.zip'}
 
@@ -53,9 +63,22 @@ fname_zip = {'prefix': 'tfs_excel_', 'suffix': '.zip'}
 def main():
     a = parse_args()
     file_out = None
+    fname_report = {**fname_xslsx, 'suffix': printers[a.format].suffix}
+    rc = RenderCache(path_render_cache, a.render_cache_size)
+    if a.no_render_cache:
+        rc = NoRenderCache()
+    # None — как принято для --xlsx_streaming: при нём задачи на листе задач вместо комментариев
+    xlsx_options = {'streaming': a.xlsx_streaming,
+                    'comments': False if a.no_comments else None,
+                    'tasks_sheet': True if a.xlsx_tasks_sheet else None}
 
     tp = TFS_TaskProvider()
-    sm = SnapshotManager(DiskSnapshotStorage(path_db_dir), tp)
+    if a.storage == 'sqlite':
+        sm = SnapshotManager(SQliteSnapshotStorage(path_snapshots_sqlite), tp)
+    elif a.storage == 'dedup':
+        sm = SnapshotManager(DedupSnapshotStorage(path_db_dedup_dir), tp)
+    else:
+        sm = SnapshotManager(DiskSnapshotStorage(path_db_dir, a.gzip), tp)
     if a.cache_fill is not None:
         date_from, date_to = ('', '')
         if isinstance(a.cache_fill, bool):
@@ -65,6 +88,37 @@ def main():
         c = Cache(SQlite(path_sqlite), ChatGPT(a.key, a.ai_rpm_limit))
         c.filter(tp.get_tasks(a.pat, date_from, date_to))
 
+    elif a.cache_stats:
+        x = SQlite(path_sqlite).stats()
+        print((f'size: {x["size"]} bytes'
+               f' rows: {x["rows"]}'
+               f' compressed bodies: {x["bodies_compressed"]}'
+               f' hits: {x["hits"]}'
+               f' misses: {x["misses"]}'
+               f' hit ratio: {x["hit_ratio"]:.2%}'))
+
+    elif a.cache_evict is not None:
+        s = SQlite(path_sqlite)
+        kind, x = a.cache_evict
+        n = s.evict_older_than(x) if kind == 'age' else s.evict_to_size(x)
+        s.vacuum()
+        print(f'{n} entries evicted from the cache')
+
+    elif a.cache_compact is not None:
+        n = SQlite(path_sqlite).compact_bodies(a.cache_compact, a.drop_bodies)
+        print(f'{n} bodies {"dropped" if a.drop_bodies else "compressed"}')
+
+    elif a.cache_vacuum:
+        SQlite(path_sqlite).vacuum()
+
+    elif a.cache_export is not None:
+        n = SQlite(path_sqlite).export(a.cache_export, a.since)
+        print(f'{n} essences exported into "{a.cache_export}"')
+
+    elif a.cache_import is not None:
+        n = SQlite(path_sqlite).merge(a.cache_import, a.prefer_model)
+        print(f'{n} essences merged from "{a.cache_import}"')
+
     elif a.draft_update is not None:
         date_from, date_to = ('', '')
         if isinstance(a.draft_update, bool):
@@ -72,17 +126,42 @@ def main():
         else:
             date_from, date_to = a.draft_update
         sm.draft_update(a.pat, date_from, date_to)
-        file_out = a.out if a.out is not None else mkstemp(**fname_xslsx)[1]
-        with ExcelPrinter(file_out, date_from, date_to) as p:
-            l = sm.draft_get_tasks(date_from, date_to)
+        file_out = a.out if a.out is not None else mkstemp(**fname_report)[1]
+        with get_printer(a.format, file_out, date_from, date_to, **xlsx_options) as p:
+            l = sm.draft_iter_tasks(date_from, date_to)
             p.print(Matrix(l, a.names_reference), a.predefined_spend)
 
     elif a.draft_get is not None:
         x = sm.drafts_list()[a.draft_get]
-        file_out = a.out if a.out is not None else mkstemp(**fname_xslsx)[1]
-        with ExcelPrinter(file_out, x.date_from, x.date_to) as p:
-            l = sm.draft_get_tasks(x.date_from, x.date_to)
-            p.print(Matrix(l, a.names_reference), a.predefined_spend)
+        file_out = a.out if a.out is not None else mkstemp(**fname_report)[1]
+        k = rc.key('draft_get', a.storage, snapshot_stamp(x), a.names_reference,
+                   a.predefined_spend, a.format, xlsx_options)
+        o = rc.get(k)
+        if o is None:
+            b = BytesIO()
+            with get_printer(a.format, b, x.date_from, x.date_to, **xlsx_options) as p:
+                l = sm.draft_iter_tasks(x.date_from, x.date_to)
+                p.print(Matrix(l, a.names_reference), a.predefined_spend)
+            o = b.getvalue()
+            rc.put(k, o)
+        with open(file_out, mode='wb') as f:
+            f.write(o)
+
+    elif a.draft_diff is not None:
+        x = sm.drafts_list()[a.draft_diff]
+        d = sm.draft_diff(x.date_from, x.date_to)
+        if d is None:
+            print('The draft has not been updated since it was created')
+        else:
+            for t in d['added']:
+                print(f'+ {t["release"] or "DEFAULT"} {", ".join(t["assignees"])}: {t["title"]} {t["link"]}')
+            for t in d['removed']:
+                print(f'- {t["release"] or "DEFAULT"} {", ".join(t["assignees"])}: {t["title"]} {t["link"]}')
+            for t in d['moved']:
+                o, n = t['old'], t['new']
+                print((f'~ {n["title"]} {n["link"]}:'
+                       f' {o["release"] or "DEFAULT"} {", ".join(o["assignees"])}'
+                       f' -> {n["release"] or "DEFAULT"} {", ".join(n["assignees"])}'))
 
     elif a.draft_delete is not None:
         x = sm.drafts_list()[a.draft_delete]
@@ -93,7 +172,8 @@ def main():
             x = dt.fromtimestamp(d.mtime, tz=timezone.utc).astimezone()
             print((f'#{i} from: {d.date_from}'
                    f' to: {d.date_to}'
-                   f' mtime: {x.strftime("%d-%m-%Y %H:%M:%S.%f")}'))
+                   f' mtime: {x.strftime("%d-%m-%Y %H:%M:%S.%f")}'
+                   f' tasks: {d.count}'))
 
     elif a.draft_approve is not None:
         x = sm.drafts_list()[a.draft_approve]
@@ -104,24 +184,74 @@ def main():
             x = dt.fromtimestamp(d.mtime, tz=timezone.utc).astimezone()
             print((f'#{i} from: {d.date_from}'
                    f' to: {d.date_to}'
-                   f' mtime: {x.strftime("%d-%m-%Y %H:%M:%S.%f")}'))
+                   f' mtime: {x.strftime("%d-%m-%Y %H:%M:%S.%f")}'
+                   f' tasks: {d.count}'))
+
+    elif a.manifest_rebuild:
+        sm.manifest_rebuild()
+
+    elif a.snapshots_migrate:
+        print(f'{sm.migrate()} drafts and snapshots migrated')
 
     elif a.snapshot_get is not None:
-        fr, to, tasks = [], [], []
-        for i in a.snapshot_get:
-            x = sm.snapshots_list()[i]
-            tasks += sm.snapshot_get_tasks(x.date_from, x.date_to, x.mtime)
-            fr.append(x.date_from)
-            to.append(x.date_to)
-        date_fr = get_the_earliest(fr)
-        date_to = get_the_latest(to)
+        snapshots = [sm.snapshots_list()[i] for i in a.snapshot_get]
+        date_fr = get_the_earliest([x.date_from for x in snapshots])
+        date_to = get_the_latest([x.date_to for x in snapshots])
 
-        c = Cache(SQlite(path_sqlite), ChatGPT(a.key, a.ai_rpm_limit))
-        s = ServiceAssignmentsMatrix(c.filter(tasks), a.names_reference)
-        dg = DocsGenerator(path_templates)
-        file_out = a.out if a.out is not None else mkstemp(**fname_zip)[1]
-        with open(file_out, mode='wb') as f:
-            f.write(get_bundle_zip(s, date_fr, date_to, a.predefined_spend, dg))
+        def get_bundle_args():
+            tasks = sm.snapshots_get_tasks(snapshots, a.jobs)
+            c = Cache(SQlite(path_sqlite), ChatGPT(a.key, a.ai_rpm_limit))
+            s = ServiceAssignmentsMatrix(c.filter(tasks), a.names_reference)
+            return (s, date_fr, date_to, a.predefined_spend, DocsGenerator(path_templates, a.docx_precompiled))
+
+        # the docx are made of the essences, so their cache is a part of the key
+        k = rc.key('snapshot_get', a.storage, [snapshot_stamp(x) for x in snapshots], a.names_reference,
+                   a.predefined_spend, dir_stamp(path_templates), SQlite(path_sqlite).essences_version(),
+                   a.format, xlsx_options)
+        if a.out == '-':
+            # в stdout пишем сразу, без кэша: пайп не перечитать
+            o = rc.get(k)
+            if o is None:
+                write_bundle_zip(stdout.buffer, *get_bundle_args(), a.format, a.jobs, **xlsx_options)
+            else:
+                stdout.buffer.write(o)
+        else:
+            file_out = a.out if a.out is not None else mkstemp(**fname_zip)[1]
+            if not rc.get_file(k, file_out):
+                previous = None
+                if a.incremental and a.out is not None and os.path.isfile(file_out):
+                    # прежний архив откладываем в сторону: из него копируются неизменившиеся docx
+                    previous = file_out + '.previous'
+                    os.replace(file_out, previous)
+                try:
+                    write_bundle_zip(file_out, *get_bundle_args(), a.format, a.jobs, previous, **xlsx_options)
+                except BaseException:
+                    if previous is not None:
+                        os.replace(previous, file_out)
+                    raise
+                if previous is not None:
+                    os.remove(previous)
+                rc.put_file(k, file_out)
+
+    elif a.report_periods is not None:
+        if a.format not in PeriodReport.formats:
+            exit(f'The report of periods is written as either of {", ".join(PeriodReport.formats)} only')
+        snapshots = sorted([sm.snapshots_list()[i] for i in a.report_periods],
+                           key=lambda x: dt.strptime(x.date_from, '%d-%m-%Y'))
+        # проценты по каждому снимку берём из кэша, считаем только новые
+        keys = [rc.key('snapshot_percents', a.storage, snapshot_stamp(x), a.names_reference, a.predefined_spend)
+                for x in snapshots]
+        percents = [rc.get(k) for k in keys]
+        missing = [i for i, x in enumerate(percents) if x is None]
+        computed = snapshots_percents(sm, [snapshots[i] for i in missing],
+                                      a.names_reference, a.predefined_spend, a.jobs)
+        for i, x in zip(missing, computed):
+            percents[i] = json.dumps(x, ensure_ascii=False).encode('utf-8')
+            rc.put(keys[i], percents[i])
+        r = PeriodReport([(x.date_from, x.date_to) for x in snapshots], [json.loads(x) for x in percents])
+        fname = {**fname_xslsx, 'suffix': PeriodReport.suffix[a.format]}
+        file_out = a.out if a.out is not None else mkstemp(**fname)[1]
+        r.write(a.format, file_out)
 
     if file_out:
         if a.no_open: